@@ -0,0 +1,9 @@
+#!/usr/bin/env python
+"""AuthorizedKeysCommand for sshd, see src/authorized_keys.py."""
+
+import sys
+
+from src.authorized_keys import main
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
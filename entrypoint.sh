@@ -0,0 +1,34 @@
+#!/bin/bash
+# Start the services of the container in the foreground, and stop the container
+# as soon as any of them exits, for its restart policy to start them all again.
+set -e
+
+# stop whatever is still running on the way out
+trap 'kill $(jobs -p) 2>/dev/null' EXIT
+trap 'exit 143' TERM INT
+
+redis-server --daemonize no &
+until redis-cli ping >/dev/null 2>&1; do
+    sleep 0.1
+done
+nginx -g "daemon off;" &
+
+# read by src.env like the urls do, from the environment and then .env
+if [ "$(python -c 'from src.env import TUNNEL_API_ASYNC; print(TUNNEL_API_ASYNC)')" = True ]; then
+    uvicorn src.asgi:application --host 0.0.0.0 --port 8000 --workers 5 --lifespan off &
+else
+    gunicorn -w 5 src.wsgi:application -b 0.0.0.0:8000 &
+fi
+uvicorn src.asgi:application --host 127.0.0.1 --port 8001 --lifespan off &
+python manage.py edge_agent &
+python manage.py run_proxy &
+python manage.py key_pool &
+python manage.py run_scheduler &
+python manage.py probe_tunnels &
+/usr/sbin/sshd -D &
+
+set +e
+wait -n
+status=$?
+echo "A service exited with status $status, stopping the container" >&2
+exit "$status"
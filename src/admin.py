@@ -4,6 +4,7 @@ from typing import Any
 from django.contrib import admin
 from django.contrib.admin import SimpleListFilter
 from django.contrib.admin.options import InlineModelAdmin
+from django.contrib.admin.views.main import ChangeList
 from django.contrib.auth.admin import UserAdmin
 from django.contrib.auth.models import Group, User
 from django.db.models import Count
@@ -11,8 +12,11 @@ from django.db.models.query import QuerySet
 from django.http.request import HttpRequest
 from django.utils.translation import gettext_lazy as _
 
+from src.connections import connection_registry
 from src.forms import ProjectForm, ProjectFormSuperUser, UserCreationForm
-from src.models import Project
+from src.funks import purge_proxy_cache
+from src.models import ConnectionEvent, Project
+from src.probes import tunnel_prober
 
 
 class SuperAdminFilter(SimpleListFilter):
@@ -55,11 +59,30 @@ class UserHasProjectsFilter(SuperAdminFilter):
         return queryset
 
 
+class OnlineFilter(SimpleListFilter):
+    title = _("online")
+    parameter_name = "online"
+
+    def lookups(self, request, model_admin) -> Sequence[tuple[str, str]]:  # noqa: ARG002
+        return (
+            ("1", _("Yes")),
+            ("0", _("No")),
+        )
+
+    def queryset(self, request, queryset) -> QuerySet[Project]:  # noqa: ARG002
+        if self.value() == "1":
+            return queryset.filter(id__in=connection_registry.online_ids())
+        if self.value() == "0":
+            return queryset.exclude(id__in=connection_registry.online_ids())
+        return queryset
+
+
 @admin.register(Project)
 class ProjectAdmin(admin.ModelAdmin):
     search_fields = ("domain", "user__username")
     list_display_links = ("domain",)
-    list_filter = (UserHasProjectsFilter, ActiveUserFilter)
+    list_filter = (UserHasProjectsFilter, ActiveUserFilter, OnlineFilter)
+    actions = ("purge_cache",)
 
     def get_readonly_fields(
         self,
@@ -81,6 +104,10 @@ class ProjectAdmin(admin.ModelAdmin):
                 "created_at",
                 "updated_at",
                 "last_connected_at",
+                "connection_count",
+                "online",
+                "probe_rtt",
+                "cache_enabled",
             )
         return (
             "domain",
@@ -88,6 +115,10 @@ class ProjectAdmin(admin.ModelAdmin):
             "created_at",
             "updated_at",
             "last_connected_at",
+            "connection_count",
+            "online",
+            "probe_rtt",
+            "cache_enabled",
         )
 
     def get_form(
@@ -107,11 +138,11 @@ class ProjectAdmin(admin.ModelAdmin):
     ) -> Sequence[Callable[..., Any] | str]:
         if obj:
             if request.user.is_superuser:
-                return ("domain", "user", "secret_key")
-            return ("domain", "secret_key")
+                return ("domain", "user", "secret_key", "cache_enabled")
+            return ("domain", "secret_key", "cache_enabled")
         if request.user.is_superuser:
-            return ("domain", "user")
-        return ("domain",)
+            return ("domain", "user", "cache_enabled")
+        return ("domain", "cache_enabled")
 
     def get_queryset(self, request: HttpRequest) -> QuerySet[Project]:
         qs = super().get_queryset(request).select_related("user")
@@ -132,6 +163,75 @@ class ProjectAdmin(admin.ModelAdmin):
 
         super().save_model(request, obj, form, change)
 
+    def get_changelist_instance(self, request: HttpRequest) -> ChangeList:
+        changelist = super().get_changelist_instance(request)
+        # the live state of the page, read from Redis once rather than per row
+        projects = list(changelist.result_list)
+        project_ids = [project.id for project in projects]
+        online = connection_registry.online_among(project_ids)
+        states = tunnel_prober.states(project_ids)
+        for project in projects:
+            project.is_online = project.id in online
+            project.probe_state = states.get(project.id)
+        return changelist
+
+    @admin.display(description=_("Online"), boolean=True)
+    def online(self, obj: Project) -> bool:
+        if hasattr(obj, "is_online"):
+            return obj.is_online
+        return connection_registry.is_online(obj.id)
+
+    @admin.display(description=_("Probe RTT"))
+    def probe_rtt(self, obj: Project) -> str:
+        if hasattr(obj, "probe_state"):
+            state = obj.probe_state
+        else:
+            state = tunnel_prober.state(obj.id)
+        if state is None or not self.online(obj):
+            return "-"
+        if not state["healthy"]:
+            return _("Unhealthy")
+        if state["rtt"] is None:
+            return _("Failed %(count)d") % {"count": state["failures"]}
+        return f"{state['rtt'] * 1000:.1f} ms"
+
+    @admin.action(
+        description=_("Purge the cache of selected projects"),
+        permissions=("change",),
+    )
+    def purge_cache(self, request: HttpRequest, queryset: QuerySet[Project]) -> None:
+        for project in queryset:
+            purge_proxy_cache(project.domain)
+        self.message_user(
+            request,
+            _("Purged the cache of %(count)d projects.") % {"count": len(queryset)},
+        )
+
+
+@admin.register(ConnectionEvent)
+class ConnectionEventAdmin(admin.ModelAdmin):
+    list_display = ("project", "event", "occurred_at", "duration", "port", "socket")
+    list_filter = ("event",)
+    search_fields = ("project__domain",)
+    date_hierarchy = "occurred_at"
+    list_select_related = ("project",)
+
+    def get_queryset(self, request: HttpRequest) -> QuerySet[ConnectionEvent]:
+        qs = super().get_queryset(request)
+        if request.user.is_superuser:
+            return qs
+        return qs.filter(project__user=request.user)
+
+    # the history is append-only, written by `manage.py run_scheduler`
+    def has_add_permission(self, request: HttpRequest) -> bool:  # noqa: ARG002
+        return False
+
+    def has_change_permission(self, request, obj=None) -> bool:  # noqa: ARG002
+        return False
+
+    def has_delete_permission(self, request, obj=None) -> bool:  # noqa: ARG002
+        return False
+
 
 class ProjectInline(admin.TabularInline):
     model = Project
@@ -12,4 +12,23 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "src.settings")
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# needs the apps loaded by get_asgi_application
+from src.websocket import tunnel_websocket  # noqa: E402
+
+WEBSOCKET_ROUTES = {
+    "/ws/tunnel/": tunnel_websocket,
+}
+
+
+async def application(scope, receive, send) -> None:
+    """Serve the WebSocket routes, and the rest with Django."""
+    if scope["type"] == "websocket":
+        handler = WEBSOCKET_ROUTES.get(scope["path"])
+        if handler is None:
+            await send({"type": "websocket.close"})
+            return
+        await handler(scope, receive, send)
+        return
+    await django_application(scope, receive, send)
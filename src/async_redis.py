@@ -0,0 +1,24 @@
+import asyncio
+import weakref
+
+import redis.asyncio
+from django.conf import settings
+
+# event loop -> client, a client cannot be shared across event loops
+_clients: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+def get_async_redis() -> redis.asyncio.Redis:
+    """Get an asyncio Redis client to the cache database, for the running loop.
+
+    ASGI servers run a single loop per process, whereas async views called
+    under WSGI get a new loop per request.
+
+    :return: redis.asyncio.Redis
+    """
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = redis.asyncio.from_url(settings.CACHES["default"]["LOCATION"])
+        _clients[loop] = client
+    return client
@@ -0,0 +1,154 @@
+"""Public keys tunnel users may log in with, kept in Redis until they expire.
+
+sshd runs `authorized_keys.py <username>` as its AuthorizedKeysCommand on every
+login attempt, so the lookup side imports neither Django nor the redis client
+and speaks just enough of the Redis protocol for a single query. Redis, being
+in memory, is the fast path of the lookup: there is no cache in front of it,
+which would keep serving a revoked key until the cache expires.
+"""
+
+import os
+import socket
+import sys
+import time
+from pathlib import Path
+
+import dotenv
+
+AUTHORIZED_KEYS_KEY = "demos:authkeys:{}"
+LOOKUP_TIMEOUT = 2
+
+ENV_FILE = Path(__file__).resolve().parent.parent / ".env"
+# same defaults as `src.env`
+REDIS_SETTINGS = {"REDIS_HOST": "localhost", "REDIS_PORT": "6379", "REDIS_DB": "0"}
+
+
+def get_redis_settings() -> dict[str, str]:
+    """Get the REDIS_* settings, the only ones the lookup needs.
+
+    sshd runs the command as nobody, with an empty environment, so a setting
+    missing from the environment is read from the .env file, and if the file
+    cannot be read either, the default is used. `src.env` is not imported:
+    it requires settings the lookup does not need.
+
+    :return: dict, setting name -> value
+    """
+    try:
+        values = dotenv.dotenv_values(ENV_FILE)
+    except Exception:
+        values = {}
+    return {
+        key: os.environ.get(key) or values.get(key) or default
+        for key, default in REDIS_SETTINGS.items()
+    }
+
+
+def add_authorized_key(redis, username, public_key, ttl) -> None:
+    """Authorize a public key for the user until it expires.
+
+    :param redis: redis client
+    :param username: string
+    :param public_key: string, an authorized_keys line
+    :param ttl: int, seconds the key stays valid
+    :return: None
+    """
+    key = AUTHORIZED_KEYS_KEY.format(username)
+    now = time.time()
+    pipe = redis.pipeline()
+    pipe.zremrangebyscore(key, "-inf", now)
+    pipe.zadd(key, {public_key: now + ttl})
+    # every key has the same lifetime, the newest one expires last
+    pipe.expire(key, ttl)
+    pipe.execute()
+
+
+def revoke_authorized_keys(redis, username) -> None:
+    """Revoke every key of the user.
+
+    :param redis: redis client
+    :param username: string
+    :return: None
+    """
+    redis.delete(AUTHORIZED_KEYS_KEY.format(username))
+
+
+def encode_command(*args) -> bytes:
+    """Encode a Redis command in the RESP protocol.
+
+    :return: bytes
+    """
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        value = str(arg).encode()
+        parts.append(b"$%d\r\n%s\r\n" % (len(value), value))
+    return b"".join(parts)
+
+
+def read_reply(file) -> bytes | int | list | None:
+    """Read a Redis reply from a buffered socket file.
+
+    :param file: file object
+    :return: bytes, int, list or None
+    """
+    line = file.readline()
+    if not line.endswith(b"\r\n"):
+        raise ConnectionError("Connection closed by Redis")
+    kind, value = line[:1], line[1:-2]
+    if kind == b"+":
+        return value
+    if kind == b"-":
+        raise ConnectionError(value.decode())
+    if kind == b":":
+        return int(value)
+    if kind == b"$":
+        if value == b"-1":
+            return None
+        data = file.read(int(value) + 2)
+        return data[:-2]
+    if kind == b"*":
+        if value == b"-1":
+            return None
+        return [read_reply(file) for _ in range(int(value))]
+    raise ConnectionError(f"Unexpected reply from Redis: {line!r}")
+
+
+def get_authorized_keys(username) -> list[str]:
+    """Get the keys of the user that have not expired yet.
+
+    :param username: string
+    :return: list of authorized_keys lines
+    """
+    redis = get_redis_settings()
+    commands = [
+        ("ZRANGEBYSCORE", AUTHORIZED_KEYS_KEY.format(username), time.time(), "+inf"),
+    ]
+    if redis["REDIS_DB"] != "0":
+        commands.insert(0, ("SELECT", redis["REDIS_DB"]))
+    with (
+        socket.create_connection(
+            (redis["REDIS_HOST"], int(redis["REDIS_PORT"])),
+            timeout=LOOKUP_TIMEOUT,
+        ) as sock,
+        sock.makefile("rb") as file,
+    ):
+        sock.sendall(b"".join(encode_command(*command) for command in commands))
+        replies = [read_reply(file) for _ in commands]
+    return [key.decode() for key in replies[-1]]
+
+
+def main(argv: list[str]) -> int:
+    """Print the authorized keys of the user given as the only argument.
+
+    :param argv: list of strings
+    :return: int, exit status
+    """
+    if len(argv) != 1:
+        sys.stderr.write("usage: authorized_keys.py <username>\n")
+        return 2
+    try:
+        keys = get_authorized_keys(argv[0])
+    except Exception:
+        # sshd treats a failure as no keys, the login is refused
+        return 1
+    sys.stdout.write("".join(f"{key}\n" for key in keys))
+    return 0
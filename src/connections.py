@@ -0,0 +1,445 @@
+import json
+import logging
+import time
+from functools import cached_property
+
+from django_redis import get_redis_connection
+
+from src.async_redis import get_async_redis
+from src.env import KEEP_ALIVE_TIMEOUT
+from src.funks import gen_default_nginx_confs
+from src.history import connection_history
+from src.ports import LEASE_PRELUDE, port_allocator
+
+# KEYS: deadlines zset (project id -> heartbeat deadline)
+# ARGV: hash key prefix, now, timeout, project id
+_HEARTBEAT = """
+if not redis.call("ZSCORE", KEYS[1], ARGV[4]) then
+    return 0
+end
+redis.call("ZADD", KEYS[1], tonumber(ARGV[2]) + tonumber(ARGV[3]), ARGV[4])
+redis.call("HSET", ARGV[1] .. ARGV[4], "last_heartbeat", ARGV[2])
+return 1
+"""
+
+# KEYS: deadlines zset, domains hash (domain -> project id)
+# ARGV: hash key prefix, now, timeout, domain
+_HEARTBEAT_DOMAIN = """
+local id = redis.call("HGET", KEYS[2], ARGV[4])
+if not id or not redis.call("ZSCORE", KEYS[1], id) then
+    return false
+end
+redis.call("ZADD", KEYS[1], tonumber(ARGV[2]) + tonumber(ARGV[3]), id)
+redis.call("HSET", ARGV[1] .. id, "last_heartbeat", ARGV[2])
+return {id, redis.call("HGET", ARGV[1] .. id, "port")}
+"""
+
+# KEYS: the 7 keys of the port allocator, deadlines zset, domains hash
+# ARGV: range start, range end, now, hash key prefix, batch size
+# The deadline is checked and the connection removed in one go, so a client
+# heartbeating or connecting again meanwhile is never reaped. The port goes back
+# to the pool along with it, unless the project leased it again since.
+_REAP = (
+    LEASE_PRELUDE
+    + """
+local ids = redis.call("ZRANGEBYSCORE", KEYS[8], "-inf", ARGV[3], "LIMIT", 0, ARGV[5])
+local expired = {}
+for _, id in ipairs(ids) do
+    local key = ARGV[4] .. id
+    redis.call("ZREM", KEYS[8], id)
+    local domain = redis.call("HGET", key, "domain")
+    if domain and redis.call("HGET", KEYS[9], domain) == id then
+        redis.call("HDEL", KEYS[9], domain)
+    end
+    local port = redis.call("HGET", key, "port")
+    if port and port ~= "" and redis.call("HGET", KEYS[3], port) == id then
+        local lease = redis.call("ZSCORE", KEYS[2], port)
+        if not lease or tonumber(lease) <= tonumber(ARGV[3]) then
+            release(port)
+        end
+    end
+    expired[#expired + 1] = redis.call("HGETALL", key)
+    redis.call("DEL", key)
+end
+return expired
+"""
+)
+
+
+def _decode(fields) -> dict:
+    if isinstance(fields, dict):
+        fields = [item for pair in fields.items() for item in pair]
+    connection = {
+        key.decode(): value.decode()
+        for key, value in zip(fields[::2], fields[1::2], strict=True)
+    }
+    for key in ("project_id", "port"):
+        connection[key] = int(connection[key]) if connection.get(key) else None
+    for key in ("connected_at", "last_heartbeat"):
+        if key in connection:
+            connection[key] = float(connection[key])
+    return connection
+
+
+class ConnectionRegistry:
+    """Live tunnels, kept in Redis.
+
+    Each connection is a hash (project id, domain, port or socket, connected_at,
+    last_heartbeat), and a sorted set holds the heartbeat deadline of every
+    connection. A heartbeat is a single ZADD, listing the live tunnels is a
+    range query, and the reaper only ever reads the expired entries.
+
+    Connecting, disconnecting and timing out are published on the channel of
+    the domain, see `events_channel`, for the clients holding a WebSocket, and
+    recorded in the connection history, see `src.history`.
+
+    Methods prefixed with `a` do the same over the asyncio Redis client.
+    """
+
+    def __init__(
+        self,
+        namespace: str = "demos:connections",
+        timeout: int = KEEP_ALIVE_TIMEOUT,
+    ) -> None:
+        self.timeout = timeout
+        self.deadlines_key = f"{namespace}:deadlines"
+        self.domains_key = f"{namespace}:domains"
+        self.prefix = f"{namespace}:"
+        self.events_prefix = f"{namespace}:events:"
+
+    @cached_property
+    def redis(self):
+        return get_redis_connection("default")
+
+    @cached_property
+    def _heartbeat(self):
+        return self.redis.register_script(_HEARTBEAT)
+
+    @cached_property
+    def _heartbeat_domain(self):
+        return self.redis.register_script(_HEARTBEAT_DOMAIN)
+
+    @cached_property
+    def _reap(self):
+        return self.redis.register_script(_REAP)
+
+    def register(
+        self,
+        project_id: int,
+        domain: str,
+        port: int | None = None,
+        socket: str | None = None,
+    ) -> None:
+        """Record a new connection, replacing the previous one of the project.
+
+        :param project_id: int
+        :param domain: string
+        :param port: int
+        :param socket: string
+        :return: None
+        """
+        pipe = self.redis.pipeline()
+        self._queue_register(pipe, project_id, domain, port, socket)
+        pipe.execute()
+
+    async def aregister(
+        self,
+        project_id: int,
+        domain: str,
+        port: int | None = None,
+        socket: str | None = None,
+    ) -> None:
+        pipe = get_async_redis().pipeline()
+        self._queue_register(pipe, project_id, domain, port, socket)
+        await pipe.execute()
+
+    def _queue_register(self, pipe, project_id, domain, port, socket) -> None:
+        now = time.time()
+        key = f"{self.prefix}{project_id}"
+        pipe.delete(key)
+        pipe.hset(
+            key,
+            mapping={
+                "project_id": project_id,
+                "domain": domain,
+                "port": port or "",
+                "socket": socket or "",
+                "connected_at": now,
+                "last_heartbeat": now,
+            },
+        )
+        pipe.zadd(self.deadlines_key, {project_id: now + self.timeout})
+        pipe.hset(self.domains_key, domain, project_id)
+        self.publish(
+            domain,
+            {"event": "connected", "port": port, "socket": socket, "connected_at": now},
+            pipe=pipe,
+        )
+        connection_history.queue_connect(pipe, project_id, now, port, socket)
+
+    def heartbeat(self, project_id: int, pipe=None) -> bool | None:
+        """Push the deadline of a live connection back.
+
+        :param project_id: int
+        :param pipe: redis pipeline to queue the update on instead
+        :return: whether the project has a live connection, None with `pipe`
+        """
+        alive = self._heartbeat(
+            keys=[self.deadlines_key],
+            args=[self.prefix, time.time(), self.timeout, project_id],
+            client=pipe,
+        )
+        return None if pipe is not None else bool(alive)
+
+    async def aheartbeat(self, project_id: int) -> bool:
+        script = get_async_redis().register_script(_HEARTBEAT)
+        alive = await script(
+            keys=[self.deadlines_key],
+            args=[self.prefix, time.time(), self.timeout, project_id],
+        )
+        return bool(alive)
+
+    def heartbeat_domains(self, domains: list[str]) -> list[bool]:
+        """Push the deadline of many connections back, and renew their ports.
+
+        Takes two round trips whatever the number of domains, and no query.
+
+        :param domains: list of strings
+        :return: list of bool, whether each domain has a live connection
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        now = time.time()
+        for domain in domains:
+            self._heartbeat_domain(
+                keys=[self.deadlines_key, self.domains_key],
+                args=[self.prefix, now, self.timeout, domain],
+                client=pipe,
+            )
+        connections = pipe.execute()
+
+        pipe = self.redis.pipeline(transaction=False)
+        for connection in connections:
+            if connection and connection[1]:
+                port_allocator.renew(
+                    int(connection[0]),
+                    int(connection[1]),
+                    timeout=self.timeout,
+                    pipe=pipe,
+                )
+        pipe.execute()
+        return [bool(connection) for connection in connections]
+
+    async def aheartbeat_domains(self, domains: list[str]) -> list[bool]:
+        client = get_async_redis()
+        script = client.register_script(_HEARTBEAT_DOMAIN)
+        pipe = client.pipeline(transaction=False)
+        now = time.time()
+        for domain in domains:
+            await script(
+                keys=[self.deadlines_key, self.domains_key],
+                args=[self.prefix, now, self.timeout, domain],
+                client=pipe,
+            )
+        connections = await pipe.execute()
+
+        pipe = client.pipeline(transaction=False)
+        for connection in connections:
+            if connection and connection[1]:
+                await port_allocator.arenew(
+                    int(connection[0]),
+                    int(connection[1]),
+                    timeout=self.timeout,
+                    pipe=pipe,
+                )
+        await pipe.execute()
+        return [bool(connection) for connection in connections]
+
+    def unregister(self, project_id: int, domain: str) -> None:
+        """Forget the connection of a project.
+
+        :param project_id: int
+        :param domain: string
+        :return: None
+        """
+        pipe = self.redis.pipeline()
+        self._queue_unregister(pipe, project_id, domain)
+        connection = pipe.execute()[0]
+        if connection:
+            pipe = self.redis.pipeline()
+            self._queue_disconnected(pipe, connection)
+            pipe.execute()
+
+    async def aunregister(self, project_id: int, domain: str) -> None:
+        client = get_async_redis()
+        pipe = client.pipeline()
+        self._queue_unregister(pipe, project_id, domain)
+        connection = (await pipe.execute())[0]
+        if connection:
+            pipe = client.pipeline()
+            self._queue_disconnected(pipe, connection)
+            await pipe.execute()
+
+    def _queue_unregister(self, pipe, project_id, domain) -> None:
+        # read first, for the history to know how long the connection lasted
+        pipe.hgetall(f"{self.prefix}{project_id}")
+        pipe.zrem(self.deadlines_key, project_id)
+        pipe.delete(f"{self.prefix}{project_id}")
+        pipe.hdel(self.domains_key, domain)
+        self.publish(domain, {"event": "disconnected"}, pipe=pipe)
+
+    def _queue_disconnected(self, pipe, fields) -> None:
+        connection_history.queue_end(
+            pipe,
+            "disconnected",
+            _decode(fields),
+            time.time(),
+        )
+
+    def reap(self, batch_size: int = 100) -> list[dict]:
+        """Remove a batch of connections whose deadline has passed.
+
+        Their ports are released at the same time, see `_REAP`.
+
+        :param batch_size: int
+        :return: list of the removed connections
+        """
+        expired = self._reap(
+            keys=[*port_allocator.keys, self.deadlines_key, self.domains_key],
+            args=[
+                port_allocator.start,
+                port_allocator.end,
+                time.time(),
+                self.prefix,
+                batch_size,
+            ],
+        )
+        expired = [_decode(fields) for fields in expired if fields]
+        if expired:
+            pipe = self.redis.pipeline(transaction=False)
+            for connection in expired:
+                self.publish(connection["domain"], {"event": "timed_out"}, pipe=pipe)
+                # the connection ended with its last heartbeat
+                connection_history.queue_end(
+                    pipe,
+                    "timed_out",
+                    connection,
+                    connection["last_heartbeat"],
+                )
+            pipe.execute()
+        return expired
+
+    def get(self, project_id: int) -> dict | None:
+        """Get the connection of a project.
+
+        :param project_id: int
+        :return: the connection, None if the project is not connected
+        """
+        fields = self.redis.hgetall(f"{self.prefix}{project_id}")
+        return _decode(fields) if fields else None
+
+    async def aget(self, project_id: int) -> dict | None:
+        fields = await get_async_redis().hgetall(f"{self.prefix}{project_id}")
+        return _decode(fields) if fields else None
+
+    def events_channel(self, domain: str) -> str:
+        """Get the pub/sub channel the events of a domain are published on.
+
+        :param domain: string
+        :return: string
+        """
+        return f"{self.events_prefix}{domain}"
+
+    def publish(self, domain: str, event: dict, pipe=None) -> None:
+        """Push an event to the clients listening on the domain.
+
+        :param domain: string
+        :param event: dict, with at least an "event" name
+        :param pipe: redis pipeline to queue the message on instead
+        :return: None
+        """
+        (pipe or self.redis).publish(self.events_channel(domain), json.dumps(event))
+
+    def online_ids(self) -> list[int]:
+        """Get the projects with a live connection.
+
+        :return: list of project ids
+        """
+        ids = self.redis.zrangebyscore(self.deadlines_key, time.time(), "+inf")
+        return [int(project_id) for project_id in ids]
+
+    def active(self) -> list[dict]:
+        """Get the live connections.
+
+        :return: list of connections, sorted by deadline
+        """
+        pipe = self.redis.pipeline()
+        for project_id in self.online_ids():
+            pipe.hgetall(f"{self.prefix}{project_id}")
+        return [_decode(fields) for fields in pipe.execute() if fields]
+
+    def count(self) -> int:
+        """Count the live connections.
+
+        :return: int
+        """
+        return self.redis.zcount(self.deadlines_key, time.time(), "+inf")
+
+    def connected_domains(self, domains: list[str]) -> set[str]:
+        """Get the domains with a connection, live or not reaped yet.
+
+        :param domains: list of strings
+        :return: set of strings
+        """
+        if not domains:
+            return set()
+        ids = self.redis.hmget(self.domains_key, domains)
+        return {
+            domain
+            for domain, project_id in zip(domains, ids, strict=True)
+            if project_id is not None
+        }
+
+    def is_online(self, project_id: int) -> bool:
+        """Check if a project has a live connection.
+
+        :param project_id: int
+        :return: bool
+        """
+        deadline = self.redis.zscore(self.deadlines_key, project_id)
+        return deadline is not None and deadline > time.time()
+
+    def online_among(self, project_ids: list[int]) -> set[int]:
+        """Get which of the projects have a live connection, in one command.
+
+        :param project_ids: list of int
+        :return: set of project ids
+        """
+        if not project_ids:
+            return set()
+        now = time.time()
+        deadlines = self.redis.zmscore(self.deadlines_key, project_ids)
+        return {
+            project_id
+            for project_id, deadline in zip(project_ids, deadlines, strict=True)
+            if deadline is not None and deadline > now
+        }
+
+
+connection_registry = ConnectionRegistry()
+
+
+def reap_expired_connections() -> int:
+    """Route the projects whose client stopped sending heartbeats offline.
+
+    :return: int, number of connections reaped
+    """
+    expired = connection_registry.reap()
+    if not expired:
+        return 0
+    domains = [connection["domain"] for connection in expired]
+    # a project registers before routing, one that connected again is left alone
+    connected = connection_registry.connected_domains(domains)
+    gen_default_nginx_confs([domain for domain in domains if domain not in connected])
+    for connection in expired:
+        logging.info("Project %s timed out", connection["domain"])
+    return len(expired)
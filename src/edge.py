@@ -0,0 +1,157 @@
+import functools
+import json
+import logging
+import subprocess
+import time
+import uuid
+from collections.abc import Callable
+
+from django_redis import get_redis_connection
+
+from src.env import EDGE_AGENT_ENABLED, EDGE_AGENT_WAIT_TIMEOUT, EDGE_RELOAD_WINDOW
+
+EDGE_QUEUE = "demos:edge:events"
+EDGE_APPLIED = "demos:edge:applied:{}"
+
+# task name -> (function, service to reload after it ran)
+_tasks: dict[str, tuple[Callable, str]] = {}
+
+
+def reload_service(service) -> None:
+    """Reload a system service.
+
+    :param service: string, e.g. "nginx" or "ssh"
+    :return: None
+    """
+    subprocess.run(  # noqa: S603
+        ["service", service, "reload"],  # noqa: S607
+        check=True,
+        capture_output=True,
+    )
+
+
+def edge_task(service) -> Callable:
+    """Register a function writing config files for `service`.
+
+    Calling the decorated function runs it and reloads the service. With the
+    edge agent enabled, the call is queued for the agent instead and returns
+    at once, unless `wait=True` is passed to block until it has been applied.
+
+    The function may return False to tell that nothing changed and the
+    reload can be skipped.
+
+    :param service: string
+    :return: decorator
+    """
+
+    def decorator(func) -> Callable:
+        _tasks[func.__name__] = (func, service)
+
+        @functools.wraps(func)
+        def wrapper(*args, wait=False, **kwargs) -> bool | None:
+            if EDGE_AGENT_ENABLED:
+                return submit(func.__name__, *args, wait=wait, **kwargs)
+            if func(*args, **kwargs) is not False:
+                reload_service(service)
+            return True
+
+        return wrapper
+
+    return decorator
+
+
+def submit(task, *args, wait=False, **kwargs) -> bool | None:
+    """Queue a task for the edge agent.
+
+    :param task: string, name of a registered task
+    :param wait: bool, block until the agent has applied the task
+    :return: whether the task was applied and its service reloaded in time,
+        or None when not waiting
+    """
+    redis = get_redis_connection("default")
+    event_id = uuid.uuid4().hex
+    redis.lpush(
+        EDGE_QUEUE,
+        json.dumps(
+            {
+                "id": event_id,
+                "task": task,
+                "args": args,
+                "kwargs": kwargs,
+                "reply": wait,
+            },
+        ),
+    )
+    if not wait:
+        return None
+    applied = redis.blpop(EDGE_APPLIED.format(event_id), EDGE_AGENT_WAIT_TIMEOUT)
+    return applied is not None and applied[1] == b"1"
+
+
+class EdgeAgent:
+    """Apply queued config changes and reload each service at most once a window."""
+
+    def __init__(self, window: float = EDGE_RELOAD_WINDOW) -> None:
+        self.window = window
+        self.redis = get_redis_connection("default")
+        self.last_reload = 0.0
+        self.dirty: set[str] = set()
+        # services whose last reload failed, until the waiters are told
+        self.failed: set[str] = set()
+        # event id -> service it reloads, "" for none, None if it failed to apply
+        self.pending: dict[str, str | None] = {}
+
+    def run(self) -> None:
+        while True:
+            self.run_once()
+
+    def run_once(self) -> None:
+        if self.dirty:
+            timeout = max(self.last_reload + self.window - time.monotonic(), 0.01)
+        else:
+            timeout = 5
+        item = self.redis.brpop(EDGE_QUEUE, timeout=timeout)
+        if item is not None:
+            self.apply(json.loads(item[1]))
+            # drain the backlog, bounded so a flood of events can't hold off reloads
+            for raw in self.redis.rpop(EDGE_QUEUE, 1000) or ():
+                self.apply(json.loads(raw))
+
+        if self.dirty and time.monotonic() >= self.last_reload + self.window:
+            for service in sorted(self.dirty):
+                try:
+                    reload_service(service)
+                except subprocess.CalledProcessError:
+                    logging.exception("Failed to reload %s", service)
+                    self.failed.add(service)
+            self.last_reload = time.monotonic()
+            self.dirty.clear()
+        if not self.dirty:
+            self.acknowledge()
+
+    def apply(self, event) -> None:
+        reloads = None
+        try:
+            func, service = _tasks[event["task"]]
+            changed = func(*event["args"], **event["kwargs"])
+        except Exception:
+            logging.exception("Failed to apply edge event %s", event)
+        else:
+            reloads = ""
+            if changed is not False:
+                self.dirty.add(service)
+                reloads = service
+        if event.get("reply"):
+            self.pending[event["id"]] = reloads
+
+    def acknowledge(self) -> None:
+        """Tell the waiters whether their events were applied, 1 or 0."""
+        if self.pending:
+            pipe = self.redis.pipeline()
+            for event_id, reloads in self.pending.items():
+                key = EDGE_APPLIED.format(event_id)
+                pipe.rpush(key, int(reloads is not None and reloads not in self.failed))
+                pipe.expire(key, EDGE_AGENT_WAIT_TIMEOUT)
+            pipe.execute()
+            self.pending.clear()
+        self.failed.clear()
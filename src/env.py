@@ -128,15 +128,88 @@ KEEP_ALIVE_TIMEOUT = get_int_env("KEEP_ALIVE_TIMEOUT", 300)
 CLOUDFLARE_SITE_KEY = get_env("CLOUDFLARE_SITE_KEY")
 CLOUDFLARE_SECRET_KEY = get_env("CLOUDFLARE_SECRET_KEY")
 CLOUDFLARE_API_URL = get_env("CLOUDFLARE_API_URL")
+TUNNEL_PORT_RANGE_START = get_int_env("TUNNEL_PORT_RANGE_START", 20000)
+TUNNEL_PORT_RANGE_END = get_int_env("TUNNEL_PORT_RANGE_END", 30000)
+PORT_LEASE_TIMEOUT = get_int_env("PORT_LEASE_TIMEOUT", 30)
+STICKY_PORTS = get_bool_env("STICKY_PORTS", default=False)
+STICKY_PORT_TTL = get_int_env("STICKY_PORT_TTL", 24 * 60 * 60)
+TUNNEL_SOCKET_DIR = get_env("TUNNEL_SOCKET_DIR", "/run/demos/tunnels")
+NGINX_ROUTING_MODE = get_env("NGINX_ROUTING_MODE", "server")
+NGINX_ROUTES_FILE = get_env("NGINX_ROUTES_FILE", "/etc/nginx/demos/routes.map")
+TUNNEL_PROXY_PORT = get_int_env("TUNNEL_PROXY_PORT", 8100)
+TUNNEL_UPSTREAM_KEEPALIVE = get_int_env("TUNNEL_UPSTREAM_KEEPALIVE", 16)
+KEY_POOL_SIZE = get_int_env("KEY_POOL_SIZE", 20)
+KEY_TYPE = get_env("KEY_TYPE", "rsa")
+SSH_KEY_STORE = get_env("SSH_KEY_STORE", "redis")
+SSH_KEY_TTL = get_int_env("SSH_KEY_TTL", 60)
+SSH_CA_KEY_PATH = get_env("SSH_CA_KEY_PATH", "/etc/ssh/demos_ca")
+TUNNEL_SHARED_ACCOUNT = get_env("TUNNEL_SHARED_ACCOUNT", "")
+REDIS_HOST = get_env("REDIS_HOST", "localhost")
+REDIS_PORT = get_env("REDIS_PORT", "6379")
+REDIS_DB = get_env("REDIS_DB", "0")
+PROXY_CACHE_DIR = get_env("PROXY_CACHE_DIR", "/var/cache/nginx/demos")
+PROXY_CACHE_MAX_SIZE = get_env("PROXY_CACHE_MAX_SIZE", "256m")
+PROBE_INTERVAL = get_int_env("PROBE_INTERVAL", 10)
+PROBE_TIMEOUT = get_int_env("PROBE_TIMEOUT", 2)
+PROBE_CONCURRENCY = get_int_env("PROBE_CONCURRENCY", 500)
+PROBE_FAILURES = get_int_env("PROBE_FAILURES", 3)
+TUNNEL_API_ASYNC = get_bool_env("TUNNEL_API_ASYNC", default=False)
+CONNECTION_FLUSH_INTERVAL = get_int_env("CONNECTION_FLUSH_INTERVAL", 10)
+LOG_QUEUE = get_bool_env("LOG_QUEUE", default=False)
+LOG_MAX_BYTES = get_int_env("LOG_MAX_BYTES", 50 * 1000 * 1000)
+LOG_SAMPLE_EVERY = get_int_env("LOG_SAMPLE_EVERY", 1)
+if LOG_SAMPLE_EVERY < 1:
+    raise ValueError(f"Invalid value for LOG_SAMPLE_EVERY: {LOG_SAMPLE_EVERY}")
+LOG_SAMPLED_URL_NAMES = get_list_env(
+    "LOG_SAMPLED_URL_NAMES",
+    default=("keep_alive", "keep_alive_batch"),
+)
+EDGE_AGENT_ENABLED = get_bool_env("EDGE_AGENT_ENABLED", default=False)
+EDGE_RELOAD_WINDOW = get_int_env("EDGE_RELOAD_WINDOW", 2)
+EDGE_AGENT_WAIT_TIMEOUT = get_int_env("EDGE_AGENT_WAIT_TIMEOUT", 10)
 
 
 __all__ = [
     "CLOUDFLARE_API_URL",
     "CLOUDFLARE_SECRET_KEY",
     "CLOUDFLARE_SITE_KEY",
+    "CONNECTION_FLUSH_INTERVAL",
+    "EDGE_AGENT_ENABLED",
+    "EDGE_AGENT_WAIT_TIMEOUT",
+    "EDGE_RELOAD_WINDOW",
     "HTTP_HOST",
     "KEEP_ALIVE_TIMEOUT",
+    "KEY_POOL_SIZE",
+    "KEY_TYPE",
+    "LOG_MAX_BYTES",
+    "LOG_QUEUE",
+    "LOG_SAMPLED_URL_NAMES",
+    "LOG_SAMPLE_EVERY",
+    "NGINX_ROUTES_FILE",
+    "NGINX_ROUTING_MODE",
+    "PORT_LEASE_TIMEOUT",
+    "PROBE_CONCURRENCY",
+    "PROBE_FAILURES",
+    "PROBE_INTERVAL",
+    "PROBE_TIMEOUT",
+    "PROXY_CACHE_DIR",
+    "PROXY_CACHE_MAX_SIZE",
+    "REDIS_DB",
+    "REDIS_HOST",
+    "REDIS_PORT",
     "SECRET_KEY",
+    "SSH_CA_KEY_PATH",
+    "SSH_KEY_STORE",
+    "SSH_KEY_TTL",
+    "STICKY_PORTS",
+    "STICKY_PORT_TTL",
+    "TUNNEL_API_ASYNC",
+    "TUNNEL_PORT_RANGE_END",
+    "TUNNEL_PORT_RANGE_START",
+    "TUNNEL_PROXY_PORT",
+    "TUNNEL_SHARED_ACCOUNT",
+    "TUNNEL_SOCKET_DIR",
+    "TUNNEL_UPSTREAM_KEEPALIVE",
     "EnvNotSetError",
     "get_bool_env",
     "get_env",
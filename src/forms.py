@@ -17,7 +17,7 @@ from src.widgets import UserSelect
 class ProjectForm(forms.ModelForm):
     class Meta:
         model = Project
-        fields = ["domain"]
+        fields = ["domain", "cache_enabled"]
         error_messages = {
             "domain": {
                 "unique": _("This domain is already in use."),
@@ -49,7 +49,7 @@ class ProjectFormSuperUser(ProjectForm):
 
     class Meta:
         model = Project
-        fields = ["domain", "user"]
+        fields = ["domain", "user", "cache_enabled"]
         error_messages = {
             "domain": {
                 "unique": _("This domain is already in use."),
@@ -1,24 +1,51 @@
+import gzip
+import logging
 import re
 import secrets
-import socket
+import shutil
 import subprocess
 from pathlib import Path
 
-import jinja2
 import requests
-import rsa
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.utils.translation import gettext_lazy as _
+from django_redis import get_redis_connection
 
+from src.authorized_keys import add_authorized_key, revoke_authorized_keys
+from src.edge import edge_task
 from src.env import (
     CLOUDFLARE_API_URL,
     CLOUDFLARE_SECRET_KEY,
     CLOUDFLARE_SITE_KEY,
     HTTP_HOST,
+    NGINX_ROUTES_FILE,
+    NGINX_ROUTING_MODE,
+    PROXY_CACHE_DIR,
+    PROXY_CACHE_MAX_SIZE,
+    SSH_KEY_STORE,
+    SSH_KEY_TTL,
+    TUNNEL_PROXY_PORT,
+    TUNNEL_SHARED_ACCOUNT,
+    TUNNEL_SOCKET_DIR,
+    TUNNEL_UPSTREAM_KEEPALIVE,
 )
+from src.keys import generate_key_pair, key_pool, sign_public_key
+from src.ports import port_allocator
+from src.render import get_template, render_to_file, write_file
+from src.routes import (
+    OFFLINE,
+    format_upstream,
+    remove_route,
+    route_map,
+    set_route,
+)
+from src.scheduler import scheduled_task, scheduler
+
+OFFLINE_PAGE = "/var/www/demos/502/index.html"
+# members get the forwarding-only rules of the `Match Group` block in sshd_config
+TUNNEL_GROUP = "tunnel"
 
 
 def domain_validator(domain) -> str:
@@ -61,113 +88,307 @@ def gen_secret_key() -> str:
 
 
 def get_available_port(project_id: int) -> int | None:
-    """Generate a port number that is not in use on the host.
+    """Lease a port that is not in use on the host to the project.
 
     :return: int
     """
-    for port in range(20000, 30001):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        result = sock.connect_ex(("127.0.0.1", port))
-        sock.close()
-        if result != 0 and not cache.get(port):
-            cache.set(port, project_id, 30)  # 30 seconds
-            return port
+    return port_allocator.acquire(project_id)
+
+
+def get_tunnel_socket_path(username, domain) -> Path:
+    """Get the unix socket a project's tunnel is forwarded to.
+
+    :param username: string
+    :param domain: string
+    :return: Path
+    """
+    return Path(TUNNEL_SOCKET_DIR) / username / f"{domain}.sock"
+
 
-    return None
+def create_tunnel_socket_dir(username) -> None:
+    """Create the directory the user's sshd session binds tunnel sockets in.
+
+    :param username: string
+    :return: None
+    """
+    socket_dir = Path(TUNNEL_SOCKET_DIR) / username
+    if socket_dir.is_dir():
+        return
+    socket_dir.mkdir(parents=True, exist_ok=True)
+    socket_dir.chmod(0o700)
+    subprocess.run(  # noqa: S603
+        ["chown", f"{username}:{username}", str(socket_dir)],  # noqa: S607
+        check=True,
+    )
 
 
-def gen_nginx_conf(domain, port=None) -> None:
-    """Generate nginx config file.
+def gen_nginx_conf(
+    domain,
+    port=None,
+    socket=None,
+    *,
+    cache=False,
+    wait=False,
+) -> bool | None:
+    """Route the domain to its tunnel, or to the offline page without one.
 
     :param domain: string
     :param port: int
+    :param socket: string, unix socket path used instead of the port
+    :param cache: bool, cache responses at the edge, only in "server" mode
+    :param wait: bool, block until the edge agent has applied the change
     """
-    with Path("src/templates/nginx.conf-tpl").open() as f:
-        tpl_str = f.read()
-    tpl = jinja2.Template(tpl_str)
-    conf_str = tpl.render(domain=domain, port=port)
-    with Path(f"/etc/nginx/sites/{domain}.conf").open("w") as f:
-        f.write(conf_str)
-    subprocess.run(["service", "nginx", "reload"], check=True)  # noqa: S607
+    if NGINX_ROUTING_MODE == "map":
+        set_route(domain, port, socket)
+        return update_nginx_routes({domain: format_upstream(port, socket)}, wait=wait)
+    if NGINX_ROUTING_MODE == "proxy":
+        # the tunnel proxy picks the change up through pub/sub
+        set_route(domain, port, socket)
+        return True
+    return gen_nginx_server_conf(domain, port, socket, cache, wait=wait)
 
 
 def remove_nginx_conf(domain) -> None:
-    """Remove the nginx config file.
+    """Stop routing the domain.
 
     :param domain: string
     """
-    try:
-        Path(f"/etc/nginx/sites/{domain}.conf").unlink()
-    except FileNotFoundError:
-        pass
+    if NGINX_ROUTING_MODE == "map":
+        remove_route(domain)
+        update_nginx_routes({domain: None})
+    elif NGINX_ROUTING_MODE == "proxy":
+        remove_route(domain)
     else:
-        subprocess.run(["service", "nginx", "reload"], check=True)  # noqa: S607
+        remove_nginx_server_conf(domain)
 
 
-def gen_default_nginx_conf(domain) -> None:
-    """Generate a default page.
+def get_upstream_name(domain) -> str:
+    """Get the name of the nginx upstream block pooling a domain's tunnel.
 
     :param domain: string
+    :return: string
     """
-    gen_nginx_conf(domain=domain, port=None)
+    return "tunnel_" + re.sub(r"[^a-z0-9]", "_", domain)
 
 
-def gen_502_page(domain) -> None:
-    """Generate a 502 error page.
+def get_proxy_cache_dir(domain) -> Path:
+    """Get the directory nginx caches a domain's responses in.
 
     :param domain: string
+    :return: Path
     """
-    with Path("src/templates/502.html-tpl").open() as f:
-        tpl_str = f.read()
-    tpl = jinja2.Template(tpl_str)
-    conf_str = tpl.render(domain=domain, HOST=HTTP_HOST)
-    Path("/var/www/demos/502").mkdir(parents=True, exist_ok=True)
-    with Path(f"/var/www/demos/502/{domain}.html").open("w") as f:
-        f.write(conf_str)
+    return Path(PROXY_CACHE_DIR) / domain
 
-    subprocess.run(["service", "nginx", "reload"], check=True)  # noqa: S607
 
+@edge_task("nginx")
+def gen_nginx_server_conf(domain, port=None, socket=None, cache=False) -> bool:  # noqa: FBT002
+    """Generate the nginx server block of a domain.
 
-def remove_502_page(domain) -> None:
-    """Remove the 502 error page.
+    :param domain: string
+    :param port: int
+    :param socket: string, unix socket path used instead of the port
+    :param cache: bool, cache responses allowed by their Cache-Control header
+    """
+    cache_dir = get_proxy_cache_dir(domain)
+    if cache:
+        # nginx only creates the last directory of proxy_cache_path
+        cache_dir.parent.mkdir(parents=True, exist_ok=True)
+    # a client reconnecting on the same port needs neither a rewrite nor a reload
+    return render_to_file(
+        "nginx.conf-tpl",
+        f"/etc/nginx/sites/{domain}.conf",
+        domain=domain,
+        port=port,
+        socket=socket,
+        upstream=get_upstream_name(domain),
+        keepalive=TUNNEL_UPSTREAM_KEEPALIVE,
+        cache=cache,
+        cache_dir=cache_dir,
+        cache_max_size=PROXY_CACHE_MAX_SIZE,
+    )
+
+
+@edge_task("nginx")
+def remove_nginx_server_conf(domain) -> bool:
+    """Remove the nginx server block of a domain.
 
     :param domain: string
     """
+    shutil.rmtree(get_proxy_cache_dir(domain), ignore_errors=True)
     try:
-        Path(f"/var/www/demos/502/{domain}.html").unlink()
-        subprocess.run(["service", "nginx", "reload"], check=True)  # noqa: S607
+        Path(f"/etc/nginx/sites/{domain}.conf").unlink()
     except FileNotFoundError:
-        pass
+        return False
+    return True
 
 
-def gen_key_pair(username) -> tuple:
-    """Generate a key pair.
+@edge_task("nginx")
+def purge_proxy_cache(domain) -> bool:
+    """Delete every response cached for a domain.
 
-    :param username: string
-    :return: tuple(public_key_path: string, private_key_path: string)
+    nginx treats the entries it still indexes as misses, so no reload is needed.
+
+    :param domain: string
+    :return: bool
     """
-    DIR = Path(f"/home/{username}/.ssh")  # noqa: N806
+    cache_dir = get_proxy_cache_dir(domain)
+    if cache_dir.is_dir():
+        # keep the directory itself, nginx created it for its worker user
+        for path in cache_dir.iterdir():
+            if path.is_dir():
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                path.unlink(missing_ok=True)
+    return False
 
-    _, private_key = rsa.newkeys(2048)
-    private_key_path = DIR / "private_key.pem"
-    with private_key_path.open("wb") as f:
-        f.write(private_key.save_pkcs1())
-    private_key_path.chmod(0o600)
-    public_key_path = DIR / "authorized_keys"
-    subprocess.run(  # noqa: S603
-        ["ssh-keygen", "-y", "-f", str(private_key_path)],  # noqa: S607
-        stdout=public_key_path.open("w"),
-        check=True,
+
+@edge_task("nginx")
+def gen_nginx_routing_conf() -> bool:
+    """Generate the wildcard server routing every domain.
+
+    It looks domains up in the route map, or hands them to the tunnel proxy.
+
+    :return: bool
+    """
+    return render_to_file(
+        f"nginx.{NGINX_ROUTING_MODE}.conf-tpl",
+        "/etc/nginx/sites/demos.conf",
+        HOST=HTTP_HOST,
+        routes_file=NGINX_ROUTES_FILE,
+        proxy_port=TUNNEL_PROXY_PORT,
     )
+
+
+@edge_task("nginx")
+def gen_nginx_routes() -> bool:
+    """Write the route map from the routes stored in Redis.
+
+    :return: bool
+    """
+    return route_map.rebuild()
+
+
+@edge_task("nginx")
+def update_nginx_routes(routes) -> bool:
+    """Change the routes of some domains in the route map, see `RouteMap`.
+
+    :param routes: dict(domain: upstream, or None to remove the domain)
+    :return: bool
+    """
+    return route_map.update(routes)
+
+
+def gen_default_nginx_conf(domain, *, wait=False) -> bool | None:
+    """Generate a default page.
+
+    :param domain: string
+    """
+    return gen_nginx_conf(domain=domain, port=None, socket=None, wait=wait)
+
+
+def gen_default_nginx_confs(domains) -> None:
+    """Route many domains to the offline page, reloading nginx at most once.
+
+    :param domains: list of strings
+    :return: None
+    """
+    if NGINX_ROUTING_MODE in ("map", "proxy"):
+        for domain in domains:
+            set_route(domain)
+        if NGINX_ROUTING_MODE == "map":
+            update_nginx_routes(dict.fromkeys(domains, OFFLINE))
+    else:
+        gen_nginx_server_confs(domains)
+
+
+@edge_task("nginx")
+def gen_nginx_server_confs(domains) -> bool:
+    """Generate the offline nginx server block of many domains.
+
+    :param domains: list of strings
+    :return: bool
+    """
+    changed = False
+    for domain in domains:
+        changed = gen_nginx_server_conf.__wrapped__(domain) or changed
+    return changed
+
+
+@edge_task("nginx")
+def gen_offline_page() -> bool:
+    """Generate the 502 error page shared by every domain, and its gzip copy.
+
+    The page fills in the domain from the address bar when it is displayed.
+    """
+    page = get_template("502.html-tpl").render(HOST=HTTP_HOST).encode()
+    write_file(OFFLINE_PAGE, page)
+    write_file(f"{OFFLINE_PAGE}.gz", gzip.compress(page, mtime=0))
+    # remove the pages rendered per domain by older versions
+    for legacy_page in Path(OFFLINE_PAGE).parent.glob("*.html"):
+        if str(legacy_page) != OFFLINE_PAGE:
+            legacy_page.unlink(missing_ok=True)
+    # nginx reads the page from disk on every request, there is nothing to reload
+    return False
+
+
+def get_tunnel_user(username) -> str:
+    """Get the system account a user's tunnels log in as.
+
+    :param username: string
+    :return: string
+    """
+    return TUNNEL_SHARED_ACCOUNT or username
+
+
+def gen_key_pair(username, permit_listen=None) -> bytes:
+    """Issue a key pair to the user, taken from the key pool when possible.
+
+    Only the public key is stored, the private key is returned. With the
+    "redis" key store the public key expires on its own after `SSH_KEY_TTL`.
+
+    :param username: string
+    :param permit_listen: int, the only port the key may forward, which makes
+        it safe to share the account; always stored in Redis
+    :return: bytes, private key
+    """
+    key_pair = key_pool.claim()
+    if key_pair is None:
+        logging.warning("Key pool is empty, generating a key pair inline")
+        key_pair = generate_key_pair()
+    private_key, public_key = key_pair
+    if permit_listen:
+        public_key = (
+            f'restrict,port-forwarding,permitlisten="localhost:{permit_listen}" '
+            f"{public_key}"
+        )
+    if permit_listen or SSH_KEY_STORE == "redis":
+        add_authorized_key(
+            get_redis_connection("default"),
+            username,
+            public_key,
+            SSH_KEY_TTL,
+        )
+    else:
+        install_public_key(username, public_key)
+    return private_key
+
+
+def install_public_key(username, public_key) -> None:
+    """Make the public key the only one authorized to log in as the user.
+
+    :param username: string
+    :param public_key: string
+    :return: None
+    """
+    public_key_path = Path(f"/home/{username}/.ssh/authorized_keys")
+    write_file(public_key_path, f"{public_key}\n", mode=0o600)
     subprocess.run(  # noqa: S603
         ["chown", f"{username}:{username}", str(public_key_path)],  # noqa: S607
         check=True,
     )
-    public_key_path.chmod(0o600)
-
-    return public_key_path, private_key_path
 
 
+@scheduled_task
 def remove_key_pair(username) -> None:
     """Remove the key pair.
 
@@ -179,17 +400,58 @@ def remove_key_pair(username) -> None:
     Path(DIR / "private_key.pem").unlink(missing_ok=True)
 
 
+def issue_key_pair(username, port=None) -> bytes:
+    """Issue a key pair for a tunnel of the user.
+
+    With a shared account the key may only forward `port`. With the "file"
+    key store the key is removed after `SSH_KEY_TTL`.
+
+    :param username: string
+    :param port: int, the port leased to the tunnel, required with a shared
+        account
+    :return: bytes, private key
+    """
+    if TUNNEL_SHARED_ACCOUNT:
+        return gen_key_pair(TUNNEL_SHARED_ACCOUNT, permit_listen=port)
+    private_key = gen_key_pair(username)
+    if SSH_KEY_STORE == "file":
+        scheduler.schedule(
+            remove_key_pair,
+            SSH_KEY_TTL,
+            username,
+            job_id=f"remove_key_pair:{username}",
+        )
+    return private_key
+
+
+def issue_certificate(username, public_key=None) -> dict:
+    """Sign a short-lived SSH certificate logging in as the user.
+
+    :param username: string
+    :param public_key: string, defaults to a key pair issued along
+    :return: dict(certificate, private_key if a key pair was issued)
+    :raises InvalidPublicKeyError: if the public key is not valid
+    """
+    data = {}
+    if not public_key:
+        private_key, public_key = key_pool.claim() or generate_key_pair()
+        data["private_key"] = private_key.decode()
+    data["certificate"] = sign_public_key(public_key, username, SSH_KEY_TTL)
+    return data
+
+
 def create_user_profile(username) -> None:
     """Create a user without password and creates a .ssh directory.
 
     :param username: string
     :return: None
     """
-    if username in settings.USERNAME_EXCLUDE_LIST:
+    # tunnels of every user log in as the shared account
+    if username in settings.USERNAME_EXCLUDE_LIST or TUNNEL_SHARED_ACCOUNT:
         return
 
     subprocess.run(  # noqa: S603
-        ["useradd", "-m", "-p", "!", username],  # noqa: S607
+        ["useradd", "-m", "-p", "!", "-G", TUNNEL_GROUP, username],  # noqa: S607
         check=True,
         capture_output=True,
     )
@@ -200,62 +462,80 @@ def create_user_profile(username) -> None:
         ["chown", f"{username}:{username}", str(ssh_dir)],  # noqa: S607
         check=True,
     )
-    gen_sshd_conf(username)
+    create_tunnel_socket_dir(username)
 
 
-def delete_user_profile(username) -> None:
-    """Delete a user and remove the .ssh directory.
+def create_shared_account() -> None:
+    """Create the account every tunnel logs in as in shared account mode.
+
+    It has no home directory and no login shell.
 
-    :param username: string
     :return: None
     """
-    if username in settings.USERNAME_EXCLUDE_LIST:
+    exists = subprocess.run(  # noqa: S603
+        ["id", TUNNEL_SHARED_ACCOUNT],  # noqa: S607
+        check=False,
+        capture_output=True,
+    )
+    if exists.returncode == 0:
         return
-
-    subprocess.run(["userdel", "-r", username], check=True, capture_output=True)  # noqa: S603, S607
-    remove_sshd_conf(username)
+    subprocess.run(  # noqa: S603
+        [  # noqa: S607
+            "useradd",
+            "--system",
+            "-M",
+            "-s",
+            "/usr/sbin/nologin",
+            "-p",
+            "!",
+            "-G",
+            TUNNEL_GROUP,
+            TUNNEL_SHARED_ACCOUNT,
+        ],
+        check=True,
+        capture_output=True,
+    )
 
 
-def gen_sshd_conf(username) -> None:
-    """Generate sshd config file.
+def create_tunnel_group() -> None:
+    """Create the group of the tunnel users if it does not exist.
 
-    :param username: string
     :return: None
     """
-    with Path("src/templates/sshd.user.conf-tpl").open() as f:
-        tpl_str = f.read()
-    tpl = jinja2.Template(tpl_str)
-    conf_str = tpl.render(username=username)
-    CONF_FILE = Path(f"/etc/ssh/sshd_config.d/user.d/{username}.conf")  # noqa: N806
-    CONF_FILE.parent.mkdir(parents=True, exist_ok=True)
-    with CONF_FILE.open("w") as f:
-        f.write(conf_str)
-    CONF_FILE.chmod(0o600)
     subprocess.run(  # noqa: S603
-        ["chown", "root:root", str(CONF_FILE)],  # noqa: S607
-        check=True,
-    )
-    subprocess.run(
-        ["service", "ssh", "reload"],  # noqa: S607
+        ["groupadd", "-f", TUNNEL_GROUP],  # noqa: S607
         check=True,
         capture_output=True,
     )
 
 
-def remove_sshd_conf(username) -> None:
-    """Remove the sshd config file.
+def add_user_to_tunnel_group(username) -> None:
+    """Add an existing user to the group of the tunnel users.
 
     :param username: string
     :return: None
     """
-    Path(f"/etc/ssh/sshd_config.d/user.d/{username}.conf").unlink(missing_ok=True)
-    subprocess.run(
-        ["service", "ssh", "reload"],  # noqa: S607
+    subprocess.run(  # noqa: S603
+        ["usermod", "-aG", TUNNEL_GROUP, username],  # noqa: S607
         check=True,
         capture_output=True,
     )
 
 
+def delete_user_profile(username) -> None:
+    """Delete a user and remove the .ssh directory.
+
+    :param username: string
+    :return: None
+    """
+    if username in settings.USERNAME_EXCLUDE_LIST or TUNNEL_SHARED_ACCOUNT:
+        return
+
+    subprocess.run(["userdel", "-r", username], check=True, capture_output=True)  # noqa: S603, S607
+    shutil.rmtree(Path(TUNNEL_SOCKET_DIR) / username, ignore_errors=True)
+    revoke_authorized_keys(get_redis_connection("default"), username)
+
+
 def username_validator(username) -> str:
     """Validate username string.
 
@@ -0,0 +1,248 @@
+import json
+import logging
+import time
+from datetime import UTC, datetime, timedelta
+from functools import cached_property
+
+from django.db import transaction
+from django.db.models import F
+from django_redis import get_redis_connection
+
+from src.env import CONNECTION_FLUSH_INTERVAL
+
+
+def _to_datetime(timestamp: float) -> datetime:
+    return datetime.fromtimestamp(timestamp, tz=UTC)
+
+
+class ConnectionHistory:
+    """Connection stats and events, buffered in Redis and written in batches.
+
+    Connecting a tunnel records its time and bumps its counter in two hashes
+    (project id -> last connected_at, project id -> new connections), and each
+    connect, disconnect or timeout appends an event to a list. The registry
+    queues these on the pipeline it already sends, so the tunnel API does no
+    database write. `flush` drains the buffers and writes them with one bulk
+    update and one bulk insert.
+    """
+
+    def __init__(
+        self,
+        namespace: str = "demos:history",
+        interval: int = CONNECTION_FLUSH_INTERVAL,
+        batch_size: int = 1000,
+    ) -> None:
+        self.interval = interval
+        self.batch_size = batch_size
+        self.last_connected_key = f"{namespace}:last_connected"
+        self.counts_key = f"{namespace}:counts"
+        self.events_key = f"{namespace}:events"
+        self.flushed_at = 0.0
+        self.backlog = False
+
+    @cached_property
+    def redis(self):
+        return get_redis_connection("default")
+
+    def queue_connect(
+        self,
+        pipe,
+        project_id: int,
+        connected_at: float,
+        port: int | None = None,
+        socket: str | None = None,
+    ) -> None:
+        """Record a new connection on a pipeline.
+
+        :param pipe: redis pipeline, sync or asyncio
+        :param project_id: int
+        :param connected_at: float, timestamp
+        :param port: int
+        :param socket: string
+        :return: None
+        """
+        pipe.hset(self.last_connected_key, project_id, connected_at)
+        pipe.hincrby(self.counts_key, project_id, 1)
+        self._queue_event(pipe, project_id, "connected", connected_at, port, socket)
+
+    def queue_end(self, pipe, event: str, connection: dict, ended_at: float) -> None:
+        """Record the end of a connection on a pipeline.
+
+        :param pipe: redis pipeline, sync or asyncio
+        :param event: string, "disconnected" or "timed_out"
+        :param connection: dict, as listed by the connection registry
+        :param ended_at: float, timestamp
+        :return: None
+        """
+        self._queue_event(
+            pipe,
+            connection["project_id"],
+            event,
+            ended_at,
+            connection["port"],
+            connection["socket"],
+            duration=ended_at - connection["connected_at"],
+        )
+
+    def _queue_event(
+        self,
+        pipe,
+        project_id,
+        event,
+        at,
+        port,
+        socket,
+        duration=None,
+    ) -> None:
+        pipe.rpush(
+            self.events_key,
+            json.dumps(
+                {
+                    "project_id": project_id,
+                    "event": event,
+                    "at": at,
+                    "port": port,
+                    "socket": socket,
+                    "duration": duration,
+                },
+            ),
+        )
+
+    def drain(self) -> tuple[dict[int, float], dict[int, int], list[dict]]:
+        """Take the buffered stats and a batch of events out of Redis, atomically.
+
+        :return: tuple(last connected_at and new connections by project id,
+            events)
+        """
+        pipe = self.redis.pipeline()
+        pipe.hgetall(self.last_connected_key)
+        pipe.hgetall(self.counts_key)
+        pipe.delete(self.last_connected_key, self.counts_key)
+        pipe.lrange(self.events_key, 0, self.batch_size - 1)
+        pipe.ltrim(self.events_key, self.batch_size, -1)
+        last_connected, counts, _, events, _ = pipe.execute()
+        return (
+            {int(k): float(v) for k, v in last_connected.items()},
+            {int(k): int(v) for k, v in counts.items()},
+            [json.loads(event) for event in events],
+        )
+
+    def restore(
+        self,
+        last_connected: dict[int, float],
+        counts: dict[int, int],
+        events: list[dict],
+    ) -> None:
+        """Put drained data back, for the next flush to write it.
+
+        :param last_connected: dict, project id -> timestamp
+        :param counts: dict, project id -> new connections
+        :param events: list of dicts
+        :return: None
+        """
+        pipe = self.redis.pipeline()
+        for project_id, connected_at in last_connected.items():
+            # a connection recorded since the drain is the latest one
+            pipe.hsetnx(self.last_connected_key, project_id, connected_at)
+        for project_id, count in counts.items():
+            pipe.hincrby(self.counts_key, project_id, count)
+        if events:
+            pipe.lpush(self.events_key, *(json.dumps(e) for e in reversed(events)))
+        pipe.execute()
+
+    def flush(self) -> int:
+        """Write the buffered stats and a batch of events to the database.
+
+        Data of deleted projects is dropped. If the write fails, the data goes
+        back to Redis.
+
+        :return: int, number of projects updated and events written
+        """
+        last_connected, counts, events = self.drain()
+        self.backlog = len(events) == self.batch_size
+        if not (last_connected or counts or events):
+            return 0
+        try:
+            return self.write(last_connected, counts, events)
+        except Exception:
+            self.restore(last_connected, counts, events)
+            raise
+
+    def write(
+        self,
+        last_connected: dict[int, float],
+        counts: dict[int, int],
+        events: list[dict],
+    ) -> int:
+        """Write drained data to the database, in one transaction.
+
+        :param last_connected: dict, project id -> timestamp
+        :param counts: dict, project id -> new connections
+        :param events: list of dicts
+        :return: int, number of projects updated and events written
+        """
+        # the models import the registry, which records here
+        from src.models import ConnectionEvent, Project  # noqa: PLC0415
+
+        ids = {*last_connected, *counts, *(e["project_id"] for e in events)}
+        existing = set(
+            Project.objects.filter(id__in=ids).values_list("id", flat=True),
+        )
+        projects = []
+        for project_id in existing & {*last_connected, *counts}:
+            project = Project.from_db(None, ["id"], [project_id])
+            project.last_connected_at = (
+                _to_datetime(last_connected[project_id])
+                if project_id in last_connected
+                else F("last_connected_at")
+            )
+            project.connection_count = F("connection_count") + counts.get(
+                project_id,
+                0,
+            )
+            projects.append(project)
+        connection_events = [
+            ConnectionEvent(
+                project_id=event["project_id"],
+                event=event["event"],
+                occurred_at=_to_datetime(event["at"]),
+                port=event["port"],
+                socket=event["socket"] or "",
+                duration=(
+                    None
+                    if event["duration"] is None
+                    else timedelta(seconds=event["duration"])
+                ),
+            )
+            for event in events
+            if event["project_id"] in existing
+        ]
+        with transaction.atomic():
+            Project.objects.bulk_update(
+                projects,
+                ["last_connected_at", "connection_count"],
+                batch_size=500,
+            )
+            ConnectionEvent.objects.bulk_create(connection_events, batch_size=500)
+        return len(projects) + len(connection_events)
+
+
+connection_history = ConnectionHistory()
+
+
+def flush_connection_history() -> int:
+    """Write the buffered connection stats and history, every `interval`.
+
+    A full batch of events is followed by the next one right away, until the
+    backlog is drained.
+
+    :return: int, number of projects updated and events written
+    """
+    if time.monotonic() - connection_history.flushed_at < connection_history.interval:
+        return 0
+    written = connection_history.flush()
+    if not connection_history.backlog:
+        connection_history.flushed_at = time.monotonic()
+    if written:
+        logging.debug("Flushed %d connection stats and events", written)
+    return written
@@ -0,0 +1,194 @@
+import json
+import subprocess
+import tempfile
+import time
+from functools import cached_property
+from pathlib import Path
+
+from django_redis import get_redis_connection
+
+from src.env import KEY_POOL_SIZE, KEY_TYPE, SSH_CA_KEY_PATH
+
+
+class InvalidPublicKeyError(ValueError):
+    """Raised when a client sends a public key that cannot be signed."""
+
+
+def generate_key_pair(key_type: str = KEY_TYPE) -> tuple[bytes, str]:
+    """Generate an SSH key pair without a passphrase.
+
+    RSA keys are written in the PEM format, as the clients always got them.
+
+    :param key_type: string, "rsa" or "ed25519"
+    :return: tuple(private_key: bytes, public_key: string)
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir) / "key"
+        args = ["-t", "rsa", "-b", "2048", "-m", "PEM"]
+        if key_type == "ed25519":
+            args = ["-t", "ed25519"]
+        subprocess.run(  # noqa: S603
+            ["ssh-keygen", "-q", *args, "-N", "", "-C", "", "-f", str(path)],  # noqa: S607
+            check=True,
+            capture_output=True,
+        )
+        return path.read_bytes(), path.with_suffix(".pub").read_text().strip()
+
+
+def create_ca_key(path=SSH_CA_KEY_PATH) -> bool:
+    """Create the key of the SSH certificate authority if it does not exist.
+
+    sshd trusts certificates it signed through `TrustedUserCAKeys <path>.pub`.
+
+    :param path: string
+    :return: whether the key was created
+    """
+    if Path(path).exists():
+        return False
+    subprocess.run(  # noqa: S603
+        ["ssh-keygen", "-q", "-t", "ed25519", "-N", "", "-C", "demos-ca", "-f", path],  # noqa: S607
+        check=True,
+        capture_output=True,
+    )
+    return True
+
+
+def sign_public_key(
+    public_key: str,
+    principal: str,
+    validity: int,
+    ca_key_path=SSH_CA_KEY_PATH,
+) -> str:
+    """Sign a user certificate allowing nothing but port forwarding.
+
+    :param public_key: string, OpenSSH public key
+    :param principal: string, user the certificate logs in as
+    :param validity: int, seconds the certificate can be used to log in
+    :param ca_key_path: string
+    :return: string, the certificate
+    :raises InvalidPublicKeyError: if the public key is not valid
+    :raises subprocess.CalledProcessError: if signing failed otherwise, e.g.
+        without a readable CA key
+    """
+    if "\n" in public_key.strip():
+        raise InvalidPublicKeyError("Expected a single public key")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir) / "key.pub"
+        path.write_text(f"{public_key.strip()}\n")
+        # checked on its own, for a signing failure to be the server's fault
+        try:
+            subprocess.run(  # noqa: S603
+                ["ssh-keygen", "-l", "-f", str(path)],  # noqa: S607
+                check=True,
+                capture_output=True,
+            )
+        except subprocess.CalledProcessError as e:
+            raise InvalidPublicKeyError(e.stderr.decode().strip()) from e
+        subprocess.run(  # noqa: S603
+            [  # noqa: S607
+                "ssh-keygen",
+                "-q",
+                "-s",
+                str(ca_key_path),
+                "-I",
+                principal,
+                "-n",
+                principal,
+                # from a minute ago, to tolerate clock skew
+                "-V",
+                f"-1m:+{validity}s",
+                "-O",
+                "clear",
+                "-O",
+                "permit-port-forwarding",
+                str(path),
+            ],
+            check=True,
+            capture_output=True,
+        )
+        return path.with_name("key-cert.pub").read_text().strip()
+
+
+class KeyPool:
+    """Pool of ready SSH key pairs kept in Redis.
+
+    `manage.py key_pool` refills it in the background, so handing a key pair to
+    a client is a single LPOP instead of a key generation. Counters of the
+    keys generated and claimed are kept next to the pool for monitoring.
+    """
+
+    def __init__(
+        self,
+        namespace: str = "demos:keys",
+        size: int = KEY_POOL_SIZE,
+        key_type: str = KEY_TYPE,
+    ) -> None:
+        self.size = size
+        self.key_type = key_type
+        self.pool_key = f"{namespace}:{key_type}"
+        self.stats_key = f"{namespace}:{key_type}:stats"
+
+    @cached_property
+    def redis(self):
+        return get_redis_connection("default")
+
+    def claim(self) -> tuple[bytes, str] | None:
+        """Take a key pair out of the pool.
+
+        :return: tuple(private_key: bytes, public_key: string) or None if empty
+        """
+        item = self.redis.lpop(self.pool_key)
+        self.redis.hincrby(self.stats_key, "claimed" if item else "missed")
+        if item is None:
+            return None
+        key_pair = json.loads(item)
+        return key_pair["private"].encode(), key_pair["public"]
+
+    def refill(self) -> int:
+        """Generate key pairs until the pool is full.
+
+        :return: int, number of key pairs added
+        """
+        started = time.perf_counter()
+        added = 0
+        while self.redis.llen(self.pool_key) < self.size:
+            private_key, public_key = generate_key_pair(self.key_type)
+            self.redis.rpush(
+                self.pool_key,
+                json.dumps({"private": private_key.decode(), "public": public_key}),
+            )
+            added += 1
+        if added:
+            pipe = self.redis.pipeline()
+            pipe.hincrby(self.stats_key, "generated", added)
+            pipe.hset(
+                self.stats_key,
+                mapping={
+                    "last_refill_at": time.time(),
+                    "refill_rate": added / (time.perf_counter() - started),
+                },
+            )
+            pipe.execute()
+        return added
+
+    def stats(self) -> dict:
+        """Get the pool depth and counters.
+
+        :return: dict
+        """
+        pipe = self.redis.pipeline()
+        pipe.llen(self.pool_key)
+        pipe.hgetall(self.stats_key)
+        depth, stats = pipe.execute()
+        return {
+            "depth": depth,
+            "size": self.size,
+            **{key.decode(): float(value) for key, value in stats.items()},
+        }
+
+    def reset(self) -> None:
+        """Drop the pool and its counters."""
+        self.redis.delete(self.pool_key, self.stats_key)
+
+
+key_pool = KeyPool()
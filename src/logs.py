@@ -0,0 +1,125 @@
+"""Logging handlers and formatters, see `LOGGING` in the settings."""
+
+import copy
+import json
+import logging
+import queue
+import threading
+import time
+from datetime import UTC, datetime
+from logging.handlers import QueueHandler
+
+# attributes of every record, the others were passed in `extra`
+_RECORD_ATTRIBUTES = {
+    *vars(logging.makeLogRecord({})),
+    "message",
+    "asctime",
+    "taskName",
+}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with the fields passed in `extra`."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": datetime.fromtimestamp(record.created, tz=UTC).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        data.update(
+            (key, value)
+            for key, value in vars(record).items()
+            if key not in _RECORD_ATTRIBUTES
+        )
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data["exception"] = record.exc_text
+        return json.dumps(data, default=str)
+
+
+class BackgroundHandler(QueueHandler):
+    """Put the records in an in-memory queue, written by a thread.
+
+    Logging a record costs the caller a queue put. The thread formats the
+    records with the formatter of this handler, and writes what piled up in
+    the queue over `interval` as one message per handler, so that a handler
+    such as `ConcurrentRotatingFileHandler` locks the file once per batch
+    rather than once per record. The handlers should format with "%(message)s".
+
+    :param interval: float, seconds the thread waits for a batch to pile up
+    :param batch_size: int, most records written at once
+    :param handlers: handlers the thread writes with, by name
+    """
+
+    def __init__(
+        self,
+        interval: float = 0.1,
+        batch_size: int = 1000,
+        **handlers: logging.Handler,
+    ) -> None:
+        super().__init__(queue.SimpleQueue())
+        self.interval = interval
+        self.batch_size = batch_size
+        self.handlers = list(handlers.values())
+        self.thread = threading.Thread(
+            target=self.write,
+            name="log-writer",
+            daemon=True,
+        )
+        self.thread.start()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # formatted by the thread, with the traceback as a field of its own
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def write(self) -> None:
+        """Write the queued records in batches, until `close`."""
+        while True:
+            records = [self.queue.get()]
+            if records[0] is not None:
+                time.sleep(self.interval)
+            while len(records) < self.batch_size:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            closed = records[-1] is None
+            if closed:
+                records.pop()
+            if records:
+                try:
+                    self.write_batch(records)
+                except Exception:
+                    self.handleError(records[-1])
+            if closed:
+                return
+
+    def write_batch(self, records: list[logging.LogRecord]) -> None:
+        """Write records with each handler, as one message.
+
+        :param records: list of LogRecord
+        :return: None
+        """
+        lines = [(record.levelno, self.format(record)) for record in records]
+        for handler in self.handlers:
+            message = "\n".join(
+                line for levelno, line in lines if levelno >= handler.level
+            )
+            if message:
+                handler.handle(logging.makeLogRecord({"msg": message}))
+
+    def close(self) -> None:
+        # writes the records left in the queue
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        super().close()
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from src.authorized_keys import get_authorized_keys
+
+
+class Command(BaseCommand):
+    help = (
+        "Print the keys a user may log in with. sshd runs the lighter "
+        "authorized_keys.py instead, which does not load Django"
+    )
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument("username")
+
+    def handle(self, *args, username, **options) -> None:  # noqa: ARG002
+        for key in get_authorized_keys(username):
+            self.stdout.write(key)
@@ -0,0 +1,898 @@
+import asyncio
+import contextlib
+import logging
+import multiprocessing
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from urllib.parse import urlencode
+
+from concurrent_log_handler import ConcurrentRotatingFileHandler
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+from django_redis import get_redis_connection
+
+from src.authorized_keys import (
+    add_authorized_key,
+    get_authorized_keys,
+    revoke_authorized_keys,
+)
+from src.connections import ConnectionRegistry, connection_registry
+from src.env import LOG_MAX_BYTES
+from src.funks import get_upstream_name
+from src.keys import create_ca_key, generate_key_pair, sign_public_key
+from src.logs import BackgroundHandler, JsonFormatter
+from src.models import Project
+from src.ports import PortAllocator, port_allocator
+from src.probes import TunnelProber
+from src.projects import get_project_info, invalidate_project_info
+from src.proxy import TunnelProxy
+from src.render import get_template
+from src.routes import format_upstream
+
+NGINX_BENCHMARK_CONF = """
+pid {root}/nginx.pid;
+error_log {root}/error.log;
+events {{}}
+http {{
+    server_names_hash_max_size 262144;
+    server_names_hash_bucket_size 128;
+    access_log off;
+    map $http_upgrade $connection_upgrade {{
+        default upgrade;
+        '' close;
+    }}
+    map $http_upgrade $connection_upgrade_keepalive {{
+        default upgrade;
+        '' '';
+    }}
+    include {root}/sites/*;
+}}
+"""
+
+
+async def http_load(
+    address: tuple[str, int],
+    host: str,
+    requests: int,
+    concurrency: int,
+) -> tuple[float, list[float]]:
+    """Send GET requests, one per connection, from concurrent clients.
+
+    :param address: tuple(host, port) to connect to
+    :param host: string, Host header
+    :param requests: int, total number of requests
+    :param concurrency: int, number of concurrent clients
+    :return: tuple(elapsed seconds, latency of every request)
+    """
+    request = f"GET / HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n"
+    latencies: list[float] = []
+    remaining = iter(range(requests))
+
+    async def client() -> None:
+        for _ in remaining:
+            started = time.perf_counter()
+            reader, writer = await asyncio.open_connection(*address)
+            writer.write(request.encode())
+            await reader.read()
+            writer.close()
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return time.perf_counter() - started, latencies
+
+
+async def read_http_response(reader) -> tuple[bytes, bool]:
+    """Read an HTTP/1.1 response, with a Content-Length or chunked body.
+
+    :param reader: asyncio.StreamReader
+    :return: tuple(status line and headers, whether the server closes)
+    """
+    head = await reader.readuntil(b"\r\n\r\n")
+    headers = {}
+    for line in head.split(b"\r\n")[1:]:
+        name, _, value = line.partition(b":")
+        headers[name.strip().lower()] = value.strip().lower()
+    if headers.get(b"transfer-encoding") == b"chunked":
+        while size := int(await reader.readuntil(b"\r\n"), 16):
+            await reader.readexactly(size + 2)
+        await reader.readuntil(b"\r\n")
+    else:
+        await reader.readexactly(int(headers.get(b"content-length", 0)))
+    # sync workers close the connection after every response
+    return head, headers.get(b"connection") == b"close"
+
+
+async def tunnel_clients(
+    address: tuple[str, int],
+    host: str,
+    path: str,
+    body: str,
+    duration: float,
+    clients: int,
+) -> tuple[float, list[float], int]:
+    """POST back to back over keep-alive connections, as many tunnel clients.
+
+    :param address: tuple(host, port) to connect to
+    :param host: string, Host header
+    :param path: string
+    :param body: string, urlencoded form
+    :param duration: float, seconds
+    :param clients: int, number of concurrent clients
+    :return: tuple(elapsed seconds, latency of every request, failed requests)
+    """
+    request = (
+        f"POST {path} HTTP/1.1\r\nHost: {host}\r\n"
+        "Content-Type: application/x-www-form-urlencoded\r\n"
+        f"Content-Length: {len(body)}\r\n\r\n{body}"
+    ).encode()
+    latencies: list[float] = []
+    failed = 0
+
+    async def client(deadline) -> None:
+        nonlocal failed
+        writer = None
+        try:
+            while time.perf_counter() < deadline:
+                if writer is None:
+                    reader, writer = await asyncio.open_connection(*address)
+                started = time.perf_counter()
+                writer.write(request)
+                head, close = await read_http_response(reader)
+                latencies.append(time.perf_counter() - started)
+                if not head.startswith((b"HTTP/1.1 2", b"HTTP/1.0 2")):
+                    failed += 1
+                if close:
+                    writer.close()
+                    writer = None
+        finally:
+            if writer is not None:
+                writer.close()
+
+    started = time.perf_counter()
+    deadline = started + duration
+    await asyncio.gather(*(client(deadline) for _ in range(clients)))
+    return time.perf_counter() - started, latencies, failed
+
+
+async def hello_upstream(reader, writer) -> None:
+    """Answer any request with a small response, standing in for a tunnel.
+
+    The connection is kept open for further requests unless the client asks
+    to close it, like a typical HTTP/1.1 application server.
+    """
+    try:
+        while True:
+            head = await reader.readuntil(b"\r\n\r\n")
+            close = b"connection: close" in head.lower()
+            writer.write(
+                b"HTTP/1.1 200 OK\r\nContent-Length: 12\r\n%s\r\nHello world!"
+                % (b"Connection: close\r\n" if close else b""),
+            )
+            await writer.drain()
+            if close:
+                break
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def wait_for_port(port: int) -> None:
+    """Wait until something accepts connections on a local port.
+
+    :param port: int
+    :return: None
+    """
+    async with asyncio.timeout(10):
+        while True:
+            try:
+                _, writer = await asyncio.open_connection("127.0.0.1", port)
+            except OSError:
+                await asyncio.sleep(0.05)
+            else:
+                writer.close()
+                return
+
+
+def get_log_handler(mode: str, directory: str) -> logging.Handler:
+    """Build the request log handler of the settings, in a benchmark directory.
+
+    :param mode: string, "file", or "queue" for LOG_QUEUE
+    :param directory: string
+    :return: Handler
+    """
+    if mode == "file":
+        handler = ConcurrentRotatingFileHandler(
+            Path(directory, "request.log"),
+            maxBytes=100 * 1000,
+            backupCount=12,
+        )
+        handler.setFormatter(
+            logging.Formatter(settings.LOGGING["formatters"]["file"]["format"]),
+        )
+        return handler
+    handler = ConcurrentRotatingFileHandler(
+        Path(directory, "queue.log"),
+        maxBytes=LOG_MAX_BYTES,
+        backupCount=12,
+        use_gzip=True,
+    )
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    background = BackgroundHandler(file=handler)
+    background.setFormatter(JsonFormatter())
+    return background
+
+
+def time_logged_requests(mode: str, directory: str, requests: int) -> list[float]:
+    """Time requests through the whole middleware stack, logging with `mode`.
+
+    :param mode: string, "off" without the request log, else see
+        `get_log_handler`
+    :param directory: string
+    :param requests: int
+    :return: list of float, seconds
+    """
+    middleware = settings.MIDDLEWARE
+    if mode == "off":
+        middleware = [
+            m for m in middleware if not m.endswith("RequestLoggerMiddleware")
+        ]
+    with override_settings(MIDDLEWARE=middleware):
+        client = Client(HTTP_HOST=settings.ALLOWED_HOSTS[0])
+        client.get("/health")  # loads the middleware
+    root = logging.getLogger()
+    root.handlers = [
+        logging.NullHandler() if mode == "off" else get_log_handler(mode, directory),
+    ]
+    root.setLevel(logging.INFO)
+    samples = []
+    for _ in range(requests):
+        started = time.perf_counter()
+        client.get("/health")
+        samples.append(time.perf_counter() - started)
+    # waits for the queue to be written
+    root.handlers[0].close()
+    return samples
+
+
+def get_free_port() -> int:
+    """Get a local port nothing is listening on.
+
+    :return: int
+    """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def format_latencies(samples: list[float]) -> str:
+    """Summarize latency samples given in seconds.
+
+    :param samples: list of float
+    :return: string
+    """
+    samples = sorted(samples)
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    return (
+        f"mean={statistics.fmean(samples) * 1e6:.1f}us "
+        f"p50={statistics.median(samples) * 1e6:.1f}us "
+        f"p99={p99 * 1e6:.1f}us"
+    )
+
+
+class Command(BaseCommand):
+    help = "Run benchmarks against the local services"
+
+    def add_arguments(self, parser) -> None:
+        subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+        ports = subparsers.add_parser("ports", help="Port lease allocation latency")
+        ports.add_argument("--size", type=int, default=10001)
+        ports.add_argument("--fill", type=float, default=0.9)
+        ports.add_argument("--iterations", type=int, default=1000)
+
+        routing = subparsers.add_parser(
+            "nginx-routing",
+            help="nginx config load time, server block per domain vs route map",
+        )
+        routing.add_argument(
+            "--projects",
+            type=int,
+            nargs="+",
+            default=[1000, 10000, 50000],
+        )
+        routing.add_argument("--repeat", type=int, default=3)
+
+        proxy = subparsers.add_parser(
+            "proxy",
+            help="Requests/sec through the tunnel proxy, or through --target",
+        )
+        proxy.add_argument("--requests", type=int, default=10000)
+        proxy.add_argument("--concurrency", type=int, default=100)
+        proxy.add_argument(
+            "--target",
+            help="host:port of a running proxy, e.g. nginx, to measure instead",
+        )
+        proxy.add_argument(
+            "--host-header",
+            default="bench.demo.test",
+            help="Domain routed to a live tunnel when using --target",
+        )
+
+        authorized_keys = subparsers.add_parser(
+            "authorized-keys",
+            help="Latency of the key lookup sshd runs on every login attempt",
+        )
+        authorized_keys.add_argument("--keys", type=int, default=1)
+        authorized_keys.add_argument("--iterations", type=int, default=1000)
+        authorized_keys.add_argument(
+            "--spawns",
+            type=int,
+            default=50,
+            help="Number of runs of the command itself, as sshd spawns it",
+        )
+
+        heartbeat = subparsers.add_parser(
+            "heartbeat",
+            help="Heartbeats/sec through the whole middleware stack, in this process",
+        )
+        heartbeat.add_argument("--requests", type=int, default=2000)
+        heartbeat.add_argument("--connections", type=int, default=1000)
+        heartbeat.add_argument("--batch-size", type=int, default=100)
+
+        certificates = subparsers.add_parser(
+            "certificates",
+            help="SSH user certificate signing throughput",
+        )
+        certificates.add_argument("--iterations", type=int, default=200)
+        certificates.add_argument(
+            "--key-type",
+            choices=("rsa", "ed25519"),
+            default="ed25519",
+            help="Type of the signed keys",
+        )
+
+        project_lookup = subparsers.add_parser(
+            "project-lookup",
+            help="Queries per tunnel API request, fails if a cached lookup queries",
+        )
+        project_lookup.add_argument(
+            "--domain",
+            help="Domain of an existing project, defaults to the first one",
+        )
+        project_lookup.add_argument("--iterations", type=int, default=1000)
+
+        tunnel_api = subparsers.add_parser(
+            "tunnel-api",
+            help="Requests/sec a running server sustains from concurrent tunnel "
+            "clients, to compare the sync and async (TUNNEL_API_ASYNC) views",
+        )
+        tunnel_api.add_argument("target", help="host:port of the app server")
+        tunnel_api.add_argument(
+            "--domain",
+            help="Domain of a project, defaults to the first one",
+        )
+        tunnel_api.add_argument(
+            "--endpoint",
+            choices=("keep_alive", "connect"),
+            default="keep_alive",
+            help="connect re-applies the route of the project's live connection",
+        )
+        tunnel_api.add_argument("--clients", type=int, nargs="+", default=[10, 100])
+        tunnel_api.add_argument("--duration", type=float, default=10)
+
+        request_logging = subparsers.add_parser(
+            "request-logging",
+            help="Per-request overhead of the request log, written on the request "
+            "vs through the queue of LOG_QUEUE, against no request log",
+        )
+        request_logging.add_argument("--requests", type=int, default=2000)
+        request_logging.add_argument(
+            "--workers",
+            type=int,
+            default=5,
+            help="Processes logging to the same files at once",
+        )
+        request_logging.add_argument("--rounds", type=int, default=5)
+
+        probes = subparsers.add_parser(
+            "probes",
+            help="Probes/sec of the tunnel health prober, for each concurrency",
+        )
+        probes.add_argument("--tunnels", type=int, default=5000)
+        probes.add_argument(
+            "--dead",
+            type=float,
+            default=0.1,
+            help="Share of the tunnels with nothing listening on their port",
+        )
+        probes.add_argument("--concurrency", type=int, nargs="+", default=[50, 500])
+
+        tunnel = subparsers.add_parser(
+            "tunnel",
+            help="Requests/sec through nginx and an SSH reverse tunnel, "
+            "with and without upstream keepalive",
+        )
+        tunnel.add_argument(
+            "destination",
+            help="SSH destination to open the reverse tunnel on, e.g. user@localhost",
+        )
+        tunnel.add_argument("--ssh-option", "-o", action="append", default=[])
+        tunnel.add_argument("--requests", type=int, default=5000)
+        tunnel.add_argument("--concurrency", type=int, default=50)
+        tunnel.add_argument("--keepalive", type=int, nargs="+", default=[0, 16])
+
+    def handle(self, *args, benchmark, **options) -> None:  # noqa: ARG002
+        getattr(self, f"bench_{benchmark.replace('-', '_')}")(**options)
+
+    def bench_ports(self, size, fill, iterations, **options) -> None:  # noqa: ARG002
+        allocator = PortAllocator(
+            namespace="demos:benchmark:ports",
+            start=1,
+            end=size,
+            lease_timeout=3600,
+            probe=False,
+        )
+        allocator.reset()
+        try:
+            for project_id in range(int(size * fill)):
+                allocator.acquire(project_id)
+
+            project_id = size + 1
+            acquire, release = [], []
+            for _ in range(iterations):
+                started = time.perf_counter()
+                port = allocator.acquire(project_id)
+                acquire.append(time.perf_counter() - started)
+
+                started = time.perf_counter()
+                allocator.release(project_id, port)
+                release.append(time.perf_counter() - started)
+        finally:
+            allocator.reset()
+
+        self.stdout.write(f"pool: {size} ports, {fill:.0%} leased")
+        self.stdout.write(f"acquire: {format_latencies(acquire)}")
+        self.stdout.write(f"release: {format_latencies(release)}")
+
+    def bench_nginx_routing(self, projects, repeat, **options) -> None:  # noqa: ARG002
+        nginx = shutil.which("nginx")
+        if nginx is None:
+            raise CommandError("nginx is not installed")
+
+        server_tpl = get_template("nginx.conf-tpl")
+        map_tpl = get_template("nginx.map.conf-tpl")
+
+        for count in projects:
+            domains = [(f"p{i}.demo.test", 20000 + i % 10000) for i in range(count)]
+            for mode in ("server", "map"):
+                with tempfile.TemporaryDirectory() as root:
+                    sites = Path(root, "sites")
+                    sites.mkdir()
+                    if mode == "server":
+                        for domain, port in domains:
+                            Path(sites, f"{domain}.conf").write_text(
+                                server_tpl.render(domain=domain, port=port),
+                            )
+                    else:
+                        routes_file = Path(root, "routes.map")
+                        routes_file.write_text(
+                            "".join(
+                                f"{domain} {format_upstream(port)};\n"
+                                for domain, port in domains
+                            ),
+                        )
+                        Path(sites, "demos.conf").write_text(
+                            map_tpl.render(HOST="demo.test", routes_file=routes_file),
+                        )
+                    conf = Path(root, "nginx.conf")
+                    conf.write_text(NGINX_BENCHMARK_CONF.format(root=root))
+
+                    # parsing the whole config is what a reload costs the master
+                    samples = []
+                    for _ in range(repeat):
+                        started = time.perf_counter()
+                        subprocess.run(  # noqa: S603
+                            [nginx, "-t", "-q", "-p", root, "-c", str(conf)],
+                            check=True,
+                            capture_output=True,
+                        )
+                        samples.append(time.perf_counter() - started)
+
+                self.stdout.write(
+                    f"{count} projects, {mode}: "
+                    f"{statistics.median(samples) * 1e3:.1f}ms to load the config",
+                )
+
+    def bench_proxy(
+        self,
+        requests,
+        concurrency,
+        target,
+        host_header,
+        **options,  # noqa: ARG002
+    ) -> None:
+        async def run() -> tuple[float, list[float]]:
+            if target:
+                host, _, port = target.rpartition(":")
+                return await http_load(
+                    (host, int(port)),
+                    host_header,
+                    requests,
+                    concurrency,
+                )
+
+            upstream = await asyncio.start_server(hello_upstream, "127.0.0.1", 0)
+            upstream_port = upstream.sockets[0].getsockname()[1]
+            proxy = TunnelProxy({host_header: f"127.0.0.1:{upstream_port}"})
+            server = await asyncio.start_server(proxy.handle, "127.0.0.1", 0)
+            async with upstream, server:
+                return await http_load(
+                    server.sockets[0].getsockname(),
+                    host_header,
+                    requests,
+                    concurrency,
+                )
+
+        elapsed, latencies = asyncio.run(run())
+        self.stdout.write(
+            f"{target or 'tunnel proxy'}: {len(latencies) / elapsed:.0f} req/s, "
+            f"{format_latencies(latencies)}",
+        )
+
+    def bench_authorized_keys(
+        self,
+        keys,
+        iterations,
+        spawns,
+        **options,  # noqa: ARG002
+    ) -> None:
+        username = "benchmark"
+        redis = get_redis_connection("default")
+        for i in range(keys):
+            add_authorized_key(redis, username, f"ssh-ed25519 KEY{i}", 3600)
+
+        def measure(func, count) -> list[float]:
+            samples = []
+            for _ in range(count):
+                started = time.perf_counter()
+                func()
+                samples.append(time.perf_counter() - started)
+            return samples
+
+        def run(*command) -> None:
+            subprocess.run(command, check=True, capture_output=True)  # noqa: S603
+
+        try:
+            lookup = measure(lambda: get_authorized_keys(username), iterations)
+            script = measure(
+                lambda: run(
+                    sys.executable,
+                    str(settings.BASE_DIR / "authorized_keys.py"),
+                    username,
+                ),
+                spawns,
+            )
+            command = measure(
+                lambda: run(
+                    sys.executable,
+                    str(settings.BASE_DIR / "manage.py"),
+                    "authorized_keys",
+                    username,
+                ),
+                spawns,
+            )
+        finally:
+            revoke_authorized_keys(redis, username)
+
+        self.stdout.write(f"lookup: {format_latencies(lookup)}")
+        self.stdout.write(f"authorized_keys.py: {format_latencies(script)}")
+        self.stdout.write(f"manage.py authorized_keys: {format_latencies(command)}")
+
+    def bench_heartbeat(
+        self,
+        requests,
+        connections,
+        batch_size,
+        **options,  # noqa: ARG002
+    ) -> None:
+        registry = ConnectionRegistry()
+        domains = [f"heartbeat{i}.benchmark.test" for i in range(connections)]
+        project_ids = range(-connections, 0)
+        for project_id, domain in zip(project_ids, domains, strict=True):
+            registry.register(project_id, domain)
+        client = Client(HTTP_HOST=settings.ALLOWED_HOSTS[0])
+
+        def measure(path, batch) -> float:
+            started = time.perf_counter()
+            for i in range(requests):
+                offset = i * batch % connections
+                client.post(path, {"domain": domains[offset : offset + batch]})
+            return requests * batch / (time.perf_counter() - started)
+
+        try:
+            single = measure(reverse("keep_alive"), 1)
+            batch = measure(reverse("keep_alive_batch"), batch_size)
+        finally:
+            for project_id, domain in zip(project_ids, domains, strict=True):
+                registry.unregister(project_id, domain)
+
+        self.stdout.write(f"keep_alive: {single:.0f} heartbeats/s")
+        self.stdout.write(
+            f"keep_alive/batch, {batch_size} domains: {batch:.0f} heartbeats/s",
+        )
+
+    def bench_certificates(self, iterations, key_type, **options) -> None:  # noqa: ARG002
+        _, public_key = generate_key_pair(key_type)
+        samples = []
+        with tempfile.TemporaryDirectory() as root:
+            ca_key_path = Path(root, "ca")
+            create_ca_key(ca_key_path)
+            started = time.perf_counter()
+            for _ in range(iterations):
+                sample_started = time.perf_counter()
+                sign_public_key(public_key, "benchmark", 60, ca_key_path)
+                samples.append(time.perf_counter() - sample_started)
+            elapsed = time.perf_counter() - started
+
+        self.stdout.write(
+            f"{key_type} keys: {iterations / elapsed:.0f} certificates/s, "
+            f"{format_latencies(samples)}",
+        )
+
+    def bench_project_lookup(self, domain, iterations, **options) -> None:  # noqa: ARG002
+        project = (
+            Project.objects.filter(domain=domain) if domain else Project.objects
+        ).first()
+        if project is None:
+            raise CommandError("No project to look up")
+        client = Client(HTTP_HOST=settings.ALLOWED_HOSTS[0])
+        # a wrong secret key goes through the lookup and changes nothing
+        requests = {
+            "get_connection_info": {"domain": project.domain},
+            "keep_alive": {"domain": project.domain},
+            "get_key_file": {"domain": project.domain, "secret_key": "-"},
+            "connect": {"domain": project.domain, "secret_key": "-"},
+            "disconnect": {"domain": project.domain, "secret_key": "-"},
+        }
+
+        def count_queries(name, data) -> int:
+            with CaptureQueriesContext(connection) as queries:
+                client.post(reverse(name), data)
+            return len(queries)
+
+        cached_queries = 0
+        try:
+            for name, data in requests.items():
+                invalidate_project_info(project.domain)
+                cold = count_queries(name, data)
+                warm = count_queries(name, data)
+                cached_queries += warm
+                self.stdout.write(f"{name}: {cold} queries cold, {warm} cached")
+        finally:
+            port_allocator.release(project.id)
+
+        def measure(lookup) -> float:
+            started = time.perf_counter()
+            for _ in range(iterations):
+                lookup()
+            return iterations / (time.perf_counter() - started)
+
+        database = measure(
+            lambda: Project.objects.select_related("user").get(id=project.id),
+        )
+        cached = measure(lambda: get_project_info(project.domain))
+        self.stdout.write(
+            f"lookups: {database:.0f}/s from the database, {cached:.0f}/s cached",
+        )
+        if cached_queries:
+            raise CommandError(f"{cached_queries} queries with a cached project")
+
+    def bench_tunnel_api(
+        self,
+        target,
+        domain,
+        endpoint,
+        clients,
+        duration,
+        **options,  # noqa: ARG002
+    ) -> None:
+        project = (
+            Project.objects.filter(domain=domain) if domain else Project.objects
+        ).first()
+        if project is None:
+            raise CommandError("No project to send requests for")
+        data = {"domain": project.domain}
+        if endpoint == "connect":
+            connection = connection_registry.get(project.id)
+            if connection is None or not connection["port"]:
+                raise CommandError(f"{project.domain} has no live tunnel on a port")
+            data |= {"secret_key": project.secret_key, "port": connection["port"]}
+        body = urlencode(data)
+        host, _, port = target.rpartition(":")
+
+        for count in clients:
+            elapsed, latencies, failed = asyncio.run(
+                tunnel_clients(
+                    (host, int(port)),
+                    settings.ALLOWED_HOSTS[0],
+                    reverse(endpoint),
+                    body,
+                    duration,
+                    count,
+                ),
+            )
+            rate = len(latencies) / elapsed
+            self.stdout.write(
+                f"{count} clients: {rate:.0f} req/s, {failed} failed, "
+                f"{format_latencies(latencies)}",
+            )
+
+    def bench_request_logging(
+        self,
+        requests,
+        workers,
+        rounds,
+        **options,  # noqa: ARG002
+    ) -> None:
+        modes = {"off": [], "file": [], "queue": []}
+        # forked like the gunicorn workers, sharing the log files
+        with (
+            tempfile.TemporaryDirectory() as directory,
+            multiprocessing.get_context("fork").Pool(workers) as pool,
+        ):
+            # interleaved, for the noise of the machine to hit every mode
+            for _ in range(rounds):
+                for mode, samples in modes.items():
+                    for worker_samples in pool.starmap(
+                        time_logged_requests,
+                        [(mode, directory, requests // rounds)] * workers,
+                    ):
+                        samples.extend(worker_samples)
+
+        # medians, the means of forked workers sharing the CPUs are noisy
+        baseline = statistics.median(modes["off"])
+        for mode, samples in modes.items():
+            overhead = (statistics.median(samples) - baseline) * 1e6
+            self.stdout.write(
+                f"{mode}: {format_latencies(samples)}, {overhead:+.1f}us per request",
+            )
+
+    def bench_probes(self, tunnels, dead, concurrency, **options) -> None:  # noqa: ARG002
+        async def run(prober) -> tuple[float, list[float | None]]:
+            # every probe hits the same listener, do not let its backlog fill up
+            upstream = await asyncio.start_server(
+                hello_upstream,
+                "127.0.0.1",
+                0,
+                backlog=4096,
+            )
+            live_port = upstream.sockets[0].getsockname()[1]
+            dead_port = get_free_port()
+            connections = [
+                {
+                    "domain": f"{i}.bench.demo.test",
+                    "port": dead_port if i < tunnels * dead else live_port,
+                    "socket": "",
+                }
+                for i in range(tunnels)
+            ]
+            async with upstream:
+                started = time.perf_counter()
+                results = await prober.probe_all(connections)
+                return time.perf_counter() - started, results
+
+        for limit in concurrency:
+            elapsed, results = asyncio.run(run(TunnelProber(concurrency=limit)))
+            rtts = [rtt for rtt in results if rtt is not None]
+            self.stdout.write(
+                f"concurrency {limit}: {len(results) / elapsed:.0f} probes/s, "
+                f"{len(results) - len(rtts)} failed, rtt {format_latencies(rtts)}",
+            )
+
+    def bench_tunnel(
+        self,
+        destination,
+        ssh_option,
+        requests,
+        concurrency,
+        keepalive,
+        **options,  # noqa: ARG002
+    ) -> None:
+        nginx, ssh = shutil.which("nginx"), shutil.which("ssh")
+        if nginx is None or ssh is None:
+            raise CommandError("nginx and ssh must be installed")
+
+        domain = "bench.demo.test"
+        template = get_template("nginx.conf-tpl")
+        tunnel_port, listen = get_free_port(), get_free_port()
+
+        def write_nginx_conf(root, connections) -> Path:
+            sites = Path(root, "sites")
+            sites.mkdir()
+            Path(sites, f"{domain}.conf").write_text(
+                template.render(
+                    domain=domain,
+                    port=tunnel_port,
+                    upstream=get_upstream_name(domain),
+                    keepalive=connections,
+                    listen=f"127.0.0.1:{listen}",
+                ),
+            )
+            conf = Path(root, "nginx.conf")
+            conf.write_text(NGINX_BENCHMARK_CONF.format(root=root))
+            return conf
+
+        async def run(roots) -> list[tuple[int, float, list[float]]]:
+            upstream = await asyncio.start_server(hello_upstream, "127.0.0.1", 0)
+            upstream_port = upstream.sockets[0].getsockname()[1]
+            options = [arg for option in ssh_option for arg in ("-o", option)]
+            # the same path a visitor request takes: nginx -> sshd -> ssh client
+            tunnel = await asyncio.create_subprocess_exec(
+                ssh,
+                "-N",
+                "-o",
+                "BatchMode=yes",
+                "-o",
+                "ExitOnForwardFailure=yes",
+                *options,
+                "-R",
+                f"{tunnel_port}:127.0.0.1:{upstream_port}",
+                destination,
+            )
+            results = []
+            try:
+                async with upstream:
+                    await wait_for_port(tunnel_port)
+                    for connections, root in zip(keepalive, roots, strict=True):
+                        server = await asyncio.create_subprocess_exec(
+                            nginx,
+                            "-p",
+                            root,
+                            "-c",
+                            f"{root}/nginx.conf",
+                            "-g",
+                            "daemon off;",
+                        )
+                        try:
+                            await wait_for_port(listen)
+                            elapsed, latencies = await http_load(
+                                ("127.0.0.1", listen),
+                                domain,
+                                requests,
+                                concurrency,
+                            )
+                        finally:
+                            server.terminate()
+                            await server.wait()
+                        results.append((connections, elapsed, latencies))
+            finally:
+                tunnel.terminate()
+                await tunnel.wait()
+            return results
+
+        with contextlib.ExitStack() as stack:
+            roots = []
+            for connections in keepalive:
+                root = stack.enter_context(tempfile.TemporaryDirectory())
+                write_nginx_conf(root, connections)
+                roots.append(root)
+            results = asyncio.run(run(roots))
+
+        for connections, elapsed, latencies in results:
+            self.stdout.write(
+                f"keepalive {connections or 'off'}: "
+                f"{len(latencies) / elapsed:.0f} req/s, "
+                f"{format_latencies(latencies)}",
+            )
@@ -0,0 +1,19 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from src.connections import connection_registry
+
+
+class Command(BaseCommand):
+    help = "List the live tunnels as JSON lines"
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument("--count", action="store_true", help="Only count them")
+
+    def handle(self, *args, count, **options) -> None:  # noqa: ARG002
+        if count:
+            self.stdout.write(str(connection_registry.count()))
+            return
+        for connection in connection_registry.active():
+            self.stdout.write(json.dumps(connection))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from src.edge import EdgeAgent
+from src.env import EDGE_RELOAD_WINDOW
+
+
+class Command(BaseCommand):
+    help = "Apply queued nginx/sshd config changes, batching service reloads"
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument(
+            "--window",
+            type=float,
+            default=EDGE_RELOAD_WINDOW,
+            help="Minimum number of seconds between two reloads of a service",
+        )
+
+    def handle(self, *args, window, **options) -> None:  # noqa: ARG002
+        EdgeAgent(window=window).run()
@@ -1,16 +1,48 @@
 # ruff: noqa: T201
 
+from pathlib import Path
+
 from django.core.management.base import BaseCommand
 
-from src.env import HTTP_HOST
-from src.funks import create_user_profile, gen_502_page, gen_default_nginx_conf
+from src.edge import reload_service
+from src.env import HTTP_HOST, NGINX_ROUTING_MODE, TUNNEL_SHARED_ACCOUNT
+from src.funks import (
+    add_user_to_tunnel_group,
+    create_shared_account,
+    create_tunnel_group,
+    create_user_profile,
+    gen_default_nginx_conf,
+    gen_nginx_routes,
+    gen_nginx_routing_conf,
+    gen_offline_page,
+)
+from src.keys import create_ca_key
 from src.models import Project, User
+from src.routes import set_route
 
 
 class Command(BaseCommand):
     help = "Generate nginx config, ssh config"
 
     def handle(self, *args, **options) -> None:  # noqa: ARG002
+        self.gen_user_profiles()
+        self.gen_project_confs()
+
+    def gen_user_profiles(self) -> None:
+        create_tunnel_group()
+        create_ca_key()
+
+        # per-user sshd config files written by older versions
+        user_confs = list(Path("/etc/ssh/sshd_config.d/user.d").glob("*.conf"))
+        for user_conf in user_confs:
+            user_conf.unlink()
+        if user_confs:
+            reload_service("ssh")
+
+        if TUNNEL_SHARED_ACCOUNT:
+            create_shared_account()
+            return
+
         # Create user's profile
         for user in User.objects.filter(is_superuser=False):
             try:
@@ -19,6 +51,16 @@ class Command(BaseCommand):
                 print("~" * 50)
                 print(f"Error: {e}")
                 print("User: ", user.username)
+            try:
+                # users created before the group existed
+                add_user_to_tunnel_group(user.username)
+            except Exception as e:
+                print("~" * 50)
+                print(f"Error: {e}")
+                print("User: ", user.username)
+
+    def gen_project_confs(self) -> None:
+        gen_offline_page()
 
         # Create project's config
         for project in Project.objects.all():
@@ -26,9 +68,21 @@ class Command(BaseCommand):
                 subdomain = project.domain.split(".")[0]
                 project.domain = f"{subdomain}.{HTTP_HOST}"
                 project.save()
-                gen_502_page(project.domain)
-                gen_default_nginx_conf(project.domain)
+                if NGINX_ROUTING_MODE in ("map", "proxy"):
+                    set_route(project.domain)
+                    Path(f"/etc/nginx/sites/{project.domain}.conf").unlink(
+                        missing_ok=True,
+                    )
+                else:
+                    gen_default_nginx_conf(project.domain)
             except Exception as e:
                 print("~" * 50)
                 print(f"Error: {e}")
                 print("Project: ", project.domain)
+
+        if NGINX_ROUTING_MODE == "map":
+            gen_nginx_routes()
+        if NGINX_ROUTING_MODE in ("map", "proxy"):
+            gen_nginx_routing_conf()
+        else:
+            Path("/etc/nginx/sites/demos.conf").unlink(missing_ok=True)
@@ -0,0 +1,38 @@
+import json
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from src.keys import key_pool
+
+
+class Command(BaseCommand):
+    help = "Keep the pool of pre-generated SSH key pairs full"
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=1,
+            help="Number of seconds between two checks of the pool depth",
+        )
+        parser.add_argument("--once", action="store_true", help="Fill it and exit")
+        parser.add_argument(
+            "--stats",
+            action="store_true",
+            help="Print the pool depth and counters as JSON and exit",
+        )
+
+    def handle(self, *args, interval, once, stats, **options) -> None:  # noqa: ARG002
+        if stats:
+            self.stdout.write(json.dumps(key_pool.stats()))
+            return
+
+        while True:
+            added = key_pool.refill()
+            if added:
+                logging.info("Added %d key pairs to the pool", added)
+            if once:
+                return
+            time.sleep(interval)
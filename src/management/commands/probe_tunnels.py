@@ -0,0 +1,39 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from src.env import PROBE_INTERVAL
+from src.probes import tunnel_prober
+
+
+class Command(BaseCommand):
+    help = "Probe the live tunnels and route the broken ones to the offline page"
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=PROBE_INTERVAL,
+            help="Number of seconds between the start of two rounds of probes",
+        )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=tunnel_prober.concurrency,
+            help="Number of probes in flight at once",
+        )
+        parser.add_argument("--once", action="store_true", help="Probe once and exit")
+
+    def handle(self, *args, interval, concurrency, once, **options) -> None:  # noqa: ARG002
+        tunnel_prober.concurrency = concurrency
+        if once:
+            started = time.perf_counter()
+            probed = tunnel_prober.run_once()
+            logging.info(
+                "Probed %d tunnels in %.3fs",
+                probed,
+                time.perf_counter() - started,
+            )
+            return
+        tunnel_prober.run(interval)
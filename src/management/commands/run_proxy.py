@@ -0,0 +1,17 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from src.env import TUNNEL_PROXY_PORT
+from src.proxy import TunnelProxy
+
+
+class Command(BaseCommand):
+    help = "Run the reverse proxy routing demo domains to their tunnels"
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=TUNNEL_PROXY_PORT)
+
+    def handle(self, *args, host, port, **options) -> None:  # noqa: ARG002
+        asyncio.run(TunnelProxy().serve(host, port))
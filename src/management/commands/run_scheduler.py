@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from src.connections import reap_expired_connections
+from src.history import flush_connection_history
+from src.scheduler import scheduler
+
+
+class Command(BaseCommand):
+    help = (
+        "Run the scheduled jobs as they fall due, reap expired connections and "
+        "flush the connection history"
+    )
+
+    def handle(self, *args, **options) -> None:  # noqa: ARG002
+        scheduler.run(reap_expired_connections, flush_connection_history)
@@ -0,0 +1,55 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.http import HttpResponse, JsonResponse
+from django.urls import reverse
+
+from src.connections import connection_registry
+from src.views import akeep_alive_connections, keep_alive_connections
+
+
+class HeartbeatMiddleware:
+    """Answer heartbeats of live connections before the rest of the middleware.
+
+    Heartbeats are the busiest requests by far. Those of a live connection
+    only need a Redis update, so they skip sessions, authentication, CSRF,
+    request logging and the database. Heartbeats of a connection that is not
+    live go through the regular view.
+
+    Under ASGI the update goes through the asyncio Redis client, so the
+    request never leaves the event loop.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response) -> None:
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+        self.keep_alive_path = reverse("keep_alive")
+        self.keep_alive_batch_path = reverse("keep_alive_batch")
+
+    def __call__(self, request) -> HttpResponse:
+        if self.async_mode:
+            return self.__acall__(request)
+        if request.method == "POST":
+            if request.path_info == self.keep_alive_path:
+                domain = request.POST.get("domain")
+                if domain and connection_registry.heartbeat_domains([domain])[0]:
+                    return JsonResponse({"success": True})
+            elif request.path_info == self.keep_alive_batch_path:
+                return keep_alive_connections(request)
+        return self.get_response(request)
+
+    async def __acall__(self, request) -> HttpResponse:
+        if request.method == "POST":
+            if request.path_info == self.keep_alive_path:
+                domain = request.POST.get("domain")
+                if (
+                    domain
+                    and (await connection_registry.aheartbeat_domains([domain]))[0]
+                ):
+                    return JsonResponse({"success": True})
+            elif request.path_info == self.keep_alive_batch_path:
+                return await akeep_alive_connections(request)
+        return await self.get_response(request)
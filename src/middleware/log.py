@@ -1,57 +1,93 @@
+import itertools
 import logging
+import time
+from collections import defaultdict
 
 from django.conf import settings
-from django.urls import resolve
+from django.http import HttpResponse
 from django.utils.deprecation import MiddlewareMixin
 from ipware import get_client_ip
 
 
 class RequestLoggerMiddleware(MiddlewareMixin):
-    def process_request(self, request) -> None:
-        if hasattr(settings, "LOGGING_EXCEPT_URL_NAME_LIST"):
-            LOGGING_EXCEPT_URL_NAME_LIST = (  # noqa: N806
-                settings.LOGGING_EXCEPT_URL_NAME_LIST
-            )
-        else:
-            LOGGING_EXCEPT_URL_NAME_LIST = ()  # noqa: N806
+    """Log every request once answered, with structured fields.
 
-        if resolve(request.path_info).url_name in LOGGING_EXCEPT_URL_NAME_LIST:
-            return
-
-        ip, _ = get_client_ip(request)
+    The url name comes from the resolver match of the request, so logging
+    never costs a second resolve. Requests to the url names of
+    `LOGGING_SAMPLED_URL_NAME_LIST` are logged one in `LOGGING_SAMPLE_EVERY`,
+    and without their user: tunnel clients authenticate with a secret key, so
+    reading it would only cost them a session lookup.
+    """
 
-        logging.info(
-            " - ".join(
-                (
-                    f"IP: {ip}",
-                    f"User: {request.user}",
-                    f"Method: {request.method}",
-                    f"Path: {request.get_full_path()}",
-                ),
-            ),
+    def __init__(self, get_response) -> None:
+        super().__init__(get_response)
+        self.except_url_names = getattr(settings, "LOGGING_EXCEPT_URL_NAME_LIST", ())
+        self.sampled_url_names = getattr(
+            settings,
+            "LOGGING_SAMPLED_URL_NAME_LIST",
+            (),
         )
+        self.sample_every = getattr(settings, "LOGGING_SAMPLE_EVERY", 1)
+        self.counters = defaultdict(itertools.count)
+
+    def process_request(self, request) -> None:
+        request.logging_started_at = time.perf_counter()
+
+    def process_response(self, request, response) -> HttpResponse:
+        if self.should_log(request):
+            fields = self.get_fields(request)
+            fields["status"] = response.status_code
+            logging.info(self.format_message(fields), extra=fields)
+        return response
 
     def process_exception(self, request, exception) -> None:
-        if hasattr(settings, "LOGGING_EXCEPT_URL_NAME_LIST"):
-            LOGGING_EXCEPT_URL_NAME_LIST = (  # noqa: N806
-                settings.LOGGING_EXCEPT_URL_NAME_LIST
-            )
-        else:
-            LOGGING_EXCEPT_URL_NAME_LIST = ()  # noqa: N806
+        if self.should_log(request):
+            fields = self.get_fields(request)
+            fields["error"] = str(exception)
+            logging.error(self.format_message(fields), extra=fields)
 
-        if resolve(request.path_info).url_name in LOGGING_EXCEPT_URL_NAME_LIST:
-            return
+    def should_log(self, request) -> bool:
+        # decided once, for the error and the response of a request to agree
+        if not hasattr(request, "logging_sampled"):
+            request.logging_sampled = self.sample(request.resolver_match)
+        return request.logging_sampled
 
-        ip, _ = get_client_ip(request)
+    def sample(self, match) -> bool:
+        # unresolved paths are not logged
+        if match is None or match.url_name in self.except_url_names:
+            return False
+        if match.url_name in self.sampled_url_names:
+            return next(self.counters[match.url_name]) % self.sample_every == 0
+        return True
 
-        logging.error(
-            " - ".join(
-                (
-                    f"IP: {ip}",
-                    f"User: {request.user}",
-                    f"Method: {request.method}",
-                    f"Path: {request.get_full_path()}",
-                    f"Error: {exception}",
-                ),
+    def get_fields(self, request) -> dict:
+        ip, _ = get_client_ip(request)
+        started_at = getattr(request, "logging_started_at", None)
+        fields = {
+            "ip": ip,
+            "method": request.method,
+            "path": request.get_full_path(),
+            "url_name": request.resolver_match.url_name,
+            "duration": (
+                None if started_at is None else time.perf_counter() - started_at
             ),
-        )
+        }
+        if request.resolver_match.url_name in self.sampled_url_names:
+            fields["sample_every"] = self.sample_every
+        else:
+            fields["user"] = str(request.user)
+        return fields
+
+    def format_message(self, fields: dict) -> str:
+        parts = [f"IP: {fields['ip']}"]
+        if "user" in fields:
+            parts.append(f"User: {fields['user']}")
+        parts += [
+            f"Method: {fields['method']}",
+            f"Path: {fields['path']}",
+        ]
+        if "status" in fields:
+            parts.append(f"Status: {fields['status']}")
+        if "error" in fields:
+            parts.append(f"Error: {fields['error']}")
+        return " - ".join(parts)
@@ -0,0 +1,20 @@
+# Generated by Django 6.0.4 on 2026-10-18 04:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("src", "0004_alter_project_user"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="project",
+            name="cache_enabled",
+            field=models.BooleanField(
+                default=False,
+                help_text="Cache responses allowed by their Cache-Control header at the edge. Applies from the next connection.",  # noqa: E501
+            ),
+        ),
+    ]
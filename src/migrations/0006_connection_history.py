@@ -0,0 +1,71 @@
+# Generated by Django 6.0.4 on 2026-10-18 04:28
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("src", "0005_project_cache_enabled"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="project",
+            name="connection_count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name="ConnectionEvent",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "event",
+                    models.CharField(
+                        choices=[
+                            ("connected", "Connected"),
+                            ("disconnected", "Disconnected"),
+                            ("timed_out", "Timed out"),
+                        ],
+                        max_length=16,
+                    ),
+                ),
+                ("occurred_at", models.DateTimeField()),
+                ("port", models.PositiveIntegerField(blank=True, null=True)),
+                ("socket", models.CharField(blank=True, max_length=255)),
+                (
+                    "duration",
+                    models.DurationField(
+                        blank=True,
+                        help_text="How long the connection lasted, on disconnects and timeouts.",  # noqa: E501
+                        null=True,
+                    ),
+                ),
+                (
+                    "project",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="connection_events",
+                        to="src.project",
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ("-occurred_at",),
+                "indexes": [
+                    models.Index(
+                        fields=["project", "occurred_at"],
+                        name="src_connect_project_9bdcc3_idx",
+                    ),
+                ],
+            },
+        ),
+    ]
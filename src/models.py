@@ -1,15 +1,15 @@
 import logging
-import threading
-from datetime import datetime
+from datetime import datetime, timedelta
 
+from asgiref.sync import sync_to_async
 from django.contrib.auth.models import User
-from django.core.cache import cache
 from django.db import models
-from django.utils.timezone import now
 
+from src.connections import connection_registry
 from src.env import KEEP_ALIVE_TIMEOUT
 from src.funks import gen_default_nginx_conf as reset_default_nginx_conf
 from src.funks import gen_nginx_conf, gen_secret_key
+from src.ports import port_allocator
 
 
 class Project(models.Model):
@@ -24,30 +24,132 @@ class Project(models.Model):
     created_at: datetime = models.DateTimeField(auto_now_add=True)
     updated_at: datetime = models.DateTimeField(auto_now=True)
     last_connected_at: datetime = models.DateTimeField(null=True, blank=True)
+    cache_enabled: bool = models.BooleanField(
+        default=False,
+        help_text=(
+            "Cache responses allowed by their Cache-Control header at the edge. "
+            "Applies from the next connection."
+        ),
+    )
+    # written in batches by `manage.py run_scheduler`, see `src.history`
+    connection_count: int = models.PositiveIntegerField(default=0)
 
     def __str__(self) -> str:
         return self.domain
 
-    def connect(self, port: int) -> None:
-        self.last_connected_at = now()
-        self.save(update_fields=["last_connected_at"])
-
-        gen_nginx_conf(self.domain, port)
-        cache.set(key=self.domain, value=True, timeout=KEEP_ALIVE_TIMEOUT)
+    def connect(
+        self,
+        port: int | None = None,
+        socket: str | None = None,
+        *,
+        wait: bool = False,
+    ) -> bool | None:
+        if port:
+            port_allocator.renew(self.id, port, timeout=KEEP_ALIVE_TIMEOUT)
+        # reaped by `manage.py run_scheduler` once the heartbeats stop; registered
+        # first, for the reaper not to route the domain offline behind our back
+        connection_registry.register(self.id, self.domain, port, socket)
+        applied = gen_nginx_conf(
+            self.domain,
+            port,
+            socket=socket,
+            cache=self.cache_enabled,
+            wait=wait,
+        )
 
-        def disconnect_task() -> None:
-            if not cache.get(self.domain):
-                reset_default_nginx_conf(self.domain)
-            cache.delete(self.domain)
+        logging.info(
+            "Project %s connected on %s",
+            self.domain,
+            socket or f"port {port}",
+        )
+        return applied
 
-        threading.Timer(KEEP_ALIVE_TIMEOUT, disconnect_task).start()
+    async def aconnect(
+        self,
+        port: int | None = None,
+        socket: str | None = None,
+        *,
+        wait: bool = False,
+    ) -> bool | None:
+        if port:
+            await port_allocator.arenew(self.id, port, timeout=KEEP_ALIVE_TIMEOUT)
+        await connection_registry.aregister(self.id, self.domain, port, socket)
+        # writes config files and reloads nginx, off the event loop
+        applied = await sync_to_async(gen_nginx_conf, thread_sensitive=False)(
+            self.domain,
+            port,
+            socket=socket,
+            cache=self.cache_enabled,
+            wait=wait,
+        )
 
-        logging.info("Project %s connected on port %d", self.domain, port)
+        logging.info(
+            "Project %s connected on %s",
+            self.domain,
+            socket or f"port {port}",
+        )
+        return applied
 
     def disconnect(self) -> None:
         reset_default_nginx_conf(self.domain)
-        cache.delete(self.domain)
+        connection_registry.unregister(self.id, self.domain)
+        port_allocator.release(self.id)
         logging.info("Project %s disconnected", self.domain)
 
-    def keep_alive_connection(self) -> None:
-        cache.set(key=self.domain, value=True, timeout=KEEP_ALIVE_TIMEOUT)
+    async def adisconnect(self) -> None:
+        await sync_to_async(reset_default_nginx_conf, thread_sensitive=False)(
+            self.domain,
+        )
+        await connection_registry.aunregister(self.id, self.domain)
+        await port_allocator.arelease(self.id)
+        logging.info("Project %s disconnected", self.domain)
+
+    def keep_alive_connection(self) -> bool:
+        """Push the deadline of the live connection back, and renew its port.
+
+        :return: bool, False if the project has no live connection
+        """
+        if not connection_registry.heartbeat(self.id):
+            return False
+        port_allocator.renew(self.id, timeout=KEEP_ALIVE_TIMEOUT)
+        return True
+
+    async def akeep_alive_connection(self) -> bool:
+        if not await connection_registry.aheartbeat(self.id):
+            return False
+        await port_allocator.arenew(self.id, timeout=KEEP_ALIVE_TIMEOUT)
+        return True
+
+
+class ConnectionEvent(models.Model):
+    """A tunnel connecting, disconnecting or timing out, for capacity planning.
+
+    Append-only, buffered in Redis and inserted in batches, see `src.history`.
+    """
+
+    class Event(models.TextChoices):
+        CONNECTED = "connected", "Connected"
+        DISCONNECTED = "disconnected", "Disconnected"
+        TIMED_OUT = "timed_out", "Timed out"
+
+    project: Project = models.ForeignKey(
+        Project,
+        on_delete=models.CASCADE,
+        related_name="connection_events",
+    )
+    event: str = models.CharField(max_length=16, choices=Event.choices)
+    occurred_at: datetime = models.DateTimeField()
+    port: int | None = models.PositiveIntegerField(null=True, blank=True)
+    socket: str = models.CharField(max_length=255, blank=True)
+    duration: timedelta | None = models.DurationField(
+        null=True,
+        blank=True,
+        help_text="How long the connection lasted, on disconnects and timeouts.",
+    )
+
+    class Meta:
+        ordering = ("-occurred_at",)
+        indexes = (models.Index(fields=("project", "occurred_at")),)
+
+    def __str__(self) -> str:
+        return f"{self.project_id} {self.event} at {self.occurred_at}"
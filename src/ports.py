@@ -0,0 +1,417 @@
+import asyncio
+import socket
+import time
+from functools import cached_property
+
+from django_redis import get_redis_connection
+
+from src.async_redis import get_async_redis
+from src.env import (
+    PORT_LEASE_TIMEOUT,
+    STICKY_PORT_TTL,
+    STICKY_PORTS,
+    TUNNEL_PORT_RANGE_END,
+    TUNNEL_PORT_RANGE_START,
+)
+
+# KEYS: free set, leases zset (port -> expiry), owners hash (port -> project id),
+#       assigned hash (project id -> port), range string,
+#       sticky hash (project id -> preferred port, kept across releases),
+#       sticky zset (project id -> expiry of the preference)
+# ARGV: range start, range end, now, ...
+# Also run by the reaper of `src.connections`, to release ports with the leases.
+LEASE_PRELUDE = """
+local function release(port)
+    local owner = redis.call("HGET", KEYS[3], port)
+    redis.call("ZREM", KEYS[2], port)
+    redis.call("HDEL", KEYS[3], port)
+    if owner and redis.call("HGET", KEYS[4], owner) == port then
+        redis.call("HDEL", KEYS[4], owner)
+    end
+    local p = tonumber(port)
+    if p >= tonumber(ARGV[1]) and p <= tonumber(ARGV[2]) then
+        redis.call("SADD", KEYS[1], port)
+    end
+end
+
+local function ensure_pool()
+    local wanted = ARGV[1] .. "-" .. ARGV[2]
+    if redis.call("GET", KEYS[5]) == wanted then
+        return
+    end
+    redis.call("DEL", KEYS[1])
+    local batch = {}
+    for port = tonumber(ARGV[1]), tonumber(ARGV[2]) do
+        if not redis.call("ZSCORE", KEYS[2], port) then
+            batch[#batch + 1] = port
+            if #batch == 1000 then
+                redis.call("SADD", KEYS[1], unpack(batch))
+                batch = {}
+            end
+        end
+    end
+    if #batch > 0 then
+        redis.call("SADD", KEYS[1], unpack(batch))
+    end
+    redis.call("SET", KEYS[5], wanted)
+end
+
+local function reclaim_expired()
+    local expired = redis.call(
+        "ZRANGEBYSCORE", KEYS[2], "-inf", ARGV[3], "LIMIT", 0, 100
+    )
+    for _, port in ipairs(expired) do
+        release(port)
+    end
+    local forgotten = redis.call(
+        "ZRANGEBYSCORE", KEYS[7], "-inf", ARGV[3], "LIMIT", 0, 100
+    )
+    for _, project in ipairs(forgotten) do
+        redis.call("ZREM", KEYS[7], project)
+        redis.call("HDEL", KEYS[6], project)
+    end
+end
+"""
+
+# ARGV[4]: lease timeout, ARGV[5]: project id, ARGV[6]: "1" to reuse the sticky port,
+# ARGV[7]: lifetime of the sticky port after the last lease or renewal,
+# ARGV[8]: "1" to make the port the sticky port, "" when it is probed first
+_ACQUIRE = (
+    LEASE_PRELUDE
+    + """
+ensure_pool()
+reclaim_expired()
+local port = false
+if ARGV[6] == "1" then
+    local preferred = redis.call("HGET", KEYS[6], ARGV[5])
+    if preferred then
+        local owner = redis.call("HGET", KEYS[3], preferred)
+        if owner == ARGV[5]
+            or (not owner and redis.call("SREM", KEYS[1], preferred) == 1) then
+            port = preferred
+        end
+    end
+end
+if not port then
+    port = redis.call("SPOP", KEYS[1])
+end
+if not port then
+    return false
+end
+-- a port still leased to the project keeps its deadline if it is later
+redis.call("ZADD", KEYS[2], "GT", tonumber(ARGV[3]) + tonumber(ARGV[4]), port)
+redis.call("HSET", KEYS[3], port, ARGV[5])
+redis.call("HSET", KEYS[4], ARGV[5], port)
+if ARGV[8] == "1" then
+    redis.call("HSET", KEYS[6], ARGV[5], port)
+    redis.call("ZADD", KEYS[7], tonumber(ARGV[3]) + tonumber(ARGV[7]), ARGV[5])
+end
+return port
+"""
+)
+
+# ARGV[4]: project id, ARGV[5]: port that passed the probe, ARGV[6]: lifetime of
+# the sticky port
+_STICK = """
+if redis.call("HGET", KEYS[3], ARGV[5]) ~= ARGV[4] then
+    return false
+end
+redis.call("HSET", KEYS[6], ARGV[4], ARGV[5])
+redis.call("ZADD", KEYS[7], tonumber(ARGV[3]) + tonumber(ARGV[6]), ARGV[4])
+return ARGV[5]
+"""
+
+# ARGV[4]: project id, ARGV[5]: port found bound by the probe
+# The project no longer holds the port, but the lease is kept without an owner,
+# so the port only returns to the pool once it expires.
+_REJECT = """
+if redis.call("HGET", KEYS[3], ARGV[5]) ~= ARGV[4] then
+    return false
+end
+redis.call("HDEL", KEYS[3], ARGV[5])
+if redis.call("HGET", KEYS[4], ARGV[4]) == ARGV[5] then
+    redis.call("HDEL", KEYS[4], ARGV[4])
+end
+return ARGV[5]
+"""
+
+# ARGV[4]: lease timeout, ARGV[5]: project id, ARGV[6]: port ("" = assigned port),
+# ARGV[7]: lifetime of the sticky port
+_RENEW = """
+local port = ARGV[6]
+if port == "" then
+    port = redis.call("HGET", KEYS[4], ARGV[5])
+end
+if not port or redis.call("HGET", KEYS[3], port) ~= ARGV[5] then
+    return false
+end
+redis.call("ZADD", KEYS[2], "XX", tonumber(ARGV[3]) + tonumber(ARGV[4]), port)
+redis.call("ZADD", KEYS[7], "XX", tonumber(ARGV[3]) + tonumber(ARGV[7]), ARGV[5])
+return port
+"""
+
+# ARGV[4]: project id, ARGV[5]: port ("" = assigned port)
+_RELEASE = (
+    LEASE_PRELUDE
+    + """
+local port = ARGV[5]
+if port == "" then
+    port = redis.call("HGET", KEYS[4], ARGV[4])
+end
+if not port or redis.call("HGET", KEYS[3], port) ~= ARGV[4] then
+    return false
+end
+release(port)
+return port
+"""
+)
+
+
+def is_port_in_use(port: int) -> bool:
+    """Check if something is already listening on the port.
+
+    :param port: int
+    :return: bool
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        return sock.connect_ex(("127.0.0.1", port)) == 0
+
+
+class PortAllocator:
+    """Lease tunnel ports from a pool of free ports kept in Redis.
+
+    Every operation is a single server-side script, so a port is never handed
+    to two projects even when several workers allocate at the same time.
+    Leases expire on their own and are reclaimed by the next allocation, and
+    so do sticky ports, `sticky_ttl` after the last lease or renewal.
+
+    Methods prefixed with `a` do the same over the asyncio Redis client.
+    """
+
+    def __init__(
+        self,
+        namespace: str = "demos:ports",
+        start: int = TUNNEL_PORT_RANGE_START,
+        end: int = TUNNEL_PORT_RANGE_END,
+        lease_timeout: int = PORT_LEASE_TIMEOUT,
+        *,
+        probe: bool = True,
+        sticky: bool = STICKY_PORTS,
+        sticky_ttl: int = STICKY_PORT_TTL,
+    ) -> None:
+        self.namespace = namespace
+        self.start = start
+        self.end = end
+        self.lease_timeout = lease_timeout
+        self.probe = probe
+        self.sticky = sticky
+        self.sticky_ttl = sticky_ttl
+        self.keys = [
+            f"{namespace}:free",
+            f"{namespace}:leases",
+            f"{namespace}:owners",
+            f"{namespace}:assigned",
+            f"{namespace}:range",
+            f"{namespace}:sticky",
+            f"{namespace}:sticky_expiry",
+        ]
+
+    @cached_property
+    def redis(self):
+        return get_redis_connection("default")
+
+    @cached_property
+    def _acquire(self):
+        return self.redis.register_script(_ACQUIRE)
+
+    @cached_property
+    def _renew(self):
+        return self.redis.register_script(_RENEW)
+
+    @cached_property
+    def _release(self):
+        return self.redis.register_script(_RELEASE)
+
+    @cached_property
+    def _stick(self):
+        return self.redis.register_script(_STICK)
+
+    @cached_property
+    def _reject(self):
+        return self.redis.register_script(_REJECT)
+
+    def _args(self, *args) -> list:
+        return [self.start, self.end, time.time(), *args]
+
+    def acquire(self, project_id: int, timeout: int | None = None) -> int | None:
+        """Lease a free port to the project.
+
+        With `sticky` enabled the project gets the port it had last time
+        whenever that port is still free or still leased to it. With `probe`,
+        a port found bound by another process is given up for another one.
+
+        :param project_id: int
+        :param timeout: lease lifetime in seconds, defaults to `lease_timeout`
+        :return: int or None if the pool is exhausted
+        """
+        timeout = timeout or self.lease_timeout
+        sticky = self.sticky
+        for _ in range(10):
+            port = self._acquire(
+                keys=self.keys,
+                args=self._args(
+                    timeout,
+                    project_id,
+                    "1" if sticky else "",
+                    self.sticky_ttl,
+                    "1" if self.sticky and not self.probe else "",
+                ),
+            )
+            # the sticky port may still be bound by a stale tunnel
+            sticky = False
+            if port is None:
+                return None
+            if not self.probe:
+                return int(port)
+            if not is_port_in_use(int(port)):
+                if self.sticky:
+                    self._stick(
+                        keys=self.keys,
+                        args=self._args(project_id, port, self.sticky_ttl),
+                    )
+                return int(port)
+            # a port held by a process outside of the pool stays out of it until
+            # the lease expires, so it is skipped by the next few allocations
+            self._reject(keys=self.keys, args=self._args(project_id, port))
+        return None
+
+    async def aacquire(
+        self,
+        project_id: int,
+        timeout: int | None = None,  # noqa: ASYNC109, the lease lifetime
+    ) -> int | None:
+        timeout = timeout or self.lease_timeout
+        sticky = self.sticky
+        redis = get_async_redis()
+        script = redis.register_script(_ACQUIRE)
+        for _ in range(10):
+            port = await script(
+                keys=self.keys,
+                args=self._args(
+                    timeout,
+                    project_id,
+                    "1" if sticky else "",
+                    self.sticky_ttl,
+                    "1" if self.sticky and not self.probe else "",
+                ),
+            )
+            sticky = False
+            if port is None:
+                return None
+            if not self.probe:
+                return int(port)
+            if not await asyncio.to_thread(is_port_in_use, int(port)):
+                if self.sticky:
+                    await redis.register_script(_STICK)(
+                        keys=self.keys,
+                        args=self._args(project_id, port, self.sticky_ttl),
+                    )
+                return int(port)
+            await redis.register_script(_REJECT)(
+                keys=self.keys,
+                args=self._args(project_id, port),
+            )
+        return None
+
+    def renew(
+        self,
+        project_id: int,
+        port: int | None = None,
+        timeout: int | None = None,
+        pipe=None,
+    ) -> bool | None:
+        """Extend the lease the project holds on the port.
+
+        :param project_id: int
+        :param port: int, defaults to the port last leased to the project
+        :param timeout: lease lifetime in seconds, defaults to `lease_timeout`
+        :param pipe: redis pipeline to queue the renewal on instead
+        :return: bool, None with `pipe`
+        """
+        timeout = timeout or self.lease_timeout
+        renewed = self._renew(
+            keys=self.keys,
+            args=self._args(timeout, project_id, port or "", self.sticky_ttl),
+            client=pipe,
+        )
+        return None if pipe is not None else bool(renewed)
+
+    async def arenew(
+        self,
+        project_id: int,
+        port: int | None = None,
+        timeout: int | None = None,  # noqa: ASYNC109, the lease lifetime
+        pipe=None,
+    ) -> bool | None:
+        timeout = timeout or self.lease_timeout
+        script = get_async_redis().register_script(_RENEW)
+        renewed = await script(
+            keys=self.keys,
+            args=self._args(timeout, project_id, port or "", self.sticky_ttl),
+            client=pipe,
+        )
+        return None if pipe is not None else bool(renewed)
+
+    def release(self, project_id: int, port: int | None = None) -> int | None:
+        """Return the port to the pool if the project holds it.
+
+        :param project_id: int
+        :param port: int, defaults to the port last leased to the project
+        :return: the released port or None
+        """
+        port = self._release(keys=self.keys, args=self._args(project_id, port or ""))
+        return int(port) if port is not None else None
+
+    async def arelease(self, project_id: int, port: int | None = None) -> int | None:
+        script = get_async_redis().register_script(_RELEASE)
+        port = await script(keys=self.keys, args=self._args(project_id, port or ""))
+        return int(port) if port is not None else None
+
+    def owner(self, port: int | str) -> int | None:
+        """Get the project holding a live lease on the port.
+
+        :param port: int
+        :return: project id or None
+        """
+        pipe = self.redis.pipeline()
+        pipe.hget(self.keys[2], port)
+        pipe.zscore(self.keys[1], port)
+        owner, expires_at = pipe.execute()
+        if owner is None or expires_at is None or expires_at < time.time():
+            return None
+        return int(owner)
+
+    async def aowner(self, port: int | str) -> int | None:
+        pipe = get_async_redis().pipeline()
+        pipe.hget(self.keys[2], port)
+        pipe.zscore(self.keys[1], port)
+        owner, expires_at = await pipe.execute()
+        if owner is None or expires_at is None or expires_at < time.time():
+            return None
+        return int(owner)
+
+    def assigned(self, project_id: int) -> int | None:
+        """Get the port last leased to the project.
+
+        :param project_id: int
+        :return: int or None
+        """
+        port = self.redis.hget(self.keys[3], project_id)
+        return int(port) if port is not None else None
+
+    def reset(self) -> None:
+        """Drop the pool and every lease."""
+        self.redis.delete(*self.keys)
+
+
+port_allocator = PortAllocator()
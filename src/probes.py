@@ -0,0 +1,224 @@
+import asyncio
+import logging
+import time
+from functools import cached_property
+
+from django_redis import get_redis_connection
+
+from src.connections import connection_registry
+from src.env import PROBE_CONCURRENCY, PROBE_FAILURES, PROBE_TIMEOUT
+from src.funks import gen_default_nginx_confs, gen_nginx_conf
+from src.models import Project
+
+
+def _decode_state(state) -> dict | None:
+    if not state:
+        return None
+    return {
+        "rtt": float(state[b"rtt"]) if state[b"rtt"] else None,
+        "failures": int(state[b"failures"]),
+        "healthy": state[b"healthy"] == b"1",
+        "probed_at": float(state[b"probed_at"]),
+    }
+
+
+class TunnelProber:
+    """Probe every live tunnel, and route the broken ones offline.
+
+    A probe sends a HEAD request through the tunnel and waits for the status
+    line: it fails when the SSH forward is gone, and when sshd accepts the
+    connection but the client cannot reach its local app. The probes of a
+    round run concurrently, at most `concurrency` at once.
+
+    The state of a connection is a hash (rtt, failures, healthy, probed_at),
+    reset whenever the project connects again. After `failures` failed probes
+    in a row the domain is routed to the offline page, and back to the tunnel
+    on the next successful probe.
+    """
+
+    def __init__(
+        self,
+        namespace: str = "demos:probes",
+        timeout: float = PROBE_TIMEOUT,
+        concurrency: int = PROBE_CONCURRENCY,
+        failures: int = PROBE_FAILURES,
+        state_ttl: int = 3600,
+    ) -> None:
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.failures = failures
+        self.state_ttl = state_ttl
+        self.prefix = f"{namespace}:"
+
+    @cached_property
+    def redis(self):
+        return get_redis_connection("default")
+
+    async def probe(self, connection: dict) -> float | None:
+        """Send a request through a tunnel.
+
+        :param connection: dict, as listed by the connection registry
+        :return: float, seconds to the status line, None if the probe failed
+        """
+        started = time.perf_counter()
+        writer = None
+        try:
+            async with asyncio.timeout(self.timeout):
+                if connection["port"]:
+                    reader, writer = await asyncio.open_connection(
+                        "127.0.0.1",
+                        connection["port"],
+                    )
+                else:
+                    reader, writer = await asyncio.open_unix_connection(
+                        connection["socket"],
+                    )
+                writer.write(
+                    f"HEAD / HTTP/1.0\r\nHost: {connection['domain']}\r\n"
+                    "User-Agent: demos-probe\r\n\r\n".encode(),
+                )
+                await writer.drain()
+                status_line = await reader.readline()
+        except (OSError, TimeoutError):
+            return None
+        finally:
+            if writer is not None:
+                writer.close()
+        if not status_line.startswith(b"HTTP/"):
+            return None
+        return time.perf_counter() - started
+
+    async def probe_all(self, connections: list[dict]) -> list[float | None]:
+        """Probe many tunnels concurrently.
+
+        :param connections: list of dicts
+        :return: list of round trip times, None for the failed probes
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def probe(connection) -> float | None:
+            async with semaphore:
+                return await self.probe(connection)
+
+        return await asyncio.gather(*(probe(c) for c in connections))
+
+    def run_once(self) -> int:
+        """Probe every live tunnel once.
+
+        :return: int, number of tunnels probed
+        """
+        connections = connection_registry.active()
+        if not connections:
+            return 0
+        results = asyncio.run(self.probe_all(connections))
+        unhealthy, recovered = self.record(connections, results)
+        if unhealthy:
+            gen_default_nginx_confs([c["domain"] for c in unhealthy])
+        for connection in unhealthy:
+            connection_registry.publish(connection["domain"], {"event": "unhealthy"})
+            logging.warning("Project %s failed its probes", connection["domain"])
+        if recovered:
+            cache = dict(
+                Project.objects.filter(
+                    id__in=[c["project_id"] for c in recovered],
+                ).values_list("id", "cache_enabled"),
+            )
+            for connection in recovered:
+                gen_nginx_conf(
+                    connection["domain"],
+                    connection["port"],
+                    socket=connection["socket"] or None,
+                    cache=cache.get(connection["project_id"], False),
+                )
+                connection_registry.publish(connection["domain"], {"event": "healthy"})
+                logging.info("Project %s recovered", connection["domain"])
+        return len(connections)
+
+    def record(
+        self,
+        connections: list[dict],
+        results: list[float | None],
+    ) -> tuple[list[dict], list[dict]]:
+        """Save the results of a round of probes.
+
+        :param connections: list of dicts
+        :param results: list of round trip times, None for the failed probes
+        :return: tuple(connections that turned unhealthy, that recovered)
+        """
+        pipe = self.redis.pipeline()
+        for connection in connections:
+            pipe.hgetall(f"{self.prefix}{connection['project_id']}")
+        states = pipe.execute()
+
+        now = time.time()
+        unhealthy, recovered = [], []
+        pipe = self.redis.pipeline()
+        for connection, rtt, state in zip(connections, results, states, strict=True):
+            failures, healthy = 0, True
+            # the state of the previous connection does not carry over
+            if state and float(state[b"connected_at"]) == connection["connected_at"]:
+                failures = int(state[b"failures"])
+                healthy = state[b"healthy"] == b"1"
+            if rtt is not None:
+                failures = 0
+                if not healthy:
+                    recovered.append(connection)
+                    healthy = True
+            else:
+                failures += 1
+                if healthy and failures >= self.failures:
+                    unhealthy.append(connection)
+                    healthy = False
+            key = f"{self.prefix}{connection['project_id']}"
+            pipe.hset(
+                key,
+                mapping={
+                    "connected_at": connection["connected_at"],
+                    "rtt": "" if rtt is None else rtt,
+                    "failures": failures,
+                    "healthy": int(healthy),
+                    "probed_at": now,
+                },
+            )
+            pipe.expire(key, self.state_ttl)
+        pipe.execute()
+        return unhealthy, recovered
+
+    def run(self, interval: float) -> None:
+        """Probe every live tunnel, forever.
+
+        :param interval: float, seconds between the start of two rounds
+        """
+        while True:
+            started = time.monotonic()
+            try:
+                self.run_once()
+            except Exception:
+                logging.exception("Failed to probe the tunnels")
+            time.sleep(max(interval - (time.monotonic() - started), 0))
+
+    def state(self, project_id: int) -> dict | None:
+        """Get the result of the last probe of a project.
+
+        :param project_id: int
+        :return: dict(rtt, failures, healthy, probed_at), None if never probed
+        """
+        return _decode_state(self.redis.hgetall(f"{self.prefix}{project_id}"))
+
+    def states(self, project_ids: list[int]) -> dict[int, dict]:
+        """Get the result of the last probe of many projects, in one round trip.
+
+        :param project_ids: list of int
+        :return: dict(project id: state), without the projects never probed
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        for project_id in project_ids:
+            pipe.hgetall(f"{self.prefix}{project_id}")
+        return {
+            project_id: _decode_state(state)
+            for project_id, state in zip(project_ids, pipe.execute(), strict=True)
+            if state
+        }
+
+
+tunnel_prober = TunnelProber()
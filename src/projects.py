@@ -0,0 +1,135 @@
+import hashlib
+import hmac
+from dataclasses import asdict, dataclass
+
+from django.core.cache import cache
+
+from src.models import Project
+
+PROJECT_CACHE_KEY = "project:{}"
+PROJECT_CACHE_TIMEOUT = 24 * 60 * 60
+
+
+def get_secret_key_digest(secret_key: str) -> str:
+    """Hash a secret key, so the cache never holds the key itself.
+
+    :param secret_key: string
+    :return: string, hex digest
+    """
+    return hashlib.sha256(secret_key.encode()).hexdigest()
+
+
+@dataclass(frozen=True)
+class ProjectInfo:
+    """What the tunnel API needs to know about a project, cached by domain."""
+
+    id: int
+    domain: str
+    user_id: int
+    username: str
+    secret_key_digest: str
+    cache_enabled: bool
+
+    def check_secret_key(self, secret_key: str | None) -> bool:
+        """Check the secret key sent by a client.
+
+        :param secret_key: string
+        :return: bool
+        """
+        if not secret_key:
+            return False
+        return hmac.compare_digest(
+            get_secret_key_digest(secret_key),
+            self.secret_key_digest,
+        )
+
+    def to_project(self) -> Project:
+        """Get a model instance to connect or disconnect, without a query.
+
+        Fields that are not cached are deferred.
+
+        :return: Project
+        """
+        return Project.from_db(
+            None,
+            ["id", "domain", "user_id", "cache_enabled"],
+            [self.id, self.domain, self.user_id, self.cache_enabled],
+        )
+
+
+_PROJECT_INFO_FIELDS = (
+    "id",
+    "domain",
+    "user_id",
+    "user__username",
+    "secret_key",
+    "cache_enabled",
+)
+
+
+def _to_project_info(row) -> ProjectInfo:
+    return ProjectInfo(
+        id=row.id,
+        domain=row.domain,
+        user_id=row.user_id,
+        username=row.user__username,
+        secret_key_digest=get_secret_key_digest(row.secret_key),
+        cache_enabled=row.cache_enabled,
+    )
+
+
+def get_project_info(domain: str | None) -> ProjectInfo | None:
+    """Get a project by domain, from the cache or else the database.
+
+    The entry is dropped by the signals whenever the project or its user is
+    saved or deleted, see `invalidate_project_info`.
+
+    :param domain: string
+    :return: ProjectInfo, None if no project has the domain
+    """
+    if not domain:
+        return None
+    key = PROJECT_CACHE_KEY.format(domain)
+    data = cache.get(key)
+    if data is not None:
+        return ProjectInfo(**data)
+
+    project = (
+        Project.objects.filter(domain=domain)
+        .values_list(*_PROJECT_INFO_FIELDS, named=True)
+        .first()
+    )
+    if project is None:
+        return None
+    info = _to_project_info(project)
+    cache.set(key, asdict(info), timeout=PROJECT_CACHE_TIMEOUT)
+    return info
+
+
+async def aget_project_info(domain: str | None) -> ProjectInfo | None:
+    if not domain:
+        return None
+    key = PROJECT_CACHE_KEY.format(domain)
+    data = await cache.aget(key)
+    if data is not None:
+        return ProjectInfo(**data)
+
+    project = await (
+        Project.objects.filter(domain=domain)
+        .values_list(*_PROJECT_INFO_FIELDS, named=True)
+        .afirst()
+    )
+    if project is None:
+        return None
+    info = _to_project_info(project)
+    await cache.aset(key, asdict(info), timeout=PROJECT_CACHE_TIMEOUT)
+    return info
+
+
+def invalidate_project_info(*domains: str) -> None:
+    """Drop the cached projects of the domains.
+
+    :param domains: strings
+    :return: None
+    """
+    cache.delete_many([PROJECT_CACHE_KEY.format(domain) for domain in domains])
@@ -0,0 +1,171 @@
+import asyncio
+import contextlib
+import json
+import logging
+from pathlib import Path
+
+import redis.asyncio as aioredis
+from django.conf import settings
+
+from src.funks import OFFLINE_PAGE
+from src.routes import OFFLINE, ROUTES_CHANNEL, ROUTES_KEY
+
+CONNECT_TIMEOUT = 5
+HEAD_TIMEOUT = 30
+CHUNK_SIZE = 64 * 1024
+# seconds between two attempts to watch the routes, doubled up to the maximum
+RETRY_DELAY = 1
+MAX_RETRY_DELAY = 30
+
+
+def parse_host(head: bytes) -> str | None:
+    """Get the host a request head is addressed to, without the port.
+
+    :param head: bytes, request line and headers
+    :return: string or None
+    """
+    for line in head.split(b"\r\n")[1:]:
+        name, _, value = line.partition(b":")
+        if name.strip().lower() == b"host":
+            return value.strip().decode("latin-1").rsplit(":", 1)[0].lower()
+    return None
+
+
+async def open_upstream(upstream: str) -> tuple:
+    """Connect to a tunnel upstream as formatted by `format_upstream`.
+
+    :param upstream: string, "127.0.0.1:<port>" or "unix:<path>:"
+    :return: tuple(reader, writer)
+    """
+    if upstream.startswith("unix:"):
+        connection = asyncio.open_unix_connection(upstream[5:-1])
+    else:
+        host, _, port = upstream.rpartition(":")
+        connection = asyncio.open_connection(host, int(port))
+    return await asyncio.wait_for(connection, CONNECT_TIMEOUT)
+
+
+async def pipe(reader, writer) -> None:
+    """Copy a stream until EOF, then half-close the other side."""
+    with contextlib.suppress(ConnectionError):
+        while data := await reader.read(CHUNK_SIZE):
+            writer.write(data)
+            await writer.drain()
+        if writer.can_write_eof():
+            writer.write_eof()
+
+
+class TunnelProxy:
+    """Reverse proxy routing requests by Host header to the tunnel upstreams.
+
+    The routing table lives in memory and follows the routes stored in Redis
+    through pub/sub, so connects and disconnects apply without any reload.
+    Once a request is routed, both directions are streamed as they are, which
+    covers request/response bodies of any size and protocol upgrades.
+    """
+
+    def __init__(self, routes: dict[str, str] | None = None) -> None:
+        self.routes = routes if routes is not None else {}
+        # (mtime, content) of the offline page as last read
+        self.offline_page: tuple[int, bytes] | None = None
+
+    async def serve(self, host: str, port: int) -> None:
+        server = await asyncio.start_server(self.handle, host, port)
+        async with server:
+            await asyncio.gather(server.serve_forever(), self.watch_routes())
+
+    async def watch_routes(self) -> None:
+        """Follow the routes stored in Redis, for as long as the proxy runs.
+
+        Whatever goes wrong is logged and the routes are loaded again, after a
+        delay doubling with each failure in a row.
+        """
+        delay = RETRY_DELAY
+        while True:
+            client = aioredis.from_url(settings.CACHES["default"]["LOCATION"])
+            try:
+                async with client.pubsub() as pubsub:
+                    # subscribe first so no change is lost while loading
+                    await pubsub.subscribe(ROUTES_CHANNEL)
+                    routes = await client.hgetall(ROUTES_KEY)
+                    self.routes = {
+                        domain.decode(): upstream.decode()
+                        for domain, upstream in routes.items()
+                    }
+                    logging.info("Proxy loaded %d routes", len(self.routes))
+                    delay = RETRY_DELAY
+                    async for message in pubsub.listen():
+                        if message["type"] == "message":
+                            self.apply(json.loads(message["data"]))
+            except Exception:
+                logging.exception("Stopped watching the routes, retrying in %ds", delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+            finally:
+                await client.aclose()
+
+    def apply(self, change: dict) -> None:
+        if change["upstream"] is None:
+            self.routes.pop(change["domain"], None)
+        else:
+            self.routes[change["domain"]] = change["upstream"]
+
+    async def handle(self, reader, writer) -> None:
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), HEAD_TIMEOUT)
+            host = parse_host(head)
+            upstream = self.routes.get(host)
+            if upstream is None:
+                return
+            if upstream == OFFLINE:
+                await self.offline(writer)
+                return
+            try:
+                upstream_reader, upstream_writer = await open_upstream(upstream)
+            except (OSError, TimeoutError):
+                await self.offline(writer)
+                return
+            try:
+                upstream_writer.write(head)
+                await asyncio.gather(
+                    pipe(reader, upstream_writer),
+                    pipe(upstream_reader, writer),
+                )
+            finally:
+                upstream_writer.close()
+        except (
+            asyncio.IncompleteReadError,
+            asyncio.LimitOverrunError,
+            ConnectionError,
+            TimeoutError,
+        ):
+            pass
+        finally:
+            writer.close()
+
+    async def get_offline_page(self) -> bytes | None:
+        """Get the offline page, read again whenever the file changed.
+
+        :return: bytes, None if it could never be read
+        """
+        path = Path(OFFLINE_PAGE)
+        try:
+            mtime = (await asyncio.to_thread(path.stat)).st_mtime_ns
+            if self.offline_page is None or self.offline_page[0] != mtime:
+                self.offline_page = (mtime, await asyncio.to_thread(path.read_bytes))
+        except OSError:
+            logging.warning("Could not read the offline page %s", OFFLINE_PAGE)
+        return self.offline_page[1] if self.offline_page else None
+
+    async def offline(self, writer) -> None:
+        body = await self.get_offline_page()
+        if body is None:
+            return
+        writer.write(
+            b"HTTP/1.1 502 Bad Gateway\r\n"
+            b"Content-Type: text/html; charset=utf-8\r\n"
+            b"Content-Length: %d\r\n"
+            b"Connection: close\r\n\r\n" % len(body),
+        )
+        writer.write(body)
+        await writer.drain()
@@ -0,0 +1,83 @@
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+
+import jinja2
+
+TEMPLATES_DIR = Path(__file__).resolve().parent / "templates"
+
+# template path -> (mtime, compiled template)
+_templates: dict[Path, tuple[int, jinja2.Template]] = {}
+# file path -> ((mtime, size) when written, sha256 of the content)
+_digests: dict[Path, tuple[tuple[int, int], bytes]] = {}
+
+
+def get_template(name) -> jinja2.Template:
+    """Get a compiled template, compiling it again only when the file changed.
+
+    :param name: string, file name in the templates directory
+    :return: jinja2.Template
+    """
+    path = TEMPLATES_DIR / name
+    mtime = path.stat().st_mtime_ns
+    cached = _templates.get(path)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, jinja2.Template(path.read_text()))
+        _templates[path] = cached
+    return cached[1]
+
+
+def _file_digest(path: Path) -> bytes | None:
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+    cached = _digests.get(path)
+    if cached is not None and cached[0] == (stat.st_mtime_ns, stat.st_size):
+        return cached[1]
+    return hashlib.sha256(path.read_bytes()).digest()
+
+
+def write_file(path, content: str | bytes, mode: int | None = None) -> bool:
+    """Replace a file atomically, unless it already has this content.
+
+    The content goes to a temporary file in the same directory which is then
+    renamed over the target, so readers never see a partially written file.
+
+    :param path: string or Path
+    :param content: string or bytes
+    :param mode: int, permissions of the file
+    :return: whether the file was written
+    """
+    path = Path(path)
+    data = content.encode() if isinstance(content, str) else content
+    digest = hashlib.sha256(data).digest()
+    if _file_digest(path) == digest:
+        return False
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        Path(tmp_path).chmod(0o644 if mode is None else mode)
+        Path(tmp_path).replace(path)
+    except BaseException:
+        Path(tmp_path).unlink(missing_ok=True)
+        raise
+
+    stat = path.stat()
+    _digests[path] = ((stat.st_mtime_ns, stat.st_size), digest)
+    return True
+
+
+def render_to_file(name, path, mode: int | None = None, **context) -> bool:
+    """Render a template into a file, see `write_file`.
+
+    :param name: string, file name in the templates directory
+    :param path: string or Path
+    :param mode: int, permissions of the file
+    :return: whether the file was written
+    """
+    return write_file(path, get_template(name).render(**context), mode=mode)
@@ -0,0 +1,131 @@
+import json
+from pathlib import Path
+
+from django_redis import get_redis_connection
+
+from src.env import NGINX_ROUTES_FILE
+from src.render import write_file
+
+ROUTES_KEY = "demos:routes"
+ROUTES_CHANNEL = "demos:routes"
+
+# upstream of a known project without a live tunnel
+OFFLINE = "-"
+
+
+def format_upstream(port=None, socket=None) -> str:
+    """Format the upstream nginx should proxy a domain to.
+
+    :param port: int
+    :param socket: string, unix socket path used instead of the port
+    :return: string
+    """
+    if socket:
+        return f"unix:{socket}:"
+    if port:
+        return f"127.0.0.1:{port}"
+    return OFFLINE
+
+
+def set_route(domain, port=None, socket=None) -> None:
+    """Route a domain to its tunnel, or to the offline page.
+
+    :param domain: string
+    :param port: int
+    :param socket: string
+    :return: None
+    """
+    upstream = format_upstream(port, socket)
+    pipe = get_redis_connection("default").pipeline()
+    pipe.hset(ROUTES_KEY, domain, upstream)
+    pipe.publish(ROUTES_CHANNEL, json.dumps({"domain": domain, "upstream": upstream}))
+    pipe.execute()
+
+
+def remove_route(domain) -> None:
+    """Forget a domain.
+
+    :param domain: string
+    :return: None
+    """
+    pipe = get_redis_connection("default").pipeline()
+    pipe.hdel(ROUTES_KEY, domain)
+    pipe.publish(ROUTES_CHANNEL, json.dumps({"domain": domain, "upstream": None}))
+    pipe.execute()
+
+
+def get_routes() -> dict[str, str]:
+    """Get the upstream of every known domain.
+
+    :return: dict(domain: upstream)
+    """
+    return {
+        domain.decode(): upstream.decode()
+        for domain, upstream in get_redis_connection("default")
+        .hgetall(ROUTES_KEY)
+        .items()
+    }
+
+
+class RouteMap:
+    """The nginx route map, kept in memory to change a few routes at a time.
+
+    A change is applied to the routes in memory and written with `write_file`,
+    so a route that did not change neither touches the file nor reloads nginx,
+    and no change reads every route back from Redis. The routes are read from
+    Redis again only when the file was replaced by another process since this
+    one wrote it, e.g. another worker when the edge agent is disabled.
+
+    :param path: string or Path, the file included by the `map` block
+    """
+
+    def __init__(self, path) -> None:
+        self.path = Path(path)
+        self.routes: dict[str, str] = {}
+        # (inode, mtime, size) of the file as this process last wrote it
+        self.written = None
+
+    def _stat(self) -> tuple[int, int, int] | None:
+        try:
+            stat = self.path.stat()
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def update(self, routes: dict[str, str | None]) -> bool:
+        """Change the upstream of some domains.
+
+        :param routes: dict(domain: upstream, or None to remove the domain)
+        :return: whether the file was written
+        """
+        if self.written is None or self.written != self._stat():
+            return self.rebuild()
+        changed = False
+        for domain, upstream in routes.items():
+            if upstream is None:
+                changed = self.routes.pop(domain, None) is not None or changed
+            elif self.routes.get(domain) != upstream:
+                self.routes[domain] = upstream
+                changed = True
+        return self.write() if changed else False
+
+    def rebuild(self) -> bool:
+        """Write every route stored in Redis.
+
+        :return: whether the file was written
+        """
+        self.routes = get_routes()
+        return self.write()
+
+    def write(self) -> bool:
+        written = write_file(
+            self.path,
+            "".join(
+                f"{domain} {upstream};\n" for domain, upstream in self.routes.items()
+            ),
+        )
+        self.written = self._stat()
+        return written
+
+
+route_map = RouteMap(NGINX_ROUTES_FILE)
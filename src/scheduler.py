@@ -0,0 +1,176 @@
+import json
+import logging
+import time
+from collections.abc import Callable
+from functools import cached_property
+
+from django_redis import get_redis_connection
+
+# KEYS: due zset (job id -> due time), jobs hash (job id -> payload),
+#       running zset (job id -> lease deadline)
+# ARGV: now, batch size, lease
+_CLAIM = """
+-- jobs whose runner died before finishing them are due again
+local stale = redis.call("ZRANGEBYSCORE", KEYS[3], "-inf", ARGV[1], "LIMIT", 0, ARGV[2])
+for _, id in ipairs(stale) do
+    redis.call("ZREM", KEYS[3], id)
+    redis.call("ZADD", KEYS[1], "NX", ARGV[1], id)
+end
+local ids = redis.call("ZRANGEBYSCORE", KEYS[1], "-inf", ARGV[1], "LIMIT", 0, ARGV[2])
+local jobs = {}
+for _, id in ipairs(ids) do
+    redis.call("ZREM", KEYS[1], id)
+    redis.call("ZADD", KEYS[3], tonumber(ARGV[1]) + tonumber(ARGV[3]), id)
+    jobs[#jobs + 1] = id
+    jobs[#jobs + 1] = redis.call("HGET", KEYS[2], id)
+end
+return jobs
+"""
+
+# ARGV: job ids
+_ACK = """
+for _, id in ipairs(ARGV) do
+    redis.call("ZREM", KEYS[3], id)
+    -- unless it was scheduled again while running
+    if not redis.call("ZSCORE", KEYS[1], id) then
+        redis.call("HDEL", KEYS[2], id)
+    end
+end
+"""
+
+# task name -> function
+_tasks: dict[str, Callable] = {}
+
+
+def scheduled_task(func) -> Callable:
+    """Register a function the scheduler can run, see `Scheduler.schedule`."""
+    _tasks[func.__name__] = func
+    return func
+
+
+class Scheduler:
+    """Run registered tasks at a later time, from Redis.
+
+    Jobs are kept in a sorted set by due time, so they survive restarts of
+    the workers that scheduled them. `manage.py run_scheduler` claims due jobs
+    in batches with a single script: a job is run by one runner only, and
+    runs again only if that runner died before finishing it.
+    """
+
+    def __init__(
+        self,
+        namespace: str = "demos:scheduler",
+        batch_size: int = 100,
+        lease: int = 60,
+    ) -> None:
+        self.batch_size = batch_size
+        self.lease = lease
+        self.keys = [
+            f"{namespace}:due",
+            f"{namespace}:jobs",
+            f"{namespace}:running",
+        ]
+
+    @cached_property
+    def redis(self):
+        return get_redis_connection("default")
+
+    @cached_property
+    def _claim(self):
+        return self.redis.register_script(_CLAIM)
+
+    @cached_property
+    def _ack(self):
+        return self.redis.register_script(_ACK)
+
+    def schedule(self, task, delay, *args, job_id=None, **kwargs) -> str:
+        """Run a task after a delay.
+
+        Scheduling again with the same `job_id` replaces the pending job.
+
+        :param task: function registered with `scheduled_task`
+        :param delay: float, seconds
+        :param job_id: string, defaults to the task name and arguments
+        :return: string, job id
+        """
+        payload = json.dumps({"task": task.__name__, "args": args, "kwargs": kwargs})
+        job_id = job_id or f"{task.__name__}:{payload}"
+        pipe = self.redis.pipeline()
+        pipe.hset(self.keys[1], job_id, payload)
+        pipe.zadd(self.keys[0], {job_id: time.time() + delay})
+        pipe.execute()
+        return job_id
+
+    def postpone(self, job_id, delay) -> bool:
+        """Push a pending job back.
+
+        :param job_id: string
+        :param delay: float, seconds from now
+        :return: whether the job was pending
+        """
+        pipe = self.redis.pipeline()
+        pipe.zadd(self.keys[0], {job_id: time.time() + delay}, xx=True)
+        pipe.zscore(self.keys[0], job_id)
+        return pipe.execute()[1] is not None
+
+    def cancel(self, job_id) -> None:
+        """Drop a pending job.
+
+        :param job_id: string
+        :return: None
+        """
+        pipe = self.redis.pipeline()
+        pipe.zrem(self.keys[0], job_id)
+        pipe.hdel(self.keys[1], job_id)
+        pipe.execute()
+
+    def run(self, *periodic: Callable[[], int]) -> None:
+        """Run the jobs as they fall due, forever.
+
+        :param periodic: functions called on every round, returning how much
+            work they did, e.g. reapers
+        """
+        while True:
+            done = self.run_once()
+            for func in periodic:
+                try:
+                    done += func()
+                except Exception:
+                    logging.exception("Failed to run %s", func.__name__)
+            if not done:
+                time.sleep(self.idle_time())
+
+    def run_once(self) -> int:
+        """Run a batch of due jobs.
+
+        :return: int, number of jobs run
+        """
+        claimed = self._claim(
+            keys=self.keys,
+            args=[time.time(), self.batch_size, self.lease],
+        )
+        job_ids = claimed[::2]
+        for job_id, payload in zip(job_ids, claimed[1::2], strict=True):
+            if payload is None:
+                continue
+            job = json.loads(payload)
+            try:
+                _tasks[job["task"]](*job["args"], **job["kwargs"])
+            except Exception:
+                logging.exception("Failed to run scheduled job %s", job_id.decode())
+        if job_ids:
+            self._ack(keys=self.keys, args=job_ids)
+        return len(job_ids)
+
+    def idle_time(self) -> float:
+        """Get how long to wait for the next job, at most a second.
+
+        :return: float, seconds
+        """
+        next_job = self.redis.zrange(self.keys[0], 0, 0, withscores=True)
+        if not next_job:
+            return 1
+        return min(max(next_job[0][1] - time.time(), 0.01), 1)
+
+
+scheduler = Scheduler()
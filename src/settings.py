@@ -12,7 +12,16 @@ https://docs.djangoproject.com/en/5.0/ref/settings/
 import re
 from pathlib import Path
 
-from src.env import HTTP_HOST
+from src.env import (
+    HTTP_HOST,
+    LOG_MAX_BYTES,
+    LOG_QUEUE,
+    LOG_SAMPLE_EVERY,
+    LOG_SAMPLED_URL_NAMES,
+    REDIS_DB,
+    REDIS_HOST,
+    REDIS_PORT,
+)
 from src.env import SECRET_KEY as ENV_SECRET_KEY
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -48,6 +57,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     "src.middleware.disallowed_host.DisallowedHostMiddleware",
+    "src.middleware.heartbeat.HeartbeatMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -90,10 +100,6 @@ DATABASES = {
 }
 
 # REDIS
-REDIS_HOST = "localhost"
-REDIS_PORT = "6379"
-REDIS_DB = "0"
-
 CACHES = {
     "default": {
         "BACKEND": "django_redis.cache.RedisCache",
@@ -189,6 +195,10 @@ LOGGING_DIR.mkdir(parents=True, exist_ok=True)
 # List of urls that will not be logged
 LOGGING_EXCEPT_URL_NAME_LIST = ("jsi18n",)
 
+# List of urls logged only one request in LOGGING_SAMPLE_EVERY, e.g. heartbeats
+LOGGING_SAMPLED_URL_NAME_LIST = tuple(LOG_SAMPLED_URL_NAMES)
+LOGGING_SAMPLE_EVERY = LOG_SAMPLE_EVERY
+
 LOGGING = {
     "version": 1,
     "disable_existing_loggers": True,
@@ -222,3 +232,21 @@ LOGGING = {
         },
     },
 }
+
+if LOG_QUEUE:
+    LOGGING["formatters"]["json"] = {"()": "src.logs.JsonFormatter"}
+    LOGGING["formatters"]["message"] = {"format": "%(message)s"}
+    LOGGING["handlers"]["file"].update(
+        formatter="message",
+        maxBytes=LOG_MAX_BYTES,
+        use_gzip=True,
+    )
+    LOGGING["handlers"]["console"]["formatter"] = "message"
+    # handlers are configured in alphabetical order, "queue" after its targets
+    LOGGING["handlers"]["queue"] = {
+        "()": "src.logs.BackgroundHandler",
+        "formatter": "json",
+        "console": "cfg://handlers.console",
+        "file": "cfg://handlers.file",
+    }
+    LOGGING["loggers"][""]["handlers"] = ["queue"]
@@ -6,12 +6,14 @@ from django.dispatch import receiver
 from src.funks import (
     create_user_profile,
     delete_user_profile,
-    gen_502_page,
     gen_default_nginx_conf,
-    remove_502_page,
     remove_nginx_conf,
 )
-from src.models import Project
+from src.models import ConnectionEvent, Project
+from src.projects import invalidate_project_info
+
+# fields of the projects cached for the tunnel API
+CACHED_PROJECT_FIELDS = {"domain", "user", "secret_key", "cache_enabled"}
 
 
 @receiver(post_save, sender=User)
@@ -21,11 +23,12 @@ def create_user_profile_signal(sender, instance, created, **kwargs) -> None:
         create_user_profile(instance.username)
 
         # grant permission
-        content_type = ContentType.objects.get_for_models(Project)
+        content_type = ContentType.objects.get_for_models(Project, ConnectionEvent)
         permissions = (
             "add_project",
             "change_project",
             "delete_project",
+            "view_connectionevent",
         )
         permission = Permission.objects.filter(
             codename__in=permissions,
@@ -37,6 +40,18 @@ def create_user_profile_signal(sender, instance, created, **kwargs) -> None:
         instance.save()
 
 
+@receiver(post_save, sender=User)
+def invalidate_user_projects_signal(sender, instance, created, **kwargs) -> None:
+    _ = sender
+    update_fields = kwargs.get("update_fields")
+    # e.g. logins only update last_login
+    if created or (update_fields is not None and "username" not in update_fields):
+        return
+    invalidate_project_info(
+        *Project.objects.filter(user=instance).values_list("domain", flat=True),
+    )
+
+
 @receiver(post_delete, sender=User)
 def delete_user_profile_signal(sender, instance, **kwargs) -> None:
     _ = (sender, kwargs)  # unused
@@ -45,16 +60,29 @@ def delete_user_profile_signal(sender, instance, **kwargs) -> None:
 
 @receiver(pre_save, sender=Project)
 def save_project_signal(sender, instance, **kwargs) -> None:
-    _ = (sender, kwargs)  # unused
+    _ = sender
+    update_fields = kwargs.get("update_fields")
+    # e.g. connections only update last_connected_at
+    if update_fields is not None and "domain" not in update_fields:
+        return
     if instance.pk:
         old_domain = Project.objects.get(id=instance.id).domain
     if not instance.pk or old_domain != instance.domain:
-        gen_502_page(instance.domain)
         gen_default_nginx_conf(instance.domain)
+        if instance.pk:
+            invalidate_project_info(old_domain)
+
+
+@receiver(post_save, sender=Project)
+def invalidate_project_signal(sender, instance, **kwargs) -> None:
+    _ = sender
+    update_fields = kwargs.get("update_fields")
+    if update_fields is None or CACHED_PROJECT_FIELDS & set(update_fields):
+        invalidate_project_info(instance.domain)
 
 
 @receiver(post_delete, sender=Project)
 def delete_project_signal(sender, instance, **kwargs) -> None:
     _ = (sender, kwargs)  # unused
-    remove_502_page(instance.domain)
     remove_nginx_conf(instance.domain)
+    invalidate_project_info(instance.domain)
@@ -0,0 +1,547 @@
+import io
+import os
+import subprocess
+import tempfile
+from contextlib import redirect_stderr, redirect_stdout
+from pathlib import Path
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import User
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.urls import resolve, reverse
+
+from src import authorized_keys
+from src.connections import connection_registry, reap_expired_connections
+from src.edge import EDGE_APPLIED, EdgeAgent
+from src.funks import gen_nginx_server_conf
+from src.keys import (
+    InvalidPublicKeyError,
+    create_ca_key,
+    generate_key_pair,
+    sign_public_key,
+)
+from src.middleware.log import RequestLoggerMiddleware
+from src.models import Project
+from src.ports import PortAllocator, port_allocator
+from src.projects import get_project_info, invalidate_project_info
+from src.proxy import TunnelProxy
+from src.routes import RouteMap, remove_route, set_route
+
+
+class TunnelTestCase(TestCase):
+    """Tunnel API tests, against the Redis of the settings.
+
+    System users and nginx configs are left alone: their helpers are mocked.
+    """
+
+    @classmethod
+    def setUpTestData(cls) -> None:
+        with mock.patch("src.signals.create_user_profile"):
+            cls.user = User.objects.create_user(username="tester", password="-")
+        with mock.patch("src.signals.gen_default_nginx_conf"):
+            cls.project = Project.objects.create(domain="test.demo.test", user=cls.user)
+
+    def setUp(self) -> None:
+        for target in (
+            "src.models.gen_nginx_conf",
+            "src.models.reset_default_nginx_conf",
+            "src.signals.gen_default_nginx_conf",
+            "src.signals.remove_nginx_conf",
+        ):
+            self.enterContext(mock.patch(target, return_value=True))
+        invalidate_project_info(self.project.domain)
+        self.addCleanup(self.disconnect, self.project.id, self.project.domain)
+
+    def disconnect(self, project_id: int, domain: str) -> None:
+        connection_registry.unregister(project_id, domain)
+        port_allocator.release(project_id)
+        invalidate_project_info(domain)
+
+    def post(self, name, **data):
+        return self.client.post(reverse(name), {"domain": self.project.domain, **data})
+
+
+class CachedProjectLookupTest(TunnelTestCase):
+    def test_cold_lookup_queries_once(self) -> None:
+        with self.assertNumQueries(1):
+            get_project_info(self.project.domain)
+        with self.assertNumQueries(0):
+            info = get_project_info(self.project.domain)
+        self.assertEqual(info.id, self.project.id)
+        self.assertEqual(info.username, self.user.username)
+        self.assertTrue(info.check_secret_key(self.project.secret_key))
+
+    def test_tunnel_api_does_no_query_once_cached(self) -> None:
+        get_project_info(self.project.domain)
+        secret_key = self.project.secret_key
+        with self.assertNumQueries(0):
+            response = self.post("get_connection_info")
+            self.assertEqual(response.status_code, 200)
+            port = response.json()["port"]
+
+            response = self.post("connect", secret_key=secret_key, port=port)
+            self.assertEqual(response.json()["success"], True)
+
+            response = self.post("keep_alive")
+            self.assertEqual(response.json()["success"], True)
+
+            response = self.post("disconnect", secret_key=secret_key)
+            self.assertEqual(response.json()["success"], True)
+
+    def test_unknown_domain_is_not_cached(self) -> None:
+        with self.assertNumQueries(1):
+            self.assertIsNone(get_project_info("unknown.demo.test"))
+        with self.assertNumQueries(1):
+            self.assertIsNone(get_project_info("unknown.demo.test"))
+
+
+class StickyPortTest(SimpleTestCase):
+    def setUp(self) -> None:
+        self.allocator = PortAllocator(
+            namespace="demos:test:ports",
+            start=40000,
+            end=40009,
+            probe=False,
+            sticky=True,
+        )
+        self.addCleanup(self.allocator.reset)
+
+    def lease_deadline(self, port: int) -> float:
+        return self.allocator.redis.zscore(self.allocator.keys[1], port)
+
+    def test_port_is_kept_across_releases(self) -> None:
+        port = self.allocator.acquire(1)
+        self.allocator.release(1)
+        self.assertEqual(self.allocator.acquire(1), port)
+
+    def test_acquire_keeps_a_later_deadline(self) -> None:
+        port = self.allocator.acquire(1)
+        self.allocator.renew(1, port, timeout=300)
+        deadline = self.lease_deadline(port)
+        self.assertEqual(self.allocator.acquire(1, timeout=30), port)
+        self.assertEqual(self.lease_deadline(port), deadline)
+
+    def test_preference_expires(self) -> None:
+        self.allocator.acquire(1)
+        self.allocator.release(1)
+        self.allocator.redis.zadd(self.allocator.keys[6], {1: 0})
+        self.allocator.acquire(2)
+        self.assertIsNone(self.allocator.redis.hget(self.allocator.keys[5], 1))
+
+
+class PortProbeTest(SimpleTestCase):
+    def setUp(self) -> None:
+        self.allocator = PortAllocator(
+            namespace="demos:test:ports",
+            start=40000,
+            end=40009,
+            sticky=True,
+        )
+        self.addCleanup(self.allocator.reset)
+
+    def acquire(self, project_id: int, busy: set[int]) -> int | None:
+        with mock.patch(
+            "src.ports.is_port_in_use",
+            side_effect=busy.__contains__,
+        ) as is_port_in_use:
+            port = self.allocator.acquire(project_id)
+        self.probed = {call.args[0] for call in is_port_in_use.call_args_list}
+        return port
+
+    def test_busy_ports_are_not_held(self) -> None:
+        redis = self.allocator.redis
+        port = self.acquire(1, set(range(40000, 40009)))
+        self.assertEqual(port, 40009)
+        self.assertEqual(redis.hgetall(self.allocator.keys[2]), {b"40009": b"1"})
+        self.assertEqual(self.allocator.assigned(1), 40009)
+        for rejected in self.probed - {port}:
+            # kept out of the pool until their lease expires
+            self.assertFalse(redis.sismember(self.allocator.keys[0], rejected))
+            self.assertIsNotNone(redis.zscore(self.allocator.keys[1], rejected))
+
+    def test_busy_sticky_port_is_not_kept(self) -> None:
+        port = self.acquire(1, set())
+        self.allocator.release(1)
+        other = self.acquire(1, {port})
+        self.assertNotEqual(other, port)
+        self.assertEqual(
+            self.allocator.redis.hget(self.allocator.keys[5], 1),
+            b"%d" % other,
+        )
+        self.allocator.release(1)
+        self.assertEqual(self.acquire(1, set()), other)
+
+
+class ReapTest(TunnelTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.port = port_allocator.acquire(self.project.id)
+        self.project.connect(self.port)
+        # the heartbeats stopped, the connection and the lease expired
+        redis = connection_registry.redis
+        redis.zadd(connection_registry.deadlines_key, {self.project.id: 0})
+        redis.zadd(port_allocator.keys[1], {self.port: 0})
+        self.gen_default_nginx_confs = self.enterContext(
+            mock.patch("src.connections.gen_default_nginx_confs"),
+        )
+
+    def test_timed_out_connection(self) -> None:
+        self.assertEqual(reap_expired_connections(), 1)
+        self.assertIsNone(connection_registry.get(self.project.id))
+        self.assertIsNone(port_allocator.owner(self.port))
+        self.gen_default_nginx_confs.assert_called_once_with([self.project.domain])
+
+    def test_port_leased_again_is_kept(self) -> None:
+        port_allocator.renew(self.project.id, self.port)
+        self.assertEqual(reap_expired_connections(), 1)
+        self.assertEqual(port_allocator.owner(self.port), self.project.id)
+
+    def test_connected_again_while_reaping(self) -> None:
+        reap = connection_registry.reap
+
+        def reap_then_connect() -> list[dict]:
+            expired = reap()
+            self.project.connect(port_allocator.acquire(self.project.id))
+            return expired
+
+        with mock.patch.object(connection_registry, "reap", reap_then_connect):
+            self.assertEqual(reap_expired_connections(), 1)
+        self.assertTrue(connection_registry.is_online(self.project.id))
+        self.gen_default_nginx_confs.assert_called_once_with([])
+
+
+class ProjectAdminTest(TunnelTestCase):
+    def test_live_state_is_read_once_per_page(self) -> None:
+        with mock.patch("src.signals.create_user_profile"):
+            admin = User.objects.create_superuser(username="admin", password="-")
+        self.client.force_login(admin)
+        self.project.connect(port_allocator.acquire(self.project.id))
+        with (
+            mock.patch.object(connection_registry, "is_online") as is_online,
+            mock.patch("src.admin.tunnel_prober.state") as state,
+        ):
+            response = self.client.get(reverse("admin:src_project_changelist"))
+        self.assertEqual(response.status_code, 200)
+        is_online.assert_not_called()
+        state.assert_not_called()
+        self.assertContains(response, 'alt="True"')
+
+
+class ProjectCacheInvalidationTest(TunnelTestCase):
+    def assert_cached(self, domain) -> None:
+        with self.assertNumQueries(0):
+            get_project_info(domain)
+
+    def test_secret_key_change_invalidates(self) -> None:
+        get_project_info(self.project.domain)
+        self.project.secret_key = "new-secret"
+        self.project.save()
+        self.assertTrue(
+            get_project_info(self.project.domain).check_secret_key("new-secret"),
+        )
+
+    def test_rename_invalidates_the_old_domain(self) -> None:
+        old_domain = self.project.domain
+        get_project_info(old_domain)
+        self.project.domain = "renamed.demo.test"
+        self.project.save()
+        self.addCleanup(invalidate_project_info, self.project.domain)
+        self.assertIsNone(get_project_info(old_domain))
+        self.assertEqual(get_project_info(self.project.domain).id, self.project.id)
+
+    def test_uncached_field_keeps_the_entry(self) -> None:
+        get_project_info(self.project.domain)
+        self.project.save(update_fields=["last_connected_at"])
+        self.assert_cached(self.project.domain)
+
+    def test_delete_invalidates(self) -> None:
+        get_project_info(self.project.domain)
+        self.project.delete()
+        self.assertIsNone(get_project_info(self.project.domain))
+
+    def test_username_change_invalidates(self) -> None:
+        get_project_info(self.project.domain)
+        self.user.username = "renamed"
+        self.user.save()
+        self.assertEqual(get_project_info(self.project.domain).username, "renamed")
+
+    def test_login_keeps_the_entry(self) -> None:
+        get_project_info(self.project.domain)
+        self.user.save(update_fields=["last_login"])
+        self.assert_cached(self.project.domain)
+
+
+class KeepAliveTest(TunnelTestCase):
+    def connect(self) -> None:
+        port = self.post("get_connection_info").json()["port"]
+        self.post("connect", secret_key=self.project.secret_key, port=port)
+
+    def test_keep_alive_without_connection(self) -> None:
+        response = self.post("keep_alive")
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()["success"], False)
+
+    def test_keep_alive_connected(self) -> None:
+        self.connect()
+        response = self.post("keep_alive")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["success"], True)
+
+    def test_batch_tells_which_domains_are_connected(self) -> None:
+        self.connect()
+        response = self.client.post(
+            reverse("keep_alive_batch"),
+            {"domain": [self.project.domain, "unknown.demo.test"]},
+        )
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(
+            response.json()["alive"],
+            {self.project.domain: True, "unknown.demo.test": False},
+        )
+        response = self.post("keep_alive_batch")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["alive"], {self.project.domain: True})
+
+
+class HandshakeTest(TunnelTestCase):
+    def handshake(self, **data):
+        return self.post(
+            "handshake",
+            secret_key=self.project.secret_key,
+            credential="certificate",
+            **data,
+        )
+
+    def test_no_certificate_without_port(self) -> None:
+        with (
+            mock.patch("src.views.get_available_port", return_value=None),
+            mock.patch("src.views.issue_certificate") as issue_certificate,
+        ):
+            response = self.handshake()
+        self.assertEqual(response.status_code, 503)
+        issue_certificate.assert_not_called()
+
+    def test_invalid_public_key_releases_port(self) -> None:
+        response = self.handshake(public_key="ssh-ed25519 invalid")
+        self.assertEqual(response.status_code, 400)
+        self.assertIsNone(port_allocator.assigned(self.project.id))
+
+    def test_signing_failure_releases_port(self) -> None:
+        error = subprocess.CalledProcessError(1, "ssh-keygen")
+        with (
+            mock.patch("src.funks.sign_public_key", side_effect=error),
+            self.assertRaises(subprocess.CalledProcessError),
+        ):
+            self.handshake()
+        self.assertIsNone(port_allocator.assigned(self.project.id))
+
+
+class SignPublicKeyTest(SimpleTestCase):
+    def setUp(self) -> None:
+        root = self.enterContext(tempfile.TemporaryDirectory())
+        self.ca_key_path = Path(root, "ca")
+        _, self.public_key = generate_key_pair("ed25519")
+
+    def test_signed(self) -> None:
+        create_ca_key(self.ca_key_path)
+        certificate = sign_public_key(self.public_key, "tester", 60, self.ca_key_path)
+        self.assertTrue(certificate.startswith("ssh-ed25519-cert-v01@openssh.com "))
+
+    def test_invalid_public_key(self) -> None:
+        create_ca_key(self.ca_key_path)
+        for public_key in (
+            "ssh-ed25519 invalid",
+            f"{self.public_key}\n{self.public_key}",
+        ):
+            with self.assertRaises(InvalidPublicKeyError):
+                sign_public_key(public_key, "tester", 60, self.ca_key_path)
+
+    def test_missing_ca_key_is_not_the_client_fault(self) -> None:
+        with self.assertRaises(subprocess.CalledProcessError):
+            sign_public_key(self.public_key, "tester", 60, self.ca_key_path)
+
+
+class AuthorizedKeysTest(SimpleTestCase):
+    def test_environment_overrides_the_env_file(self) -> None:
+        with (
+            mock.patch.dict(os.environ, {"REDIS_PORT": "16379"}, clear=True),
+            mock.patch(
+                "dotenv.dotenv_values",
+                return_value={"REDIS_PORT": "6380", "REDIS_DB": "3"},
+            ),
+        ):
+            settings = authorized_keys.get_redis_settings()
+        self.assertEqual(
+            settings,
+            {"REDIS_HOST": "localhost", "REDIS_PORT": "16379", "REDIS_DB": "3"},
+        )
+
+    def test_unreadable_env_file(self) -> None:
+        with mock.patch("dotenv.dotenv_values", side_effect=PermissionError):
+            settings = authorized_keys.get_redis_settings()
+        self.assertEqual(settings.keys(), authorized_keys.REDIS_SETTINGS.keys())
+
+    def test_failed_lookup_prints_nothing(self) -> None:
+        output = io.StringIO()
+        with (
+            mock.patch.object(
+                authorized_keys,
+                "get_authorized_keys",
+                side_effect=ValueError,
+            ),
+            redirect_stdout(output),
+            redirect_stderr(output),
+        ):
+            self.assertEqual(authorized_keys.main(["tester"]), 1)
+        self.assertEqual(output.getvalue(), "")
+
+
+class RouteMapTest(SimpleTestCase):
+    def setUp(self) -> None:
+        root = self.enterContext(tempfile.TemporaryDirectory())
+        self.path = Path(root, "routes.map")
+        self.route_map = RouteMap(self.path)
+        self.addCleanup(remove_route, "a.demo.test")
+        self.addCleanup(remove_route, "b.demo.test")
+        set_route("a.demo.test", 20001)
+
+    def read(self) -> set[str]:
+        return set(self.path.read_text().splitlines())
+
+    def test_update_changes_one_route(self) -> None:
+        self.assertTrue(self.route_map.update({"a.demo.test": "127.0.0.1:20001"}))
+        with mock.patch("src.routes.get_routes") as get_routes:
+            self.assertTrue(self.route_map.update({"b.demo.test": "-"}))
+            self.assertFalse(self.route_map.update({"b.demo.test": "-"}))
+            self.assertTrue(self.route_map.update({"a.demo.test": None}))
+        get_routes.assert_not_called()
+        self.assertEqual(self.read(), {"b.demo.test -;"})
+
+    def test_file_replaced_by_another_process(self) -> None:
+        self.route_map.update({"a.demo.test": "127.0.0.1:20001"})
+        other = RouteMap(self.path)
+        set_route("b.demo.test", 20002)
+        other.update({"b.demo.test": "127.0.0.1:20002"})
+        set_route("a.demo.test")
+        self.route_map.update({"a.demo.test": "-"})
+        self.assertEqual(
+            self.read(),
+            {"a.demo.test -;", "b.demo.test 127.0.0.1:20002;"},
+        )
+
+
+class EdgeAgentTest(SimpleTestCase):
+    def setUp(self) -> None:
+        self.enterContext(
+            mock.patch.dict(
+                "src.edge._tasks",
+                {"write": (lambda changed: changed, "nginx"), "fail": (None, "nginx")},
+            ),
+        )
+        self.agent = EdgeAgent(window=0)
+
+    def submit(self, task, **kwargs) -> str:
+        event_id = f"test-{task}-{len(self.agent.pending)}"
+        self.addCleanup(self.agent.redis.delete, EDGE_APPLIED.format(event_id))
+        self.agent.apply(
+            {"id": event_id, "task": task, "args": [], "kwargs": kwargs, "reply": True},
+        )
+        return event_id
+
+    def replies(self, *event_ids) -> list[bytes]:
+        self.agent.run_once()
+        return [self.agent.redis.lpop(EDGE_APPLIED.format(i)) for i in event_ids]
+
+    def test_applied(self) -> None:
+        events = self.submit("write", changed=True), self.submit("write", changed=False)
+        with mock.patch("src.edge.reload_service") as reload_service:
+            self.assertEqual(self.replies(*events), [b"1", b"1"])
+        reload_service.assert_called_once_with("nginx")
+
+    def test_failures_sent_back(self) -> None:
+        events = self.submit("write", changed=True), self.submit("write", changed=False)
+        events += (self.submit("fail"),)
+        error = subprocess.CalledProcessError(1, "service")
+        with (
+            mock.patch("src.edge.reload_service", side_effect=error),
+            self.assertLogs(level="ERROR"),
+        ):
+            self.assertEqual(self.replies(*events), [b"0", b"1", b"0"])
+        self.assertEqual(self.agent.failed, set())
+
+
+class ProxyCacheDirTest(SimpleTestCase):
+    def test_cache_dir_parent_created(self) -> None:
+        root = self.enterContext(tempfile.TemporaryDirectory())
+        cache_dir = Path(root, "cache", "demos")
+        for target, value in (
+            ("src.edge.EDGE_AGENT_ENABLED", False),
+            ("src.funks.PROXY_CACHE_DIR", str(cache_dir)),
+        ):
+            self.enterContext(mock.patch(target, value))
+        self.enterContext(mock.patch("src.edge.reload_service"))
+        render_to_file = self.enterContext(mock.patch("src.funks.render_to_file"))
+        gen_nginx_server_conf("test.demo.test", 20001)
+        self.assertFalse(cache_dir.exists())
+        gen_nginx_server_conf("test.demo.test", 20001, cache=True)
+        self.assertTrue(cache_dir.is_dir())
+        self.assertEqual(
+            render_to_file.call_args.kwargs["cache_dir"],
+            cache_dir / "test.demo.test",
+        )
+
+
+class OfflinePageTest(SimpleTestCase):
+    def test_reloaded_when_changed(self) -> None:
+        root = self.enterContext(tempfile.TemporaryDirectory())
+        path = Path(root, "index.html")
+        path.write_bytes(b"offline")
+        self.enterContext(mock.patch("src.proxy.OFFLINE_PAGE", str(path)))
+        proxy = TunnelProxy()
+        self.assertEqual(async_to_sync(proxy.get_offline_page)(), b"offline")
+        path.write_bytes(b"maintenance")
+        os.utime(path, ns=(0, 0))
+        self.assertEqual(async_to_sync(proxy.get_offline_page)(), b"maintenance")
+        path.unlink()
+        self.assertEqual(async_to_sync(proxy.get_offline_page)(), b"maintenance")
+
+
+class RequestLoggerTest(SimpleTestCase):
+    @override_settings(
+        LOGGING_SAMPLED_URL_NAME_LIST=("keep_alive",),
+        LOGGING_SAMPLE_EVERY=3,
+    )
+    def test_sampled_url_names(self) -> None:
+        middleware = RequestLoggerMiddleware(lambda _: None)
+        factory = RequestFactory()
+
+        def should_log(name) -> bool:
+            request = factory.post(reverse(name))
+            request.resolver_match = resolve(request.path_info)
+            return middleware.should_log(request)
+
+        self.assertEqual(
+            [should_log("keep_alive") for _ in range(6)],
+            [True, False, False, True, False, False],
+        )
+        self.assertTrue(should_log("connect"))
+        self.assertTrue(should_log("connect"))
+
+    @override_settings(LOGGING_SAMPLED_URL_NAME_LIST=("keep_alive",))
+    def test_user_skipped_for_sampled_url_names(self) -> None:
+        middleware = RequestLoggerMiddleware(lambda _: None)
+
+        def log(name) -> tuple[mock.MagicMock, str]:
+            request = RequestFactory().post(reverse(name))
+            request.resolver_match = resolve(request.path_info)
+            request.user = mock.MagicMock()
+            request.user.__str__.return_value = "tester"
+            message = middleware.format_message(middleware.get_fields(request))
+            return request.user, message
+
+        user, message = log("keep_alive")
+        user.__str__.assert_not_called()
+        self.assertNotIn("User:", message)
+        user, message = log("connect")
+        self.assertIn("User: tester", message)
@@ -16,18 +16,30 @@ Including another URLconf
 
 """
 
+from collections.abc import Callable
+
 from django.contrib import admin
 from django.http import HttpResponse
 from django.shortcuts import redirect
 from django.urls import path
 
+from src.env import TUNNEL_API_ASYNC
 from src.views import (
     LoginView,
+    aconnect,
+    adisconnect,
+    aget_connection_info,
+    ahandshake,
+    akeep_alive_connection,
+    akeep_alive_connections,
     connect,
     disconnect,
+    get_certificate,
     get_connection_info,
     get_key_file,
+    handshake,
     keep_alive_connection,
+    keep_alive_connections,
     signup,
 )
 
@@ -36,15 +48,36 @@ admin.site.site_title = "DEMOS"
 admin.site.index_title = "Welcome to Demos"
 admin.site.site_url = None
 
+
+def tunnel_view(sync_view, async_view) -> Callable:
+    """Pick the async view when the tunnel API is served by an ASGI server."""
+    return async_view if TUNNEL_API_ASYNC else sync_view
+
+
 urlpatterns = [
     path("health", lambda _: HttpResponse("OK")),
     path("admin/login/", LoginView.as_view(), name="login"),
     path("admin/signup/", signup, name="signup"),
     path("admin/", admin.site.urls),
-    path("get_connection_info/", get_connection_info),
-    path("get_key_file/", get_key_file),
-    path("connect/", connect),
-    path("disconnect/", disconnect),
-    path("keep_alive/", keep_alive_connection),
+    path(
+        "get_connection_info/",
+        tunnel_view(get_connection_info, aget_connection_info),
+        name="get_connection_info",
+    ),
+    path("get_key_file/", get_key_file, name="get_key_file"),
+    path("get_certificate/", get_certificate, name="get_certificate"),
+    path("handshake/", tunnel_view(handshake, ahandshake), name="handshake"),
+    path("connect/", tunnel_view(connect, aconnect), name="connect"),
+    path("disconnect/", tunnel_view(disconnect, adisconnect), name="disconnect"),
+    path(
+        "keep_alive/",
+        tunnel_view(keep_alive_connection, akeep_alive_connection),
+        name="keep_alive",
+    ),
+    path(
+        "keep_alive/batch/",
+        tunnel_view(keep_alive_connections, akeep_alive_connections),
+        name="keep_alive_batch",
+    ),
     path("", lambda _: redirect("admin/")),
 ]
@@ -1,103 +1,392 @@
-import threading
-from pathlib import Path
+import io
 from typing import Any, Never
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.contrib.auth import login
 from django.contrib.auth.models import User
 from django.contrib.auth.views import LoginView as BaseLoginView
-from django.core.cache import cache
 from django.http import FileResponse, Http404, HttpRequest, HttpResponse, JsonResponse
 from django.shortcuts import redirect, render
 from django.views.decorators.csrf import csrf_exempt
 
-from src.env import CLOUDFLARE_SITE_KEY
+from src.connections import connection_registry
+from src.env import (
+    CLOUDFLARE_SITE_KEY,
+    KEEP_ALIVE_TIMEOUT,
+    SSH_KEY_TTL,
+    TRUTHY_VALUES,
+    TUNNEL_SHARED_ACCOUNT,
+)
 from src.exceptions import CsrfFailureException
 from src.forms import AdminAuthenticationForm, UserCreationForm
 from src.funks import (
     check_cf_turnstile,
-    gen_key_pair,
+    create_tunnel_socket_dir,
     get_available_port,
-    remove_key_pair,
+    get_tunnel_socket_path,
+    get_tunnel_user,
+    issue_certificate,
+    issue_key_pair,
 )
-from src.models import Project
+from src.keys import InvalidPublicKeyError
+from src.ports import port_allocator
+from src.projects import aget_project_info, get_project_info
 
 
 @csrf_exempt
 def get_connection_info(request: HttpRequest) -> JsonResponse:
-    """Generate user, port and domain of the project."""
+    """Generate user, port and domain of the project.
+
+    Clients asking for `mode=unix` get a unix socket path to forward to
+    instead of a port, unless every tunnel logs in as a shared account.
+    """
     domain = request.POST.get("domain")
-    try:
-        project = Project.objects.get(domain=domain)
-    except Project.DoesNotExist as e:
-        raise Http404 from e
+    mode = request.POST.get("mode", "tcp")
+    project = get_project_info(domain)
+    if project is None:
+        raise Http404
+
+    if mode == "unix" and TUNNEL_SHARED_ACCOUNT:
+        return JsonResponse(
+            {"error": "Unix sockets are not available on this server"},
+            status=400,
+        )
+    if mode == "unix":
+        create_tunnel_socket_dir(project.username)
+        return JsonResponse(
+            {
+                "user": project.username,
+                "socket": str(
+                    get_tunnel_socket_path(project.username, project.domain),
+                ),
+            },
+        )
+    if mode != "tcp":
+        return JsonResponse({"error": "Invalid mode"}, status=400)
 
     return JsonResponse(
         {
-            "user": project.user.username,
+            "user": get_tunnel_user(project.username),
             "port": get_available_port(project.id),
         },
     )
 
 
+@csrf_exempt
+async def aget_connection_info(request: HttpRequest) -> JsonResponse:
+    """Async version of `get_connection_info`."""
+    domain = request.POST.get("domain")
+    mode = request.POST.get("mode", "tcp")
+    project = await aget_project_info(domain)
+    if project is None:
+        raise Http404
+
+    if mode == "unix" and TUNNEL_SHARED_ACCOUNT:
+        return JsonResponse(
+            {"error": "Unix sockets are not available on this server"},
+            status=400,
+        )
+    if mode == "unix":
+        await sync_to_async(create_tunnel_socket_dir, thread_sensitive=False)(
+            project.username,
+        )
+        return JsonResponse(
+            {
+                "user": project.username,
+                "socket": str(
+                    get_tunnel_socket_path(project.username, project.domain),
+                ),
+            },
+        )
+    if mode != "tcp":
+        return JsonResponse({"error": "Invalid mode"}, status=400)
+
+    return JsonResponse(
+        {
+            "user": get_tunnel_user(project.username),
+            "port": await port_allocator.aacquire(project.id),
+        },
+    )
+
+
 @csrf_exempt
 def get_key_file(request: HttpRequest) -> FileResponse:
-    """Generate a key pair and returns the private key file."""
+    """Issue a key pair and return the private key file."""
     if request.method == "POST":
         domain = request.POST.get("domain")
         secret_key = request.POST.get("secret_key")
 
-        try:
-            project = Project.objects.get(domain=domain)
-        except Project.DoesNotExist:
+        project = get_project_info(domain)
+        if project is None:
             return JsonResponse({"error": "Project not found"}, status=404)
 
-        if project.secret_key != secret_key:
+        if not project.check_secret_key(secret_key):
             return JsonResponse({"error": "Invalid secret_key"}, status=403)
 
-        _, private_key_path = gen_key_pair(project.user.username)
+        port = None
+        if TUNNEL_SHARED_ACCOUNT:
+            # the key may only forward the port leased by get_connection_info
+            port = port_allocator.assigned(project.id)
+            if port is None or port_allocator.owner(port) != project.id:
+                return JsonResponse({"error": "Port not available"}, status=409)
+        private_key = issue_key_pair(project.username, port)
 
-        threading.Timer(
-            60,
-            remove_key_pair,
-            args=(project.user.username,),
-        ).start()
+        return FileResponse(io.BytesIO(private_key), filename="private_key.pem")
+    raise Http404
+
+
+@csrf_exempt
+def get_certificate(request: HttpRequest) -> JsonResponse:
+    """Sign a short-lived SSH certificate logging in as the project's user.
+
+    Clients may send their own `public_key`, otherwise a key pair is issued
+    and its private key is returned along with the certificate.
+    """
+    if request.method == "POST":
+        domain = request.POST.get("domain")
+        secret_key = request.POST.get("secret_key")
+        public_key = request.POST.get("public_key")
+
+        project = get_project_info(domain)
+        if project is None:
+            return JsonResponse({"error": "Project not found"}, status=404)
 
-        return FileResponse(Path(private_key_path).open("rb"))
+        if not project.check_secret_key(secret_key):
+            return JsonResponse({"error": "Invalid secret_key"}, status=403)
+
+        if TUNNEL_SHARED_ACCOUNT:
+            # a certificate cannot restrict the port the shared account forwards
+            return JsonResponse(
+                {"error": "Certificates are not available on this server"},
+                status=400,
+            )
+
+        try:
+            data = issue_certificate(project.username, public_key)
+        except InvalidPublicKeyError:
+            return JsonResponse({"error": "Invalid public_key"}, status=400)
+
+        return JsonResponse({"user": project.username, **data})
     raise Http404
 
 
+def check_handshake_options(mode, credential) -> str | None:
+    """Tell why the handshake options cannot be served, if they cannot.
+
+    :param mode: string, "tcp" or "unix"
+    :param credential: string, "key" or "certificate"
+    :return: string, error message, or None
+    """
+    if mode not in ("tcp", "unix") or credential not in ("key", "certificate"):
+        return "Invalid mode or credential"
+    if TUNNEL_SHARED_ACCOUNT and (mode == "unix" or credential == "certificate"):
+        return "Only tcp tunnels with a key are available on this server"
+    return None
+
+
+def lease_tunnel(project, mode) -> dict:
+    """Lease a port to the project, or give the unix socket it forwards to.
+
+    :param project: ProjectInfo
+    :param mode: string, "tcp" or "unix"
+    :return: dict(port: int or None) or dict(socket: string)
+    """
+    if mode == "unix":
+        create_tunnel_socket_dir(project.username)
+        return {
+            "socket": str(get_tunnel_socket_path(project.username, project.domain)),
+        }
+    return {"port": get_available_port(project.id)}
+
+
+def release_lease(project, port) -> None:
+    """Give back the port leased to the project, if one was.
+
+    :param project: ProjectInfo
+    :param port: int or None
+    """
+    if port is not None:
+        port_allocator.release(project.id, port)
+
+
+def issue_credential(project, credential, public_key, port) -> dict:
+    """Issue the credential the tunnel logs in with.
+
+    :param project: ProjectInfo
+    :param credential: string, "key" or "certificate"
+    :param public_key: string, key to certify, or None for an issued key pair
+    :param port: int, the port leased to the tunnel, or None
+    :return: dict
+    :raises InvalidPublicKeyError: if the public key is invalid
+    """
+    if credential == "certificate":
+        return issue_certificate(project.username, public_key)
+    return {"private_key": issue_key_pair(project.username, port).decode()}
+
+
+@csrf_exempt
+def handshake(request: HttpRequest) -> JsonResponse:
+    """Everything a client needs to open its tunnel, in a single request.
+
+    Leases a port (or, with `mode=unix`, gives the socket path) and issues
+    the credential: a key pair, or with `credential=certificate` a certificate
+    for the posted `public_key` or for an issued key pair. With `connect=true`
+    the domain is routed to the tunnel at once, so the client does not need to
+    call `connect/` once SSH is up; visitors get a 502 until it is.
+    """
+    if request.method != "POST":
+        raise Http404
+
+    domain = request.POST.get("domain")
+    secret_key = request.POST.get("secret_key")
+    mode = request.POST.get("mode", "tcp")
+    credential = request.POST.get("credential", "key")
+    implicit_connect = request.POST.get("connect", "").lower() in TRUTHY_VALUES
+    wait = request.POST.get("wait", "").lower() in TRUTHY_VALUES
+
+    project = get_project_info(domain)
+    if project is None:
+        return JsonResponse({"error": "Project not found"}, status=404)
+
+    if not project.check_secret_key(secret_key):
+        return JsonResponse({"error": "Invalid secret_key"}, status=403)
+
+    error = check_handshake_options(mode, credential)
+    if error:
+        return JsonResponse({"error": error}, status=400)
+
+    data = {
+        "user": get_tunnel_user(project.username),
+        "key_ttl": SSH_KEY_TTL,
+        "keep_alive_timeout": KEEP_ALIVE_TIMEOUT,
+    }
+    # lease first, so no credential is issued for a tunnel that cannot open
+    data |= lease_tunnel(project, mode)
+    port, socket = data.get("port"), data.get("socket")
+    if mode == "tcp" and port is None:
+        return JsonResponse({"error": "No port available"}, status=503)
+
+    # the lease is given back whenever the client does not get the tunnel
+    try:
+        data |= issue_credential(
+            project,
+            credential,
+            request.POST.get("public_key"),
+            port,
+        )
+        if implicit_connect:
+            data["applied"] = project.to_project().connect(port, socket, wait=wait)
+    except InvalidPublicKeyError:
+        release_lease(project, port)
+        return JsonResponse({"error": "Invalid public_key"}, status=400)
+    except BaseException:
+        release_lease(project, port)
+        raise
+    data["connected"] = implicit_connect
+    return JsonResponse(data)
+
+
+@csrf_exempt
+async def ahandshake(request: HttpRequest) -> JsonResponse:
+    """Async version of `handshake`, run in a worker thread.
+
+    Issuing the credential may generate a key pair and routing the domain
+    reloads nginx, neither of which has an async version.
+    """
+    return await sync_to_async(handshake, thread_sensitive=False)(request)
+
+
 @csrf_exempt
 def connect(request) -> JsonResponse:
     if request.method == "POST":
         domain = request.POST.get("domain")
         secret_key = request.POST.get("secret_key")
         port = request.POST.get("port")
+        socket = request.POST.get("socket")
+        # block until the edge agent has routed the domain to the tunnel
+        wait = request.POST.get("wait", "").lower() in TRUTHY_VALUES
 
-        try:
-            project = Project.objects.get(domain=domain)
-        except Project.DoesNotExist:
+        project = get_project_info(domain)
+        if project is None:
+            return JsonResponse(
+                {"success": False, "error": "Project not found"},
+                status=404,
+            )
+
+        if not project.check_secret_key(secret_key):
+            return JsonResponse(
+                {"success": False, "error": "Invalid secret_key"},
+                status=403,
+            )
+
+        if socket:
+            if TUNNEL_SHARED_ACCOUNT or socket != str(
+                get_tunnel_socket_path(project.username, project.domain),
+            ):
+                return JsonResponse(
+                    {"success": False, "error": "Socket not available"},
+                    status=409,
+                )
+            applied = project.to_project().connect(socket=socket, wait=wait)
+            return JsonResponse({"success": True, "applied": applied})
+
+        if not port or port_allocator.owner(port) != project.id:
+            return JsonResponse(
+                {"success": False, "error": "Port not available"},
+                status=409,
+            )
+
+        applied = project.to_project().connect(int(port), wait=wait)
+
+        return JsonResponse({"success": True, "applied": applied})
+
+    raise Http404
+
+
+@csrf_exempt
+async def aconnect(request) -> JsonResponse:
+    """Async version of `connect`."""
+    if request.method == "POST":
+        domain = request.POST.get("domain")
+        secret_key = request.POST.get("secret_key")
+        port = request.POST.get("port")
+        socket = request.POST.get("socket")
+        wait = request.POST.get("wait", "").lower() in TRUTHY_VALUES
+
+        project = await aget_project_info(domain)
+        if project is None:
             return JsonResponse(
                 {"success": False, "error": "Project not found"},
                 status=404,
             )
 
-        if project.secret_key != secret_key:
+        if not project.check_secret_key(secret_key):
             return JsonResponse(
                 {"success": False, "error": "Invalid secret_key"},
                 status=403,
             )
 
-        if cache.get(port) != project.id:
+        if socket:
+            if TUNNEL_SHARED_ACCOUNT or socket != str(
+                get_tunnel_socket_path(project.username, project.domain),
+            ):
+                return JsonResponse(
+                    {"success": False, "error": "Socket not available"},
+                    status=409,
+                )
+            applied = await project.to_project().aconnect(socket=socket, wait=wait)
+            return JsonResponse({"success": True, "applied": applied})
+
+        if not port or await port_allocator.aowner(port) != project.id:
             return JsonResponse(
                 {"success": False, "error": "Port not available"},
                 status=409,
             )
 
-        cache.delete(port)
-        project.connect(port)
+        applied = await project.to_project().aconnect(int(port), wait=wait)
 
-        return JsonResponse({"success": True})
+        return JsonResponse({"success": True, "applied": applied})
 
     raise Http404
 
@@ -108,15 +397,14 @@ def disconnect(request) -> JsonResponse:
         domain = request.POST.get("domain")
         secret_key = request.POST.get("secret_key")
 
-        try:
-            project = Project.objects.get(domain=domain)
-        except Project.DoesNotExist:
+        project = get_project_info(domain)
+        if project is None:
             return JsonResponse({"error": "Project not found"}, status=404)
 
-        if project.secret_key != secret_key:
+        if not project.check_secret_key(secret_key):
             return JsonResponse({"error": "Invalid secret_key"}, status=403)
 
-        project.disconnect()
+        project.to_project().disconnect()
 
         return JsonResponse(
             {
@@ -128,18 +416,106 @@ def disconnect(request) -> JsonResponse:
 
 
 @csrf_exempt
-def keep_alive_connection(request) -> JsonResponse:
-    domain = request.POST.get("domain")
-    try:
-        project = Project.objects.get(domain=domain)
-        project.keep_alive_connection()
+async def adisconnect(request) -> JsonResponse:
+    """Async version of `disconnect`."""
+    if request.method == "POST":
+        domain = request.POST.get("domain")
+        secret_key = request.POST.get("secret_key")
+
+        project = await aget_project_info(domain)
+        if project is None:
+            return JsonResponse({"error": "Project not found"}, status=404)
+
+        if not project.check_secret_key(secret_key):
+            return JsonResponse({"error": "Invalid secret_key"}, status=403)
+
+        await project.to_project().adisconnect()
+
         return JsonResponse(
             {
                 "success": True,
             },
         )
-    except Project.DoesNotExist as e:
-        raise Http404 from e
+
+    raise Http404
+
+
+@csrf_exempt
+def keep_alive_connection(request) -> JsonResponse:
+    domain = request.POST.get("domain")
+    project = get_project_info(domain)
+    if project is None:
+        raise Http404
+    if not project.to_project().keep_alive_connection():
+        return JsonResponse(
+            {"success": False, "error": "Not connected"},
+            status=409,
+        )
+    return JsonResponse(
+        {
+            "success": True,
+        },
+    )
+
+
+@csrf_exempt
+async def akeep_alive_connection(request) -> JsonResponse:
+    """Async version of `keep_alive_connection`."""
+    domain = request.POST.get("domain")
+    project = await aget_project_info(domain)
+    if project is None:
+        raise Http404
+    if not await project.to_project().akeep_alive_connection():
+        return JsonResponse(
+            {"success": False, "error": "Not connected"},
+            status=409,
+        )
+    return JsonResponse(
+        {
+            "success": True,
+        },
+    )
+
+
+def keep_alive_response(domains: list[str], alive: list[bool]) -> JsonResponse:
+    """Answer a batch of heartbeats, with a 409 if a domain is not connected.
+
+    :param domains: list of strings
+    :param alive: list of bool, whether each domain has a live connection
+    :return: JsonResponse
+    """
+    data = {
+        "success": all(alive),
+        "alive": dict(zip(domains, alive, strict=True)),
+    }
+    if not data["success"]:
+        data["error"] = "Not connected"
+    return JsonResponse(data, status=200 if data["success"] else 409)
+
+
+@csrf_exempt
+def keep_alive_connections(request) -> JsonResponse:
+    """Refresh the connections of every `domain` posted, in one go.
+
+    Answered by `HeartbeatMiddleware` before the rest of the middleware.
+    """
+    if request.method == "POST":
+        domains = request.POST.getlist("domain")
+        alive = connection_registry.heartbeat_domains(domains)
+        return keep_alive_response(domains, alive)
+
+    raise Http404
+
+
+@csrf_exempt
+async def akeep_alive_connections(request) -> JsonResponse:
+    """Async version of `keep_alive_connections`."""
+    if request.method == "POST":
+        domains = request.POST.getlist("domain")
+        alive = await connection_registry.aheartbeat_domains(domains)
+        return keep_alive_response(domains, alive)
+
+    raise Http404
 
 
 class LoginView(BaseLoginView):
@@ -0,0 +1,139 @@
+"""WebSocket control channel of the tunnel clients, served over ASGI.
+
+A client opens `/ws/tunnel/` once its tunnel is connected and sends
+`{"domain": ..., "secret_key": ...}` as its first message. From then on the
+open socket is the heartbeat: the server keeps the connection alive in the
+registry while the socket is open, and routes the domain offline as soon as it
+closes, instead of waiting for `KEEP_ALIVE_TIMEOUT` to pass without a
+heartbeat. Events of the domain ("connected" on a new port or socket,
+"disconnected", "timed_out") are pushed to the client as JSON messages.
+"""
+
+import asyncio
+import json
+import logging
+
+from src.async_redis import get_async_redis
+from src.connections import connection_registry
+from src.projects import ProjectInfo, aget_project_info
+
+AUTH_TIMEOUT = 10
+
+# https://developer.mozilla.org/en-US/docs/Web/API/CloseEvent/code
+CLOSE_INVALID_MESSAGE = 4400
+CLOSE_FORBIDDEN = 4403
+CLOSE_NOT_FOUND = 4404
+CLOSE_NOT_CONNECTED = 4409
+
+
+async def authenticate(receive) -> tuple[ProjectInfo | None, int | None]:
+    """Read the first message of the client and find its project.
+
+    :param receive: ASGI receive callable
+    :return: tuple(project, None) or tuple(None, close code)
+    """
+    async with asyncio.timeout(AUTH_TIMEOUT):
+        message = await receive()
+    if message["type"] != "websocket.receive":
+        return None, None
+    try:
+        credentials = json.loads(message.get("text") or message.get("bytes") or "")
+        domain, secret_key = credentials["domain"], credentials["secret_key"]
+    except (ValueError, TypeError, KeyError):
+        return None, CLOSE_INVALID_MESSAGE
+    project = await aget_project_info(domain)
+    if project is None:
+        return None, CLOSE_NOT_FOUND
+    if not project.check_secret_key(secret_key):
+        return None, CLOSE_FORBIDDEN
+    return project, None
+
+
+class TunnelSocket:
+    """One open control channel, watching the connection of a project."""
+
+    def __init__(self, project: ProjectInfo, connected_at: float, send) -> None:
+        self.project = project
+        # the connection the socket keeps alive, moved on by "connected" events
+        self.connected_at = connected_at
+        self.send = send
+
+    async def send_event(self, event: dict) -> None:
+        await self.send({"type": "websocket.send", "text": json.dumps(event)})
+
+    async def keep_alive(self) -> None:
+        """Heartbeat the connection while the socket is open."""
+        interval = connection_registry.timeout / 3
+        while True:
+            await asyncio.sleep(interval)
+            alive = await connection_registry.aheartbeat_domains(
+                [self.project.domain],
+            )
+            if not alive[0]:
+                await self.send(
+                    {"type": "websocket.close", "code": CLOSE_NOT_CONNECTED},
+                )
+                return
+
+    async def forward_events(self, pubsub) -> None:
+        """Push the events published for the domain to the client."""
+        async for message in pubsub.listen():
+            if message["type"] != "message":
+                continue
+            event = json.loads(message["data"])
+            if event["event"] == "connected":
+                self.connected_at = event["connected_at"]
+            await self.send_event(event)
+
+    async def disconnect(self) -> None:
+        """Route the domain offline, unless the client connected again since."""
+        connection = await connection_registry.aget(self.project.id)
+        if connection and connection["connected_at"] == self.connected_at:
+            await self.project.to_project().adisconnect()
+
+
+async def tunnel_websocket(scope, receive, send) -> None:  # noqa: ARG001
+    """ASGI application of `/ws/tunnel/`.
+
+    :param scope: ASGI connection scope
+    :param receive: ASGI receive callable
+    :param send: ASGI send callable
+    """
+    message = await receive()
+    if message["type"] != "websocket.connect":
+        return
+    await send({"type": "websocket.accept"})
+
+    try:
+        project, code = await authenticate(receive)
+    except TimeoutError:
+        project, code = None, CLOSE_INVALID_MESSAGE
+    if project is None:
+        if code:
+            await send({"type": "websocket.close", "code": code})
+        return
+
+    connection = await connection_registry.aget(project.id)
+    if connection is None:
+        await send({"type": "websocket.close", "code": CLOSE_NOT_CONNECTED})
+        return
+
+    socket = TunnelSocket(project, connection["connected_at"], send)
+    pubsub = get_async_redis().pubsub()
+    await pubsub.subscribe(connection_registry.events_channel(project.domain))
+    tasks = [
+        asyncio.create_task(socket.keep_alive()),
+        asyncio.create_task(socket.forward_events(pubsub)),
+    ]
+    try:
+        await socket.send_event({"event": "watching", **connection})
+        # messages of the client are only there to keep proxies from timing out
+        while (await receive())["type"] != "websocket.disconnect":
+            pass
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await pubsub.aclose()
+        await socket.disconnect()
+        logging.info("Control channel of %s closed", project.domain)